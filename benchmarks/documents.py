@@ -0,0 +1,54 @@
+"""Benchmark bulk supplier name sanitisation and document name generation
+
+    PYTHONPATH=. python benchmarks/documents.py [supplier count]
+
+Compares ``dmutils.documents.sanitise_supplier_names`` with the per-character
+``str.replace`` loop it replaced, and ``generate_file_names`` with calling
+``generate_file_name`` once per file.
+"""
+from __future__ import print_function
+import sys
+import timeit
+
+from dmutils.documents import (
+    BAD_SUPPLIER_NAME_CHARACTERS, generate_file_name, generate_file_names, sanitise_supplier_names)
+
+
+def replace_loop_sanitise(supplier_name):
+    sanitised_supplier_name = supplier_name.encode("ascii", errors="ignore").decode("ascii").strip()
+    sanitised_supplier_name = sanitised_supplier_name.replace(' ', '_').replace('&', 'and')
+    for bad_char in BAD_SUPPLIER_NAME_CHARACTERS:
+        sanitised_supplier_name = sanitised_supplier_name.replace(bad_char, '')
+    while '__' in sanitised_supplier_name:
+        sanitised_supplier_name = sanitised_supplier_name.replace('__', '_')
+    return sanitised_supplier_name
+
+
+def supplier_names(count):
+    return [
+        u'  Supplier {} & Sons (Digital) Ltd. | "Caf\xe9"  /  Services #{}  '.format(i, i % 97)
+        for i in range(count)
+    ]
+
+
+def report(name, seconds, count):
+    print("{:<40} {:8.3f}s {:12,.0f} items/s".format(name, seconds, count / seconds))
+
+
+def main(count):
+    names = supplier_names(count)
+    assert sanitise_supplier_names(names) == [replace_loop_sanitise(name) for name in names]
+
+    report("str.replace loop", timeit.timeit(lambda: [replace_loop_sanitise(name) for name in names], number=1),
+           count)
+    report("sanitise_supplier_names", timeit.timeit(lambda: sanitise_supplier_names(names), number=1), count)
+
+    files = [(i, 500000 + i, 'pricingDocumentURL', 'pricing.pdf') for i in range(count)]
+    report("generate_file_name per file", timeit.timeit(
+        lambda: [generate_file_name('g-cloud-7', 'documents', *file) for file in files], number=1), count)
+    report("generate_file_names", timeit.timeit(
+        lambda: generate_file_names('g-cloud-7', 'documents', files), number=1), count)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,122 @@
+"""Benchmark dmutils.s3.S3 operations against the local S3 stand-in
+
+    PYTHONPATH=. python benchmarks/s3.py [--objects 1000] [--latency 0.005]
+
+Each operation runs against a ``LocalS3`` bucket in a temporary directory,
+with ``--latency`` seconds of injected latency per simulated S3 request. The
+report shows operations per second, S3 round trips per operation (from
+``LocalBucket.request_count``) and peak memory. Peak memory is traced
+allocations where ``tracemalloc`` is available (Python 3), and the growth in
+the process's maximum resident set size otherwise.
+
+Round trips per operation are deterministic, so a change in them is a
+regression in request counts rather than noise.
+"""
+from __future__ import print_function
+import argparse
+import io
+import resource
+import shutil
+import sys
+import tempfile
+
+from monotonic import monotonic
+
+from dmutils.s3_local import LocalS3
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+FILE_CONTENTS = b'%PDF-1.4\n' + b'x' * 1024
+
+
+class Benchmark(object):
+    def __init__(self, s3, object_count):
+        self.s3 = s3
+        self.object_count = object_count
+        self.paths = ['g-cloud-7/documents/{0}/{0}-pricing-document.pdf'.format(i) for i in range(object_count)]
+
+    def run(self, name, fn, operations):
+        request_count = self.s3.bucket.request_count
+        if tracemalloc:
+            tracemalloc.start()
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = monotonic()
+
+        fn()
+
+        elapsed = monotonic() - start
+        if tracemalloc:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            # ru_maxrss is in kilobytes on Linux
+            peak_memory = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss) * 1024
+        round_trips = self.s3.bucket.request_count - request_count
+
+        print("{:<32} {:>8} {:>12,.1f} {:>12.2f} {:>14,}".format(
+            name, operations, operations / elapsed, float(round_trips) / operations, peak_memory))
+
+    def save(self):
+        for path in self.paths:
+            self.s3.save(path, io.BytesIO(FILE_CONTENTS))
+
+    def save_existing(self):
+        for path in self.paths:
+            self.s3.save(path, io.BytesIO(FILE_CONTENTS), move_prefix='OLD')
+
+    def save_unchanged(self):
+        for path in self.paths:
+            self.s3.save(path, io.BytesIO(FILE_CONTENTS), skip_unchanged=True)
+
+    def list(self, load_timestamps=False):
+        self.s3.list('g-cloud-7/', load_timestamps=load_timestamps)
+
+    def iter_list(self):
+        for key in self.s3.iter_list('g-cloud-7/'):
+            pass
+
+    def get_signed_url(self):
+        for path in self.paths:
+            self.s3.get_signed_url(path)
+
+    def path_exists(self):
+        for path in self.paths:
+            self.s3.path_exists(path)
+
+    def delete_key(self):
+        for path in self.paths:
+            self.s3.delete_key(path)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--objects', type=int, default=1000, help="number of objects per operation")
+    parser.add_argument('--latency', type=float, default=0.005, help="seconds of latency per S3 request")
+    args = parser.parse_args(argv)
+
+    root = tempfile.mkdtemp()
+    try:
+        benchmark = Benchmark(LocalS3('benchmark', root, latency=args.latency), args.objects)
+        print("{:<32} {:>8} {:>12} {:>12} {:>14}".format(
+            "operation", "ops", "ops/s", "requests/op", "peak memory"))
+
+        benchmark.run("save (new)", benchmark.save, args.objects)
+        benchmark.run("save (existing)", benchmark.save_existing, args.objects)
+        benchmark.run("save (skip_unchanged)", benchmark.save_unchanged, args.objects)
+        # listings include the OLD- copies made by "save (existing)"
+        benchmark.run("list", benchmark.list, 1)
+        benchmark.run("list (load_timestamps)", lambda: benchmark.list(load_timestamps=True), 1)
+        benchmark.run("iter_list", benchmark.iter_list, 1)
+        benchmark.run("get_signed_url", benchmark.get_signed_url, args.objects)
+        benchmark.run("path_exists", benchmark.path_exists, args.objects)
+        benchmark.run("delete_key", benchmark.delete_key, args.objects)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
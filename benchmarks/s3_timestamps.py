@@ -0,0 +1,61 @@
+"""Benchmark S3 key timestamp handling over a large listing
+
+    PYTHONPATH=. python benchmarks/s3_timestamps.py [key count]
+
+Compares ``dmutils.s3.normalise_timestamp`` with the dateutil parse and
+strftime it replaced, and times ``S3._format_key`` plus sorting for a
+listing of S3-format timestamps.
+"""
+from __future__ import print_function
+import datetime
+import sys
+import timeit
+
+from dateutil.parser import parse as parse_time
+
+from dmutils.formats import DATETIME_FORMAT
+from dmutils.s3 import S3, normalise_timestamp
+
+
+class Key(object):
+    def __init__(self, name, last_modified):
+        self.name = name
+        self.last_modified = last_modified
+        self.size = 1
+
+
+def s3_timestamps(count):
+    start = datetime.datetime(2015, 1, 1)
+    return [
+        (start + datetime.timedelta(seconds=i * 7919 % count, milliseconds=i % 1000)).strftime(
+            '%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+        for i in range(count)
+    ]
+
+
+def dateutil_normalise(value):
+    return parse_time(value).strftime(DATETIME_FORMAT)
+
+
+def report(name, seconds, count):
+    print("{:<40} {:8.3f}s {:12,.0f} keys/s".format(name, seconds, count / seconds))
+
+
+def main(count):
+    timestamps = s3_timestamps(count)
+    assert [normalise_timestamp(t) for t in timestamps[:1000]] == [dateutil_normalise(t) for t in timestamps[:1000]]
+
+    report("dateutil parse + strftime", timeit.timeit(lambda: [dateutil_normalise(t) for t in timestamps], number=1),
+           count)
+    report("normalise_timestamp", timeit.timeit(lambda: [normalise_timestamp(t) for t in timestamps], number=1),
+           count)
+
+    s3 = S3.__new__(S3)
+    keys = [Key('dir/file-{}.pdf'.format(i), t) for i, t in enumerate(timestamps)]
+    report("_format_key + sort by last_modified", timeit.timeit(
+        lambda: sorted((s3._format_key(key, False) for key in keys), key=lambda key: key['last_modified']),
+        number=1), count)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
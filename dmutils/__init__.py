@@ -3,4 +3,4 @@ from .flask_init import init_app, init_frontend_app, init_manager
 
 import flask_featureflags
 
-__version__ = '24.4.1'
+__version__ = '24.28.0'
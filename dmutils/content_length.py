@@ -0,0 +1,91 @@
+from werkzeug.exceptions import RequestEntityTooLarge
+
+
+class ContentLengthLimit(object):
+    """WSGI middleware that rejects request bodies over a size limit before they are read
+
+    Requests declaring a larger ``Content-Length`` get a ``413 Request Entity Too Large``
+    response without the application being called. Bodies without a ``Content-Length``,
+    such as chunked uploads, are read through a wrapper that raises ``RequestEntityTooLarge``
+    as soon as more than the limit has been read, which Flask turns into the same response.
+
+    :param app:           WSGI application to wrap
+    :param limit:         maximum body size in bytes, or ``None`` for no limit
+    :param prefix_limits: dict of path prefixes to limits for requests under them, overriding
+                          ``limit``; the longest matching prefix is used
+    """
+
+    def __init__(self, app, limit=None, prefix_limits=None):
+        self.app = app
+        self.limit = limit
+        # longest first, so the most specific prefix matches
+        self.prefix_limits = sorted((prefix_limits or {}).items(), key=lambda item: len(item[0]), reverse=True)
+
+    def __call__(self, environ, start_response):
+        limit = self.get_limit(environ.get('PATH_INFO', ''))
+        if limit is not None:
+            content_length = environ.get('CONTENT_LENGTH')
+            if content_length:
+                try:
+                    too_large = int(content_length) > limit
+                except ValueError:
+                    too_large = False  # left to werkzeug, which treats it as no body
+                if too_large:
+                    return RequestEntityTooLarge()(environ, start_response)
+            elif 'wsgi.input' in environ:
+                environ['wsgi.input'] = LimitedInput(environ['wsgi.input'], limit)
+
+        return self.app(environ, start_response)
+
+    def get_limit(self, path):
+        for prefix, limit in self.prefix_limits:
+            if path.startswith(prefix):
+                return limit
+
+        return self.limit
+
+
+class LimitedInput(object):
+    """``wsgi.input`` wrapper raising ``RequestEntityTooLarge`` once more than ``limit`` bytes are read"""
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.position = 0
+
+    def read(self, size=-1):
+        # read one byte past the limit so an oversized body is detected without reading the rest of it
+        allowed = self.limit + 1 - self.position
+        if size is None or size < 0 or size > allowed:
+            size = allowed
+        return self._count(self.stream.read(size))
+
+    def readline(self, size=-1):
+        allowed = self.limit + 1 - self.position
+        if size is None or size < 0 or size > allowed:
+            size = allowed
+        return self._count(self.stream.readline(size))
+
+    def readlines(self, hint=None):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def _count(self, data):
+        self.position += len(data)
+        if self.position > self.limit:
+            raise RequestEntityTooLarge()
+        return data
+
+
+def init_app(app):
+    """Install ``ContentLengthLimit`` if ``DM_MAX_CONTENT_LENGTH`` or ``DM_MAX_CONTENT_LENGTH_PREFIXES`` is set"""
+    limit = app.config.get('DM_MAX_CONTENT_LENGTH')
+    prefix_limits = app.config.get('DM_MAX_CONTENT_LENGTH_PREFIXES')
+    if limit is not None or prefix_limits:
+        app.wsgi_app = ContentLengthLimit(app.wsgi_app, limit, prefix_limits)
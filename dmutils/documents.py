@@ -1,16 +1,51 @@
+from __future__ import absolute_import
+import base64
+import csv
+import hashlib
+import itertools
+import json
+import logging
 import os
 import datetime
+import re
+import struct
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import six
+from contextlib2 import ExitStack
+from flask import Response, current_app, has_app_context, has_request_context
 
 try:
     import urlparse
 except ImportError:
     import urllib.parse as urlparse
 
-from .s3 import S3ResponseError, get_file_size_up_to_maximum, FILE_SIZE_LIMIT
+from .formats import DATETIME_FORMAT
+from .logging import RequestIdFilter, request_id_context
+from .s3 import (
+    S3ResponseError, DEFAULT_CHUNK_SIZE, DEFAULT_MAX_WORKERS, FILE_SIZE_LIMIT, iter_key_chunks, parse_timestamp)
+from .zipstream import iter_zip
+
+logger = logging.getLogger(__name__)
 
 
 BAD_SUPPLIER_NAME_CHARACTERS = ['#', '%', '&', '{', '}', '\\', '<', '>', '*', '?', '/', '$',
                                 '!', "'", '"', ':', '@', '+', '`', '|', '=', ',', '.']
+# sanitise_supplier_name replaces spaces and removes the other bad characters in a single
+# ``bytes.translate`` pass over the ASCII-encoded name ('&' is replaced with 'and' first)
+SUPPLIER_NAME_TRANSLATION = bytes(bytearray(ord('_') if i == ord(' ') else i for i in range(256)))
+SUPPLIER_NAME_DELETED_CHARACTERS = ''.join(c for c in BAD_SUPPLIER_NAME_CHARACTERS if c != '&').encode('ascii')
+UNDERSCORES_PATTERN = re.compile(br'__+')
+
+ID_TO_FILE_NAME_SUFFIX = {
+    'serviceDefinitionDocumentURL': 'service-definition-document',
+    'termsAndConditionsDocumentURL': 'terms-and-conditions',
+    'sfiaRateDocumentURL': 'sfia-rate-card',
+    'pricingDocumentURL': 'pricing-document',
+}
+
+DEFAULT_READ_AHEAD = 4  # S3 objects opened ahead of the one being written to a ZIP archive
 
 RESULT_LETTER_FILENAME = 'result-letter.pdf'
 AGREEMENT_FILENAME = 'framework-agreement.pdf'
@@ -18,6 +53,41 @@ SIGNED_AGREEMENT_PREFIX = 'signed-framework-agreement'
 COUNTERSIGNED_AGREEMENT_FILENAME = 'countersigned-framework-agreement.pdf'
 SIGNATURE_PAGE_FILENAME = 'signature-page.pdf'
 
+# documents checked by ``audit_framework_documents`` by default
+FRAMEWORK_AUDIT_DOCUMENTS = (SIGNED_AGREEMENT_PREFIX, COUNTERSIGNED_AGREEMENT_FILENAME, RESULT_LETTER_FILENAME)
+AUDIT_MANIFEST_FIELDS = ('supplier_code', 'document', 'status', 'path', 'last_modified')
+
+# attribute of an uploaded file object holding its ``DocumentScan``
+SCAN_ATTRIBUTE = '_dm_document_scan'
+
+#: Result of reading a document once. ``md5`` is ``None`` if the document is over
+#: ``FILE_SIZE_LIMIT``, and otherwise the ``(hexdigest, base64 digest, size)`` tuple
+#: that ``S3.save`` and boto accept in place of hashing the file again.
+DocumentScan = namedtuple('DocumentScan', ['size', 'md5'])
+
+SNIFF_SIZE = 4096  # bytes of a document read to identify its format
+# attribute of an uploaded file object holding its sniffed document type, or '' if unknown
+SNIFF_ATTRIBUTE = '_dm_document_type'
+
+ZIP_LOCAL_FILE_HEADER = struct.Struct('<4s22xHH')
+ODF_MIMETYPE_PREFIX = b'application/vnd.oasis.opendocument.'
+CSV_DELIMITERS = (b',', b';', b'\t')
+
+# document types returned by ``sniff_document_type`` that are valid for each file extension
+EXTENSION_DOCUMENT_TYPES = {
+    '.pdf': ('pdf',),
+    '.pda': ('pdf',),
+    '.odt': ('odf',),
+    '.ods': ('odf',),
+    '.odp': ('odf',),
+    # a single-column CSV has no delimiters, so is only recognised as text
+    '.csv': ('csv', 'text'),
+    '.zip': ('zip', 'odf'),
+    '.jpg': ('jpeg',),
+    '.jpeg': ('jpeg',),
+    '.png': ('png',),
+}
+
 
 def filter_empty_files(files):
     """Remove any empty files from the list.
@@ -32,10 +102,12 @@ def filter_empty_files(files):
     }
 
 
-def validate_documents(files):
+def validate_documents(files, sniff_content=False):
     """Validate document files for size and format
 
     :param files: a dictionary of file attachments
+    :param sniff_content: if True, also reject files whose contents do not
+                          match their extension
 
     :return: a dictionary of errors, where keys match
              the keys from the ``files`` argument and
@@ -49,6 +121,8 @@ def validate_documents(files):
     for field, contents in files.items():
         if not file_is_open_document_format(contents):
             errors[field] = 'file_is_open_document_format'
+        elif sniff_content and not file_content_matches_extension(contents):
+            errors[field] = 'file_is_open_document_format'
         elif not file_is_less_than_5mb(contents):
             errors[field] = 'file_is_less_than_5mb'
 
@@ -87,7 +161,7 @@ def upload_document(uploader, documents_url, service, field, file_contents, publ
     acl = 'public-read' if public else 'private'
 
     try:
-        uploader.save(file_path, file_contents, acl=acl)
+        uploader.save(file_path, file_contents, acl=acl, md5=scan_document(file_contents).md5)
     except S3ResponseError:
         return False
 
@@ -99,13 +173,24 @@ def upload_document(uploader, documents_url, service, field, file_contents, publ
     return full_url
 
 
-def upload_service_documents(uploader, documents_url, service, request_files, section, public=True):
+def upload_service_documents(uploader, documents_url, service, request_files, section, public=True,
+                             max_workers=DEFAULT_MAX_WORKERS, sniff_content=False):
+    """Validate and upload the documents for a section of a service
+
+    Valid documents are uploaded concurrently, at most ``max_workers`` at a time.
+    ``sniff_content`` is passed on to ``validate_documents``.
+
+    :return: ``(files, errors)``, where ``files`` maps each uploaded field to its
+             document URL, or is ``None`` if validation failed, and ``errors`` maps
+             fields to validator names as in ``validate_documents``, or to
+             ``'file_can_be_saved'`` if the upload failed
+    """
     assert uploader.bucket_short_name in ['documents', 'submissions']
 
     files = {field: request_files[field] for field in section.get_question_ids(type="upload")
              if field in request_files}
     files = filter_empty_files(files)
-    errors = validate_documents(files)
+    errors = validate_documents(files, sniff_content=sniff_content)
 
     if errors:
         return None, errors
@@ -113,11 +198,25 @@ def upload_service_documents(uploader, documents_url, service, request_files, se
     if len(files) == 0:
         return {}, {}
 
-    for field, contents in files.items():
-        url = upload_document(
-            uploader, documents_url, service, field, contents,
-            public=public)
-
+    # the upload threads must not push the request context: popping it in each thread would run
+    # the teardown handlers and close the request's files. They get the app context and the
+    # request id for logging instead.
+    app = current_app._get_current_object() if has_app_context() else None
+    request_id = RequestIdFilter().request_id if has_request_context() else None
+
+    def upload(field):
+        with ExitStack() as stack:
+            if app is not None:
+                stack.enter_context(app.app_context())
+            stack.enter_context(request_id_context(request_id))
+            return field, upload_document(
+                uploader, documents_url, service, field, files[field],
+                public=public)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(files))) as executor:
+        uploaded = list(executor.map(upload, list(files)))
+
+    for field, url in uploaded:
         if not url:
             errors[field] = 'file_can_be_saved'
         else:
@@ -131,13 +230,46 @@ def file_is_not_empty(file_contents):
 
 
 def file_is_empty(file_contents):
-    empty = len(file_contents.read(1)) == 0
-    file_contents.seek(0)
-    return empty
+    return scan_document(file_contents).size == 0
 
 
 def file_is_less_than_5mb(file_contents):
-    return get_file_size_up_to_maximum(file_contents) < FILE_SIZE_LIMIT
+    return scan_document(file_contents).size < FILE_SIZE_LIMIT
+
+
+def scan_document(file_contents):
+    """Read a document once to find its size and MD5 digest
+
+    The file is read from the start in chunks, stopping just past ``FILE_SIZE_LIMIT``,
+    and rewound. The result is cached on the file object, so the emptiness and size
+    checks and the upload, which passes the digest on as the ``Content-MD5``, all
+    share this one pass.
+
+    :param file_contents: attached file object
+    :return: ``DocumentScan``
+    """
+    scan = getattr(file_contents, SCAN_ATTRIBUTE, None)
+    if isinstance(scan, DocumentScan):
+        return scan
+
+    checksum = hashlib.md5()
+    size = 0
+    file_contents.seek(0)
+    while size <= FILE_SIZE_LIMIT:
+        chunk = file_contents.read(DEFAULT_CHUNK_SIZE)
+        if not chunk:
+            break
+        checksum.update(chunk)
+        size += len(chunk)
+    file_contents.seek(0)
+
+    md5 = None
+    if size <= FILE_SIZE_LIMIT:
+        md5 = (checksum.hexdigest(), base64.b64encode(checksum.digest()).decode('ascii'), size)
+    scan = DocumentScan(size, md5)
+    _cache_on_file(file_contents, SCAN_ATTRIBUTE, scan)
+
+    return scan
 
 
 def file_is_open_document_format(file_object):
@@ -178,13 +310,6 @@ def generate_file_name(framework_slug, bucket_short_name, supplier_code, service
     if suffix is None:
         suffix = default_file_suffix()
 
-    ID_TO_FILE_NAME_SUFFIX = {
-        'serviceDefinitionDocumentURL': 'service-definition-document',
-        'termsAndConditionsDocumentURL': 'terms-and-conditions',
-        'sfiaRateDocumentURL': 'sfia-rate-card',
-        'pricingDocumentURL': 'pricing-document',
-    }
-
     return '{}/{}/{}/{}-{}-{}{}'.format(
         framework_slug,
         bucket_short_name,
@@ -196,10 +321,98 @@ def generate_file_name(framework_slug, bucket_short_name, supplier_code, service
     )
 
 
+def generate_file_names(framework_slug, bucket_short_name, files, suffix=None):
+    """Generate the names of many files, all with the same timestamp suffix
+
+    :param files: iterable of ``(supplier_code, service_id, field, filename)`` tuples
+    :param suffix: suffix for every name; defaults to a single ``default_file_suffix()``
+
+    :return: list of names in the same order as ``files``
+    """
+    if suffix is None:
+        suffix = default_file_suffix()
+
+    return [
+        generate_file_name(framework_slug, bucket_short_name, supplier_code, service_id, field, filename, suffix)
+        for supplier_code, service_id, field, filename in files
+    ]
+
+
 def default_file_suffix():
     return datetime.datetime.utcnow().strftime("%Y-%m-%d-%H%M")
 
 
+def file_content_matches_extension(file_object):
+    """Checks the file's contents are in the format its extension claims."""
+    return sniff_document_type(file_object) in EXTENSION_DOCUMENT_TYPES.get(get_extension(file_object.filename), ())
+
+
+def sniff_document_type(file_contents):
+    """Identify a document's format from the first ``SNIFF_SIZE`` bytes of its contents
+
+    The header is read from the start of the file, which is then rewound, and the
+    result is cached on the file object.
+
+    :param file_contents: attached file object
+    :return: one of ``'pdf'``, ``'odf'``, ``'zip'``, ``'png'``, ``'jpeg'``, ``'csv'`` or ``'text'``
+             (UTF-8 text without a CSV delimiter on its first line), or ``None`` if the format was
+             not recognised
+    """
+    document_type = getattr(file_contents, SNIFF_ATTRIBUTE, None)
+    if not isinstance(document_type, six.string_types):
+        file_contents.seek(0)
+        header = file_contents.read(SNIFF_SIZE)
+        file_contents.seek(0)
+        document_type = _sniff_header(header) or ''
+        _cache_on_file(file_contents, SNIFF_ATTRIBUTE, document_type)
+
+    return document_type or None
+
+
+def _cache_on_file(file_contents, name, value):
+    try:
+        setattr(file_contents, name, value)
+    except (AttributeError, TypeError):
+        pass  # e.g. a Python 2 built-in file, which is scanned again each time instead
+
+
+def _sniff_header(header):
+    # PDF readers accept the signature anywhere in the first 1KB
+    if b'%PDF-' in header[:1024]:
+        return 'pdf'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if header.startswith(b'PK\x03\x04') and len(header) >= ZIP_LOCAL_FILE_HEADER.size:
+        # ODF packages start with an uncompressed "mimetype" entry naming the format
+        signature, name_length, extra_length = ZIP_LOCAL_FILE_HEADER.unpack_from(header)
+        name_end = ZIP_LOCAL_FILE_HEADER.size + name_length
+        content = header[name_end + extra_length:]
+        if header[ZIP_LOCAL_FILE_HEADER.size:name_end] == b'mimetype' and content.startswith(ODF_MIMETYPE_PREFIX):
+            return 'odf'
+        return 'zip'
+    if header.startswith(b'PK\x05\x06'):
+        return 'zip'  # empty archive
+    if _is_text(header):
+        if any(delimiter in header.split(b'\n', 1)[0] for delimiter in CSV_DELIMITERS):
+            return 'csv'
+        return 'text'
+
+    return None
+
+
+def _is_text(header):
+    if not header or b'\x00' in header:
+        return False
+    try:
+        header.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # the header may end part way through a multi-byte character
+        return len(header) == SNIFF_SIZE and e.start >= len(header) - 3 and _is_text(header[:e.start])
+    return True
+
+
 def get_extension(filename):
     file_name, file_extension = os.path.splitext(filename)
     return file_extension.lower()
@@ -233,12 +446,180 @@ def get_document_path(framework_slug, supplier_code, bucket_category, document_n
     )
 
 
+def iter_documents_zip(s3, paths, read_ahead=DEFAULT_READ_AHEAD, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield a ZIP archive of S3 objects in chunks
+
+    Each object is added under its file name and streamed into the archive in chunks. Objects
+    whose file names would clash, ignoring case, get a numeric suffix, e.g. ``letter-2.pdf``. Up to
+    ``read_ahead`` further objects are opened concurrently while one is being written, which
+    hides the request latency without holding more than one chunk of any object in memory.
+    Objects that do not exist are left out.
+
+    :param s3:         ``dmutils.s3.S3`` instance for the bucket holding the objects
+    :param paths:      iterable of S3 object paths
+    :param read_ahead: maximum number of objects opened ahead of the one being written
+    :param chunk_size: maximum size in bytes of each chunk read from S3
+    """
+    paths = iter(paths)
+    pending = deque()
+    used_names = set()
+    executor = ThreadPoolExecutor(max_workers=read_ahead + 1)
+
+    def entries():
+        while True:
+            # the next object to write and up to read_ahead after it
+            for path in itertools.islice(paths, read_ahead + 1 - len(pending)):
+                pending.append((path, executor.submit(s3.open, path)))
+            if not pending:
+                return
+            path, opened = pending.popleft()
+            key = opened.result()
+            if key is None:
+                logger.warning("Left missing file {filepath} out of ZIP archive", extra={"filepath": path})
+                continue
+            modified = parse_timestamp(key.last_modified) if key.last_modified else datetime.datetime.utcnow()
+            yield _unique_name(os.path.basename(path), used_names), modified, iter_key_chunks(key, chunk_size)
+
+    try:
+        for chunk in iter_zip(entries()):
+            yield chunk
+    finally:
+        # objects opened ahead but never written, e.g. because the client disconnected
+        for path, opened in pending:
+            try:
+                key = opened.result()
+            except Exception:
+                continue
+            if key is not None:
+                key.close()
+        executor.shutdown()
+
+
+def _unique_name(name, used_names):
+    # compared ignoring case, as archives are often extracted onto case-insensitive file systems
+    root, extension = os.path.splitext(name)
+    unique_name = name
+    suffix = 1
+    while unique_name.lower() in used_names:
+        suffix += 1
+        unique_name = '{}-{}{}'.format(root, suffix, extension)
+    used_names.add(unique_name.lower())
+    return unique_name
+
+
+def documents_zip_response(s3, paths, filename, read_ahead=DEFAULT_READ_AHEAD):
+    """Return a Flask response streaming a ZIP archive of S3 objects as a download
+
+    See ``iter_documents_zip``.
+    """
+    return Response(
+        iter_documents_zip(s3, paths, read_ahead=read_ahead),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename="{}"'.format(filename)},
+    )
+
+
+def audit_framework_documents(s3, framework_slug, supplier_codes=None, bucket_category='agreements',
+                              documents=FRAMEWORK_AUDIT_DOCUMENTS, stale_before=None):
+    """Yield the status of each supplier's documents for a framework
+
+    The documents under ``{framework_slug}/{bucket_category}/`` are listed once, as a stream,
+    and the latest key for each supplier and document is kept in memory. No request is made
+    per supplier.
+
+    A document name matches keys named ``{supplier_code}-{document}`` (see
+    ``get_document_path``). A name without an extension, such as ``SIGNED_AGREEMENT_PREFIX``,
+    also matches any key starting with it.
+
+    :param s3:              ``dmutils.s3.S3`` instance for the bucket holding the documents
+    :param supplier_codes:  suppliers expected on the framework; defaults to every supplier
+                            with at least one of the documents
+    :param documents:       document names each supplier should have
+    :param stale_before:    datetime before which a document counts as stale
+
+    :return: generator of dicts with the ``AUDIT_MANIFEST_FIELDS`` keys, where ``status`` is
+             ``'present'``, ``'missing'`` or ``'stale'``, for each supplier and document in order
+    """
+    prefix = '{}/{}/'.format(framework_slug, bucket_category)
+    if stale_before is not None:
+        # last_modified values are DATETIME_FORMAT strings, which sort in time order
+        stale_before = stale_before.strftime(DATETIME_FORMAT)
+
+    latest = {}
+    for key in s3.iter_list(prefix):
+        supplier_code, _, filename = key['path'][len(prefix):].partition('/')
+        if '/' in filename or not filename.startswith(supplier_code + '-'):
+            continue
+        name = filename[len(supplier_code) + 1:]
+        for document in documents:
+            if name == document or (not get_extension(document) and name.startswith(document)):
+                supplier_documents = latest.setdefault(supplier_code, {})
+                if document not in supplier_documents or \
+                        key['last_modified'] > supplier_documents[document]['last_modified']:
+                    supplier_documents[document] = key
+
+    if supplier_codes is None:
+        supplier_codes = sorted(latest)
+    for supplier_code in supplier_codes:
+        supplier_documents = latest.get(six.text_type(supplier_code), {})
+        for document in documents:
+            key = supplier_documents.get(document)
+            if key is None:
+                status = 'missing'
+            elif stale_before is not None and key['last_modified'] < stale_before:
+                status = 'stale'
+            else:
+                status = 'present'
+            yield {
+                'supplier_code': supplier_code,
+                'document': document,
+                'status': status,
+                'path': key['path'] if key else None,
+                'last_modified': key['last_modified'] if key else None,
+            }
+
+
+def iter_audit_csv(results):
+    """Yield a CSV manifest of ``audit_framework_documents`` results line by line, with a header row
+
+    On Python 2 the lines are UTF-8 encoded byte strings.
+    """
+    line = six.StringIO()
+    writer = csv.writer(line)
+    for row in itertools.chain([AUDIT_MANIFEST_FIELDS], (
+            [result[field] for field in AUDIT_MANIFEST_FIELDS] for result in results)):
+        writer.writerow([_csv_value(value) for value in row])
+        yield line.getvalue()
+        line.seek(0)
+        line.truncate()
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if six.PY2 and isinstance(value, six.text_type):
+        # the Python 2 csv module only writes byte strings
+        return value.encode('utf-8')
+    return value
+
+
+def iter_audit_json(results):
+    """Yield a JSON array manifest of ``audit_framework_documents`` results one result at a time"""
+    separator = '['
+    for result in results:
+        yield separator + json.dumps(result, sort_keys=True)
+        separator = ',\n'
+    yield '[]' if separator == '[' else ']'
+
+
 def sanitise_supplier_name(supplier_name):
     """Replace ampersands with 'and' and spaces with a single underscore."""
-    sanitised_supplier_name = supplier_name.encode("ascii", errors="ignore").decode("ascii").strip()
-    sanitised_supplier_name = sanitised_supplier_name.replace(' ', '_').replace('&', 'and')
-    for bad_char in BAD_SUPPLIER_NAME_CHARACTERS:
-        sanitised_supplier_name = sanitised_supplier_name.replace(bad_char, '')
-    while '__' in sanitised_supplier_name:
-        sanitised_supplier_name = sanitised_supplier_name.replace('__', '_')
-    return sanitised_supplier_name
+    sanitised_supplier_name = supplier_name.encode("ascii", errors="ignore").strip().replace(b'&', b'and')
+    sanitised_supplier_name = sanitised_supplier_name.translate(SUPPLIER_NAME_TRANSLATION,
+                                                                SUPPLIER_NAME_DELETED_CHARACTERS)
+    return UNDERSCORES_PATTERN.sub(b'_', sanitised_supplier_name).decode("ascii")
+
+
+def sanitise_supplier_names(supplier_names):
+    """Sanitise many supplier names, returning them as a list in the same order."""
+    return [sanitise_supplier_name(supplier_name) for supplier_name in supplier_names]
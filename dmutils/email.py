@@ -2,23 +2,43 @@ import base64
 from datetime import datetime, timedelta
 import hashlib
 import json
+import os
 import six
 from string import Template
 import struct
 import sys
 import textwrap
+import threading
 
 import boto3
 import botocore.exceptions
+from concurrent.futures import ThreadPoolExecutor
 from flask import current_app, flash
 from flask._compat import string_types
+from monotonic import monotonic
 
 from datetime import datetime
-from cryptography.fernet import Fernet, InvalidToken
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 
 from .formats import DATETIME_FORMAT
+from .outbox import Outbox, OutboxWorker, DEFAULT_DRAIN_INTERVAL
+from .retry import RetryPolicy, TokenBucket
 
 ONE_DAY_IN_SECONDS = 86400
+SEND_LATENCY_METRIC = 'email.send.latency'
+OUTBOX_DEPTH_METRIC = 'email.outbox.depth'
+OUTBOX_AGE_METRIC = 'email.outbox.age'
+BULK_EMAIL_MAX_WORKERS = 8
+SES_THROTTLING_ERROR_CODES = ('Throttling', 'ServiceUnavailable')
+
+_ses_clients_lock = threading.Lock()
+_ses_clients_pid = None
+_ses_clients = {}
+
+# the version byte and timestamp at the start of a Fernet token are the first 12 base64 characters
+FERNET_HEADER_LENGTH = 12
+_fernets_lock = threading.Lock()
+_fernets = {}
 
 
 class EmailError(Exception):
@@ -26,10 +46,27 @@ class EmailError(Exception):
 
 
 def send_email(to_email_addresses, email_body, subject, from_email, from_name, reply_to=None):
+    """Send an email through SES
+
+    If ``DM_SEND_EMAIL_TO_STDERR`` is set the email is written to stderr instead. Otherwise, if
+    ``DM_EMAIL_OUTBOX_DIR`` is set, the email is added to the outbox in that directory and sent
+    later by ``drain_email_outbox``, so SES errors are not raised.
+    """
     if isinstance(to_email_addresses, string_types):
         to_email_addresses = [to_email_addresses]
 
-    if current_app.config.get('DM_SEND_EMAIL_TO_STDERR', False):
+    if current_app.config.get('DM_EMAIL_OUTBOX_DIR') and not current_app.config.get('DM_SEND_EMAIL_TO_STDERR'):
+        message_id = Outbox(current_app.config['DM_EMAIL_OUTBOX_DIR']).put({
+            'to_email_addresses': to_email_addresses,
+            'email_body': email_body,
+            'subject': subject,
+            'from_email': from_email,
+            'from_name': from_name,
+            'reply_to': reply_to,
+        })
+        current_app.logger.info("Queued email: id={id}, email={email_hash}",
+                                extra={'id': message_id, 'email_hash': hash_email(to_email_addresses[0])})
+    elif current_app.config.get('DM_SEND_EMAIL_TO_STDERR', False):
         template = Template(textwrap.dedent("""\
             To: $to
             Subject: $subject
@@ -46,31 +83,7 @@ def send_email(to_email_addresses, email_body, subject, from_email, from_name, r
         ))
     else:
         try:
-            email_client = boto3.client('ses')
-
-            destination_addresses = {
-                'ToAddresses': to_email_addresses,
-            }
-            if 'DM_EMAIL_BCC_ADDRESS' in current_app.config:
-                destination_addresses['BccAddresses'] = [current_app.config['DM_EMAIL_BCC_ADDRESS']]
-
-            result = email_client.send_email(
-                Source=u"{} <{}>".format(from_name, from_email),
-                Destination=destination_addresses,
-                Message={
-                    'Subject': {
-                        'Data': subject,
-                        'Charset': 'UTF-8'
-                    },
-                    'Body': {
-                        'Html': {
-                            'Data': email_body,
-                            'Charset': 'UTF-8'
-                        }
-                    }
-                },
-                ReplyToAddresses=[reply_to or from_email],
-            )
+            result = _send_ses_email(to_email_addresses, email_body, subject, from_email, from_name, reply_to)
         except botocore.exceptions.ClientError as e:
             current_app.logger.error("An SES error occurred: {error}", extra={'error': e.response['Error']['Message']})
             raise EmailError(e.response['Error']['Message'])
@@ -80,25 +93,341 @@ def send_email(to_email_addresses, email_body, subject, from_email, from_name, r
                                        'email_hash': hash_email(to_email_addresses[0])})
 
 
+def send_bulk_email(messages, max_workers=BULK_EMAIL_MAX_WORKERS, max_send_rate=None, retry_policy=None):
+    """Send many emails concurrently within the SES sending rate limit
+
+    Each message goes to a single recipient, and messages to a recipient that has already been
+    sent a message in the batch are skipped. Messages are sent on up to ``max_workers`` threads,
+    which share a token bucket for the SES maximum send rate, and throttled messages are retried
+    with backoff. Failures are returned rather than raised. If the app uses ``dmutils.metrics``, the
+    send latency samples for the batch are published to CloudWatch once it has been sent.
+
+    :param messages:      iterable of dicts with ``to_email_address``, ``email_body``, ``subject``,
+                          ``from_email``, ``from_name`` and optionally ``reply_to``
+    :param max_workers:   maximum number of messages being sent at once
+    :param max_send_rate: recipients per second; defaults to the account's SES ``MaxSendRate``.
+                          The ``DM_EMAIL_BCC_ADDRESS`` copy of each message counts as a recipient.
+    :param retry_policy:  ``dmutils.retry.RetryPolicy`` for throttled messages
+
+    :return: list of dicts with ``email_hash``, ``status`` (``'sent'``, ``'duplicate'`` or
+             ``'failed'``), ``id`` (the SES request id) and ``error`` (``None`` or an ``EmailError``),
+             in the same order as ``messages``
+    """
+    messages = list(messages)
+    results = [
+        {'email_hash': hash_email(message['to_email_address']), 'status': 'duplicate', 'id': None, 'error': None}
+        for message in messages
+    ]
+    seen = set()
+    to_send = []
+    for message, result in zip(messages, results):
+        recipient = message['to_email_address'].strip().lower()
+        if recipient not in seen:
+            seen.add(recipient)
+            to_send.append((message, result))
+
+    if current_app.config.get('DM_SEND_EMAIL_TO_STDERR', False):
+        for message, result in to_send:
+            send_email(message['to_email_address'], message['email_body'], message['subject'],
+                       message['from_email'], message['from_name'], message.get('reply_to'))
+            result['status'] = 'sent'
+        return results
+
+    if max_send_rate is None:
+        max_send_rate = get_ses_client(current_app.config.get('DM_SES_REGION')).get_send_quota()['MaxSendRate']
+    recipients_per_message = 2 if 'DM_EMAIL_BCC_ADDRESS' in current_app.config else 1
+    # each message takes all of its recipients' tokens at once, so the bucket must hold that many
+    rate_limiter = TokenBucket(max_send_rate, capacity=max(recipients_per_message, max_send_rate))
+    retry_policy = retry_policy or RetryPolicy(is_throttling_error, base_delay=0.5)
+    app = current_app._get_current_object()
+
+    def send(item):
+        message, result = item
+
+        def attempt():
+            rate_limiter.acquire(recipients_per_message)
+            return _send_ses_email([message['to_email_address']], message['email_body'], message['subject'],
+                                   message['from_email'], message['from_name'], message.get('reply_to'))
+
+        with app.app_context():
+            try:
+                response = retry_policy.call(attempt)
+            except Exception as e:
+                # connection and parameter errors are recorded like SES errors, so one recipient's
+                # failure does not lose the results of the rest of the batch
+                if isinstance(e, botocore.exceptions.ClientError):
+                    message = e.response['Error']['Message']
+                else:
+                    message = str(e)
+                app.logger.error("An SES error occurred sending to {email_hash}: {error}",
+                                 extra={'email_hash': result['email_hash'], 'error': message})
+                result['status'] = 'failed'
+                result['error'] = EmailError(message)
+            else:
+                result['status'] = 'sent'
+                result['id'] = response['ResponseMetadata']['RequestId']
+                app.logger.info("Sent email: id={id}, email={email_hash}",
+                                extra={'id': result['id'], 'email_hash': result['email_hash']})
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(send, to_send))
+    _flush_metrics()
+
+    current_app.logger.info(
+        "Sent {sentcount} of {count} bulk emails ({failedcount} failed, {duplicatecount} duplicates)",
+        extra={
+            "count": len(results),
+            "sentcount": sum(1 for result in results if result['status'] == 'sent'),
+            "failedcount": sum(1 for result in results if result['status'] == 'failed'),
+            "duplicatecount": len(results) - len(to_send),
+        })
+
+    return results
+
+
+def drain_email_outbox(app=None):
+    """Send the emails that are due in the ``DM_EMAIL_OUTBOX_DIR`` outbox
+
+    Throttled and undelivered emails are retried later, and emails SES rejects are moved to
+    the outbox's ``failed`` directory. The outbox depth and the age of its oldest email are
+    recorded through dmutils metrics if the app has set them up.
+
+    :param app: Flask app to use instead of ``current_app``
+    :return: dict with the number of emails ``sent``, ``retried`` and ``failed``
+    """
+    app = app or current_app._get_current_object()
+    with app.app_context():
+        outbox = Outbox(app.config['DM_EMAIL_OUTBOX_DIR'])
+
+        def send(message):
+            result = _send_ses_email(**message)
+            app.logger.info("Sent email: id={id}, email={email_hash}",
+                            extra={'id': result['ResponseMetadata']['RequestId'],
+                                   'email_hash': hash_email(message['to_email_addresses'][0])})
+
+        counts = outbox.drain(send, is_retryable_send_error)
+
+        if app.extensions.get('dm_metrics') is not None:
+            stats = outbox.stats()
+            _put_metric(OUTBOX_DEPTH_METRIC, stats['depth'], "Count")
+            _put_metric(OUTBOX_AGE_METRIC, stats['age'], "Seconds")
+
+    return counts
+
+
+def start_email_outbox_worker(app, interval=DEFAULT_DRAIN_INTERVAL):
+    """Start a daemon thread running ``drain_email_outbox`` every ``interval`` seconds
+
+    :return: the started ``dmutils.outbox.OutboxWorker``, which can be stopped with ``stop()``
+    """
+    worker = OutboxWorker(lambda: drain_email_outbox(app), interval)
+    worker.start()
+    return worker
+
+
+def is_retryable_send_error(e):
+    # connection errors and throttling may clear up; SES rejecting a message will not
+    return not isinstance(e, botocore.exceptions.ClientError) or is_throttling_error(e)
+
+
+def is_throttling_error(e):
+    if not isinstance(e, botocore.exceptions.ClientError):
+        return False
+    error = e.response.get('Error', {})
+    # a spent daily quota is also reported as Throttling, but will not clear with a retry
+    return error.get('Code') in SES_THROTTLING_ERROR_CODES and 'quota' not in error.get('Message', '').lower()
+
+
+def _send_ses_email(to_email_addresses, email_body, subject, from_email, from_name, reply_to=None):
+    email_client = get_ses_client(current_app.config.get('DM_SES_REGION'))
+
+    destination_addresses = {
+        'ToAddresses': to_email_addresses,
+    }
+    if 'DM_EMAIL_BCC_ADDRESS' in current_app.config:
+        destination_addresses['BccAddresses'] = [current_app.config['DM_EMAIL_BCC_ADDRESS']]
+
+    start = monotonic()
+    response = email_client.send_email(
+        Source=u"{} <{}>".format(from_name, from_email),
+        Destination=destination_addresses,
+        Message={
+            'Subject': {
+                'Data': subject,
+                'Charset': 'UTF-8'
+            },
+            'Body': {
+                'Html': {
+                    'Data': email_body,
+                    'Charset': 'UTF-8'
+                }
+            }
+        },
+        ReplyToAddresses=[reply_to or from_email],
+    )
+    # buffered rather than sent to CloudWatch here, so recording it cannot slow down or fail a send;
+    # the shared metrics client publishes the samples in the background
+    metrics_client = _get_metrics_client()
+    if metrics_client is not None:
+        metrics_client.buffer(SEND_LATENCY_METRIC, "Milliseconds").add(int((monotonic() - start) * 1000))
+    return response
+
+
+def get_ses_client(region_name=None, aws_access_key_id=None, aws_secret_access_key=None, aws_session_token=None):
+    """Return the process-wide boto3 SES client for a region and set of credentials
+
+    Creating a boto3 client loads the service model and sets up a connection pool, so clients
+    are created once and shared by all threads, which boto3 clients support. A forked child
+    process creates its own clients rather than sharing connections with its parent.
+    Arguments left as ``None`` use boto3's defaults.
+    """
+    global _ses_clients_pid
+    client_args = dict(
+        (name, value) for name, value in (
+            ('region_name', region_name),
+            ('aws_access_key_id', aws_access_key_id),
+            ('aws_secret_access_key', aws_secret_access_key),
+            ('aws_session_token', aws_session_token),
+        ) if value is not None
+    )
+    cache_key = tuple(sorted(client_args.items()))
+    with _ses_clients_lock:
+        if _ses_clients_pid != os.getpid():
+            _ses_clients.clear()
+            _ses_clients_pid = os.getpid()
+        if cache_key not in _ses_clients:
+            _ses_clients[cache_key] = boto3.client('ses', **client_args)
+        return _ses_clients[cache_key]
+
+
+def reset_ses_clients():
+    """Discard all shared SES clients"""
+    with _ses_clients_lock:
+        _ses_clients.clear()
+
+
+def _get_metrics_client():
+    # only if the app has set up dmutils.metrics
+    metrics = current_app.extensions.get('dm_metrics')
+    return metrics.client if metrics is not None else None
+
+
+def _put_metric(name, value, unit):
+    # best effort
+    metrics_client = _get_metrics_client()
+    if metrics_client is None:
+        return
+    try:
+        metrics_client.gauge(name, value, unit=unit)
+    except Exception as e:
+        current_app.logger.warning("Failed to record {metric} metric: {error}", extra={'metric': name, 'error': e})
+
+
+def _flush_metrics():
+    # best effort
+    metrics_client = _get_metrics_client()
+    if metrics_client is None:
+        return
+    try:
+        metrics_client.flush()
+    except Exception as e:
+        current_app.logger.warning("Failed to publish metrics: {error}", extra={'error': e})
+
+
+def get_fernet(secret_key):
+    """Return a cached ``Fernet`` for a key, or a ``MultiFernet`` for a list of keys
+
+    Tokens are encrypted with the first key in a list and can be decrypted with any of them,
+    tried in order, so keys can be rotated by adding the new key to the front of the list.
+
+    ``SHARED_EMAIL_KEY`` can be set to a list of keys. ``SECRET_KEY`` must stay a string, as
+    Flask sessions and CSRF tokens use it too, so password reset tokens are decoded with the
+    ``SECRET_KEYS`` list when it is set, and ``SECRET_KEY`` otherwise.
+    """
+    if not isinstance(secret_key, (six.string_types, six.binary_type)):
+        secret_key = tuple(secret_key)
+    fernet = _fernets.get(secret_key)
+    if fernet is None:
+        with _fernets_lock:
+            fernet = _fernets.get(secret_key)
+            if fernet is None:
+                if isinstance(secret_key, tuple):
+                    fernets = [Fernet(key) for key in secret_key]
+                    fernet = fernets[0] if len(fernets) == 1 else MultiFernet(fernets)
+                else:
+                    fernet = Fernet(secret_key)
+                _fernets[secret_key] = fernet
+
+    return fernet
+
+
 def generate_token(data, secret_key, salt):
     """
     Matches the itsdangerous functionality, but with encryption (using Fernet).
 
     The "salt" isn't a cryptographic salt.  Use a different salt for different handlers to avoid replay attacks
     (e.g., a token created for /create-buyer-user being sent by an attacker to /give-user-admin-rights)
+
+    ``secret_key`` can be a list of keys, in which case the first is used (see ``get_fernet``).
     """
     json_data = json.dumps(data)
-    fernet = Fernet(secret_key)
-    return fernet.encrypt(b'{}\0{}'.format(salt, json_data))
+    return get_fernet(secret_key).encrypt(b'{}\0{}'.format(salt, json_data))
 
 
 def decode_token(token, secret_key, salt, max_age_in_seconds=ONE_DAY_IN_SECONDS):
-    fernet = Fernet(secret_key)
-    cleartext = fernet.decrypt(token, ttl=max_age_in_seconds)
+    return decode_token_with_timestamp(token, secret_key, salt, max_age_in_seconds)[0]
+
+
+def decode_token_with_timestamp(token, secret_key, salt, max_age_in_seconds=ONE_DAY_IN_SECONDS):
+    """Decrypt a token made by ``generate_token``, returning its data and the datetime it was made
+
+    :raises InvalidToken: if the token is invalid, has expired or has a different salt
+    """
+    cleartext = get_fernet(secret_key).decrypt(token, ttl=max_age_in_seconds)
     token_salt, json_data = cleartext.split(b'\0', 1)
     if token_salt != salt:
         raise InvalidToken
-    return json.loads(json_data)
+    # the timestamp has been verified by decrypt, so only the token header needs decoding
+    return json.loads(json_data), parse_fernet_timestamp(token[:FERNET_HEADER_LENGTH])
+
+
+def generate_tokens(payloads, secret_key, salt):
+    """Generate a token for each of a list of payloads, as ``generate_token`` does
+
+    The key is set up once for the whole batch.
+
+    :return: list of ``{'token', 'error'}`` dicts in the order of ``payloads``, where ``error``
+             is the exception raised for a payload that could not be encoded
+    """
+    fernet = get_fernet(secret_key)
+    prefix = b'{}\0'.format(salt)
+    results = []
+    for payload in payloads:
+        try:
+            results.append({'token': fernet.encrypt(prefix + json.dumps(payload)), 'error': None})
+        except Exception as e:
+            results.append({'token': None, 'error': e})
+
+    return results
+
+
+def decode_tokens(tokens, secret_key, salt, max_age_in_seconds=ONE_DAY_IN_SECONDS):
+    """Decode each of a list of tokens, as ``decode_token_with_timestamp`` does
+
+    Invalid tokens do not stop the rest of the batch being decoded.
+
+    :return: list of ``{'data', 'timestamp', 'error'}`` dicts in the order of ``tokens``, where
+             ``error`` is the exception raised for a token that could not be decoded
+    """
+    results = []
+    for token in tokens:
+        try:
+            data, timestamp = decode_token_with_timestamp(token, secret_key, salt, max_age_in_seconds)
+            results.append({'data': data, 'timestamp': timestamp, 'error': None})
+        except Exception as e:
+            results.append({'data': None, 'timestamp': None, 'error': e})
+
+    return results
 
 
 def hash_email(email):
@@ -127,13 +456,12 @@ def parse_fernet_timestamp(ciphertext):
 
 def decode_password_reset_token(token, data_api_client):
     try:
-        decoded = decode_token(
+        decoded, timestamp = decode_token_with_timestamp(
             token,
-            current_app.config["SECRET_KEY"],
+            current_app.config.get("SECRET_KEYS") or current_app.config["SECRET_KEY"],
             current_app.config["RESET_PASSWORD_SALT"],
             ONE_DAY_IN_SECONDS
         )
-        timestamp = parse_fernet_timestamp(token)
     except InvalidToken:
         current_app.logger.info('Invalid password reset token {}'.format(token))
         return {'error': 'token_invalid'}
@@ -0,0 +1,29 @@
+import contextlib
+import os
+import tempfile
+
+
+TMP_PREFIX = '.tmp-'
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='wb', fsync=False):
+    """Write a file via a temporary file in the same directory that is renamed into place
+
+    Readers, including other processes, see either the old file or the complete new one.
+    Temporary files start with ``TMP_PREFIX`` so directory scans can skip them.
+
+    :param fsync: flush the file to disk before renaming it, so that the new contents also
+                  survive a power failure or operating system crash
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=TMP_PREFIX)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
@@ -1,6 +1,6 @@
 import os
 from flask_featureflags.contrib.inline import InlineFeatureFlag
-from . import config, logging, proxy_fix, request_id, formats, filters
+from . import config, content_length, logging, proxy_fix, request_id, formats, filters
 from flask import Markup, redirect, request, session
 from flask.ext.script import Manager, Server
 from flask_login import current_user
@@ -30,6 +30,8 @@ def init_app(
     logging.init_app(application)
     proxy_fix.init_app(application)
     request_id.init_app(application)
+    # outermost, so oversized requests are rejected before any other middleware needs a request context
+    content_length.init_app(application)
 
     if bootstrap:
         bootstrap.init_app(application)
@@ -175,6 +177,13 @@ def init_manager(application, port, extra_directories=()):
         from waitress import serve
         serve(application, port=port)
 
+    @manager.command
+    def drain_email_outbox():
+        """Send the emails waiting in the DM_EMAIL_OUTBOX_DIR outbox."""
+        from .email import drain_email_outbox
+        counts = drain_email_outbox(application)
+        print("Sent {sent}, will retry {retried}, failed {failed}".format(**counts))
+
     @manager.command
     def list_routes():
         """List URLs of all application routes."""
@@ -2,6 +2,8 @@ from __future__ import absolute_import
 import logging
 import sys
 import re
+import threading
+from contextlib import contextmanager
 from itertools import product
 
 from flask import request, current_app
@@ -15,6 +17,8 @@ TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
 logger = logging.getLogger(__name__)
 
+_thread_request_id = threading.local()
+
 
 def init_app(app):
     app.config.setdefault('DM_LOG_LEVEL', 'INFO')
@@ -87,13 +91,24 @@ class AppNameFilter(logging.Filter):
         return record
 
 
+@contextmanager
+def request_id_context(request_id):
+    """Log with ``request_id`` in this thread outside a request context, e.g. in a request's worker threads"""
+    previous = getattr(_thread_request_id, 'value', None)
+    _thread_request_id.value = request_id
+    try:
+        yield
+    finally:
+        _thread_request_id.value = previous
+
+
 class RequestIdFilter(logging.Filter):
     @property
     def request_id(self):
         if has_request_context() and hasattr(request, 'request_id'):
             return request.request_id
         else:
-            return 'no-request-id'
+            return getattr(_thread_request_id, 'value', None) or 'no-request-id'
 
     def filter(self, record):
         record.request_id = self.request_id
@@ -1,5 +1,10 @@
+from __future__ import absolute_import
+
 import copy
 from datetime import datetime
+import logging
+import os
+import threading
 
 from boto.ec2.cloudwatch import connect_to_region
 from flask import current_app, _app_ctx_stack as stack
@@ -7,6 +12,16 @@ from contextlib2 import ContextDecorator
 from monotonic import monotonic
 
 
+DEFAULT_FLUSH_INTERVAL = 60
+
+logger = logging.getLogger(__name__)
+
+_shared_clients = {}
+_shared_clients_lock = threading.Lock()
+_shared_clients_pid = None
+_flusher = None
+
+
 def flask_client():
     return CloudWatchFlaskClient()
 
@@ -21,23 +36,58 @@ class CloudWatchFlaskClient(object):
         }
         dimensions.update(c.get('DM_METRICS_DIMENSIONS', dict()))
         c['DM_METRICS_DIMENSIONS'] = dimensions
+        app.extensions['dm_metrics'] = self
 
     @property
     def client(self):
         ctx = stack.top
         if ctx is not None:
-            if not hasattr(ctx, 'dmutils_metrics_client'):
-                ctx.dmutils_metrics_client = client(
-                    current_app.config['DM_METRICS_REGION'],
-                    current_app.config['DM_METRICS_NAMESPACE'],
-                    current_app.config['DM_METRICS_DIMENSIONS'])
-            return ctx.dmutils_metrics_client
+            return shared_client(
+                current_app.config['DM_METRICS_REGION'],
+                current_app.config['DM_METRICS_NAMESPACE'],
+                current_app.config['DM_METRICS_DIMENSIONS'])
 
 
 def client(region, namespace, default_dimensions=None):
     return CloudWatchClient(region, namespace, default_dimensions)
 
 
+def shared_client(region, namespace, default_dimensions=None):
+    """Return the process-wide client for a region, namespace and set of default dimensions
+
+    Shared clients reuse one CloudWatch connection for every app context, and their metric buffers
+    are flushed by a daemon thread every ``DEFAULT_FLUSH_INTERVAL`` seconds. A forked child process
+    creates its own clients and thread.
+    """
+    global _shared_clients_pid, _flusher
+    cache_key = (region, namespace, tuple(sorted((default_dimensions or {}).items())))
+    with _shared_clients_lock:
+        if _shared_clients_pid != os.getpid():
+            _shared_clients.clear()
+            _shared_clients_pid = os.getpid()
+            _flusher = None
+        if cache_key not in _shared_clients:
+            _shared_clients[cache_key] = client(region, namespace, default_dimensions)
+        if _flusher is None:
+            _flusher = MetricsFlusher(flush_shared_clients)
+            _flusher.start()
+        return _shared_clients[cache_key]
+
+
+def flush_shared_clients():
+    """Publish the buffered metrics of all shared clients"""
+    with _shared_clients_lock:
+        clients = list(_shared_clients.values())
+    for metrics_client in clients:
+        metrics_client.flush()
+
+
+def reset_shared_clients():
+    """Discard all shared clients, without flushing them"""
+    with _shared_clients_lock:
+        _shared_clients.clear()
+
+
 class CloudWatchClient(object):
     def __init__(self, region, namespace, default_dimensions=None):
         self._conn = connect_to_region(region)
@@ -45,6 +95,8 @@ class CloudWatchClient(object):
         if default_dimensions is None:
             default_dimensions = dict()
         self.default_dimensions = default_dimensions
+        self._buffers = {}
+        self._buffers_lock = threading.Lock()
 
     def dimensions(self, dimensions):
         _dimensions = copy.copy(self.default_dimensions)
@@ -68,6 +120,74 @@ class CloudWatchClient(object):
     def timer(self, name):
         return Timer(self, name)
 
+    def gauge(self, name, value, unit="Count"):
+        self._put_metric(name, value, unit=unit)
+
+    def buffer(self, name, unit=None):
+        """Return the buffer for samples of a metric, which are published when the client is flushed"""
+        with self._buffers_lock:
+            if (name, unit) not in self._buffers:
+                self._buffers[(name, unit)] = MetricBuffer(self, name, unit)
+            return self._buffers[(name, unit)]
+
+    def flush(self):
+        """Publish the samples in all of the client's buffers, one statistic set per metric"""
+        with self._buffers_lock:
+            buffers = list(self._buffers.values())
+        for metric_buffer in buffers:
+            metric_buffer.flush()
+
+
+class MetricBuffer(object):
+    """Samples of a metric, kept as a CloudWatch statistic set until flushed
+
+    Adding a sample does not call CloudWatch, so it can be done for every request or email sent;
+    flushing publishes all of the samples since the last flush with a single call.
+    """
+
+    def __init__(self, client, name, unit=None):
+        self.client = client
+        self.name = name
+        self.unit = unit
+        self._statistics = None
+        self._lock = threading.Lock()
+
+    def add(self, value):
+        with self._lock:
+            if self._statistics is None:
+                self._statistics = {'samplecount': 0, 'sum': 0, 'minimum': value, 'maximum': value}
+            self._statistics['samplecount'] += 1
+            self._statistics['sum'] += value
+            self._statistics['minimum'] = min(self._statistics['minimum'], value)
+            self._statistics['maximum'] = max(self._statistics['maximum'], value)
+
+    def flush(self):
+        with self._lock:
+            statistics, self._statistics = self._statistics, None
+        if statistics is not None:
+            self.client._put_metric(self.name, unit=self.unit, statistics=statistics)
+
+
+class MetricsFlusher(threading.Thread):
+    """Daemon thread calling ``flush`` every ``interval`` seconds until stopped"""
+
+    def __init__(self, flush, interval=DEFAULT_FLUSH_INTERVAL):
+        super(MetricsFlusher, self).__init__(name='metrics-flusher')
+        self.daemon = True
+        self.flush = flush
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Metrics flush failed: {error}", extra={"error": e})
+
+    def stop(self):
+        self._stopped.set()
+
 
 class Timer(ContextDecorator):
     def __init__(self, client, name):
@@ -0,0 +1,215 @@
+from __future__ import absolute_import
+import errno
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from .files import TMP_PREFIX, atomic_write
+from .retry import RetryPolicy
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_DRAIN_INTERVAL = 5  # seconds between drains of the outbox by an OutboxWorker
+DEFAULT_CLAIM_TIMEOUT = 3600  # seconds after which a claimed message is assumed abandoned
+
+_process_token_lock = threading.Lock()
+_process_token = None
+
+
+class Outbox(object):
+    """Durable local spool of messages waiting to be sent
+
+    ``put`` writes each message to its own file in ``pending/`` and returns without sending
+    it. ``drain`` sends the messages that are due, oldest first. Each message is claimed by
+    renaming it into ``sending/`` so that several processes can drain the same outbox, and it
+    is only removed once it has been sent. Claims are named with a token unique to the claiming
+    process, so that claims left by a process that died before finishing are returned to
+    ``pending/`` by the next drain, even when a restarted process reuses its pid. Claims older
+    than ``claim_timeout`` are returned too. A crash can at worst cause a message to be sent
+    twice but never lost.
+
+    Failed messages are retried with backoff. They are moved to ``failed/`` when they cannot
+    be retried or have been tried ``max_attempts`` times.
+
+    :param directory:    outbox directory, created if it does not exist
+    :param max_attempts: maximum number of attempts to send each message
+    :param retry_policy: ``dmutils.retry.RetryPolicy`` whose ``backoff`` spaces out the attempts
+    :param claim_timeout: seconds after which a message claimed by another process is assumed
+                          to have been abandoned
+    """
+
+    def __init__(self, directory, max_attempts=DEFAULT_MAX_ATTEMPTS, retry_policy=None,
+                 claim_timeout=DEFAULT_CLAIM_TIMEOUT):
+        self.directory = directory
+        self.max_attempts = max_attempts
+        self.claim_timeout = claim_timeout
+        self.retry_policy = retry_policy or RetryPolicy(None, base_delay=5, max_delay=600)
+        self.pending_dir = os.path.join(directory, 'pending')
+        self.sending_dir = os.path.join(directory, 'sending')
+        self.failed_dir = os.path.join(directory, 'failed')
+        for path in (self.pending_dir, self.sending_dir, self.failed_dir):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+    def put(self, message):
+        """Add a JSON-serialisable message to the outbox
+
+        :return: message id
+        """
+        now = time.time()
+        # ids sort in the order messages were added
+        message_id = '{:016d}-{}'.format(int(now * 1000000), uuid.uuid4().hex)
+        record = {'id': message_id, 'message': message, 'attempts': 0, 'not_before': now}
+        with atomic_write(os.path.join(self.pending_dir, message_id), 'w', fsync=True) as f:
+            json.dump(record, f)
+
+        return message_id
+
+    def drain(self, send, is_retryable=lambda e: True):
+        """Send the messages that are due, oldest first
+
+        :param send:         function of a message that sends it, raising an exception on failure
+        :param is_retryable: function of an exception returning whether the message should be retried
+
+        :return: dict with the number of messages ``sent``, ``retried`` and ``failed``
+        """
+        self.recover()
+        counts = {'sent': 0, 'retried': 0, 'failed': 0}
+        for message_id in sorted(_list(self.pending_dir)):
+            record = self._load(os.path.join(self.pending_dir, message_id))
+            if record is None or record['not_before'] > time.time():
+                continue
+            claimed_path = self._claim(message_id)
+            if claimed_path is None:
+                continue  # claimed by another process
+
+            try:
+                send(record['message'])
+            except Exception as e:
+                record['attempts'] += 1
+                record['error'] = str(e)
+                if record['attempts'] >= self.max_attempts or not is_retryable(e):
+                    self._write(os.path.join(self.failed_dir, message_id), record)
+                    counts['failed'] += 1
+                    logger.error("Failed to send outbox message {messageid}: {error}",
+                                 extra={"messageid": message_id, "error": e})
+                else:
+                    record['not_before'] = time.time() + self.retry_policy.backoff(record['attempts'])
+                    self._write(os.path.join(self.pending_dir, message_id), record)
+                    counts['retried'] += 1
+                    logger.warning("Will retry outbox message {messageid}: {error}",
+                                   extra={"messageid": message_id, "error": e})
+            else:
+                counts['sent'] += 1
+            os.remove(claimed_path)
+
+        return counts
+
+    def recover(self):
+        """Return messages claimed by processes that no longer exist, or too long ago, to ``pending/``"""
+        process_token = _get_process_token()
+        for name in _list(self.sending_dir):
+            message_id, _, owner = name.rpartition('.')
+            if owner == process_token:
+                continue  # being sent by this process
+            if not self._is_abandoned(os.path.join(self.sending_dir, name), int(owner.split('-', 1)[0])):
+                continue
+            try:
+                os.rename(os.path.join(self.sending_dir, name), os.path.join(self.pending_dir, message_id))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                logger.warning("Recovered outbox message {messageid}", extra={"messageid": message_id})
+
+    def stats(self):
+        """Return the number of messages waiting to be sent and the age in seconds of the oldest"""
+        message_ids = _list(self.pending_dir) + [name.rpartition('.')[0] for name in _list(self.sending_dir)]
+        oldest = min(message_ids) if message_ids else None
+        return {
+            'depth': len(message_ids),
+            'age': time.time() - int(oldest.split('-', 1)[0]) / 1000000.0 if oldest else 0,
+        }
+
+    def _claim(self, message_id):
+        claimed_path = os.path.join(self.sending_dir, '{}.{}'.format(message_id, _get_process_token()))
+        try:
+            os.rename(os.path.join(self.pending_dir, message_id), claimed_path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        # the modification time records when the claim was made, for claim_timeout
+        os.utime(claimed_path, None)
+        return claimed_path
+
+    def _is_abandoned(self, claimed_path, pid):
+        if pid == os.getpid():
+            return True  # claimed by an earlier process with the same pid
+        if not _process_exists(pid):
+            return True
+        try:
+            return time.time() - os.path.getmtime(claimed_path) > self.claim_timeout
+        except OSError:
+            return False  # finished since it was listed
+
+    def _load(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return None  # sent or claimed by another process since it was listed
+
+    def _write(self, path, record):
+        with atomic_write(path, 'w', fsync=True) as f:
+            json.dump(record, f)
+
+
+class OutboxWorker(threading.Thread):
+    """Daemon thread calling ``drain`` every ``interval`` seconds until stopped"""
+
+    def __init__(self, drain, interval=DEFAULT_DRAIN_INTERVAL):
+        super(OutboxWorker, self).__init__(name='outbox-worker')
+        self.daemon = True
+        self.drain = drain
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.drain()
+            except Exception as e:
+                logger.error("Outbox drain failed: {error}", extra={"error": e})
+
+    def stop(self):
+        self._stopped.set()
+
+
+def _get_process_token():
+    # pid plus a random part, as a pid can be reused by the next process, e.g. after a container restart
+    global _process_token
+    with _process_token_lock:
+        if _process_token is None or int(_process_token.split('-', 1)[0]) != os.getpid():
+            _process_token = '{}-{}'.format(os.getpid(), uuid.uuid4().hex)
+        return _process_token
+
+
+def _list(directory):
+    return [name for name in os.listdir(directory) if not name.startswith(TMP_PREFIX)]
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
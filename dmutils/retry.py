@@ -0,0 +1,141 @@
+import random
+import threading
+import time
+
+from monotonic import monotonic
+
+
+class RetryBudget(object):
+    """Limits retries to a fraction of successful calls, shared by all calls using it
+
+    Each retry withdraws a token and each success deposits ``ratio`` tokens, so
+    when a service is failing most requests, retries stop adding to its load.
+    """
+
+    def __init__(self, ratio=0.1, initial_tokens=10, max_tokens=100):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = initial_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class RetryPolicy(object):
+    """Retry failed calls with exponential backoff and full jitter
+
+    :param is_retryable:  function of an exception returning whether the call should be retried
+    :param max_attempts:  maximum number of attempts, including the first
+    :param base_delay:    upper bound in seconds of the first backoff, doubled on each attempt
+    :param max_delay:     upper bound in seconds of any backoff
+    :param budget:        ``RetryBudget`` shared with other calls; a new one is used if not given
+    """
+
+    def __init__(self, is_retryable, max_attempts=5, base_delay=0.1, max_delay=5, budget=None):
+        self.is_retryable = is_retryable
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+
+    def call(self, fn, *args, **kwargs):
+        attempt = 1
+        while True:
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_attempts or not self.is_retryable(e) or not self.budget.withdraw():
+                    raise
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+            else:
+                self.budget.deposit()
+                return result
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class AdaptiveConcurrencyLimiter(object):
+    """Additive-increase/multiplicative-decrease limit on concurrent calls
+
+    Use as a context manager around each call. The limit grows by about one
+    for each ``limit`` successes and is multiplied by ``decrease_factor``
+    when a call is throttled, at most once per ``decrease_interval`` seconds,
+    so a burst of throttled responses to calls that were already in flight
+    counts as a single signal.
+    """
+
+    def __init__(self, initial_limit=8, min_limit=1, max_limit=64, decrease_factor=0.5, decrease_interval=1.0):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.decrease_interval = decrease_interval
+        self.in_flight = 0
+        self._last_decrease = None
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        with self._condition:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def on_throttle(self):
+        with self._condition:
+            now = monotonic()
+            if self._last_decrease is not None and now - self._last_decrease < self.decrease_interval:
+                return
+            self._last_decrease = now
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+
+
+class TokenBucket(object):
+    """Limits the rate of calls made by all threads using it
+
+    Tokens are added at ``rate`` per second, up to ``capacity``, and ``acquire`` waits until
+    enough tokens are available and takes them. The bucket starts full, so up to ``capacity``
+    tokens can be taken at once, and ``acquire`` raises ``ValueError`` for more than that.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1, rate))
+        self.tokens = self.capacity
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        if tokens > self.capacity:
+            # the bucket never holds enough to satisfy this, so waiting would never end
+            raise ValueError("Cannot acquire {} tokens from a bucket with capacity {}".format(tokens, self.capacity))
+        while True:
+            with self._lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
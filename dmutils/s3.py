@@ -1,31 +1,108 @@
 from __future__ import absolute_import
 import os
 import re
+import socket
 import boto
 import boto.exception
 import datetime
+import heapq
 import mimetypes
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dateutil import tz
 from dateutil.parser import parse as parse_time
+from monotonic import monotonic
 
 from boto.exception import S3ResponseError  # noqa
+from boto.utils import compute_md5
+import six
+from six.moves import http_client
 
 from .formats import DATETIME_FORMAT
+from .retry import AdaptiveConcurrencyLimiter, RetryPolicy
 
 logger = logging.getLogger(__name__)
 
 FILE_SIZE_LIMIT = 5400000  # approximately 5Mb
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_CHUNK_SIZE = 64 * 1024
+MULTI_DELETE_LIMIT = 1000  # keys per S3 multi-object delete request
+RETRYABLE_ERROR_CODES = ('SlowDown', 'RequestTimeout', 'InternalError', 'ServiceUnavailable')
+# S3 listing timestamps (2015-08-17T14:00:00.000Z) and DATETIME_FORMAT (2015-08-17T14:00:00.000000Z)
+TIMESTAMP_PATTERN = re.compile(r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?Z$')
+MD5_HEXDIGEST_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+# the credentials boto.connect_s3 uses when none are passed to it
+CREDENTIALS_ENVIRONMENT_VARIABLES = ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN')
 BUCKET_SHORT_NAME_PATTERN = re.compile(
     r'^digitalmarketplace-([^\-]+)-([^\-]+)-(\2)$'
 )
 
 
-class S3(object):
-    def __init__(self, bucket_name=None, host='s3-eu-west-1.amazonaws.com'):
-        conn = boto.connect_s3(host=host)
+_registry_lock = threading.Lock()
+_registry_pid = None
+_connections = {}
+_buckets = {}
+_validated_buckets = set()
+
+
+def is_retryable_error(e):
+    if isinstance(e, S3ResponseError):
+        return (e.status or 0) >= 500 or e.error_code in RETRYABLE_ERROR_CODES
+    return isinstance(e, (socket.error, http_client.HTTPException))
+
+
+def is_throttling_error(e):
+    return isinstance(e, S3ResponseError) and (e.status == 503 or e.error_code == 'SlowDown')
+
+
+# shared by all S3 instances in a process, so the retry budget and the concurrency
+# limit reflect the overall load on S3 rather than that of a single caller
+DEFAULT_RETRY_POLICY = RetryPolicy(is_retryable_error)
+DEFAULT_CONCURRENCY_LIMITER = AdaptiveConcurrencyLimiter()
+
 
+class S3(object):
+    retry_policy = DEFAULT_RETRY_POLICY
+    concurrency_limiter = DEFAULT_CONCURRENCY_LIMITER
+    host = None
+    _bucket = None
+    _bucket_pid = None
+
+    def __init__(self, bucket_name=None, host='s3-eu-west-1.amazonaws.com', index=None, validate=False,
+                 retry_policy=None, concurrency_limiter=None):
+        """
+        :param bucket_name: name of the S3 bucket
+        :param host:        S3 endpoint host
+        :param index:       optional ``dmutils.s3_index.S3Index`` kept up to date by ``save`` and ``delete_key``
+        :param validate:    check the bucket exists. This makes a request the first time a bucket is
+                            used in a process only. Defaults to ``False``, so unlike earlier versions a
+                            missing or inaccessible bucket raises ``S3ResponseError`` on its first
+                            operation rather than when the ``S3`` instance is created.
+        :param retry_policy:        ``dmutils.retry.RetryPolicy`` for S3 requests
+        :param concurrency_limiter: ``dmutils.retry.AdaptiveConcurrencyLimiter`` for parallel operations
+        """
         self.bucket_name = bucket_name
-        self.bucket = conn.get_bucket(bucket_name)
+        self.host = host
+        self.bucket = get_bucket(bucket_name, host, validate)
+        self.index = index
+        if retry_policy is not None:
+            self.retry_policy = retry_policy
+        if concurrency_limiter is not None:
+            self.concurrency_limiter = concurrency_limiter
+
+    @property
+    def bucket(self):
+        # an instance created before a fork gets the child process's own bucket and connection,
+        # rather than sharing the parent's sockets
+        if self.host is not None and self._bucket_pid != os.getpid():
+            self.bucket = get_bucket(self.bucket_name, self.host)
+        return self._bucket
+
+    @bucket.setter
+    def bucket(self, bucket):
+        self._bucket = bucket
+        self._bucket_pid = os.getpid()
 
     @property
     def bucket_short_name(self):
@@ -36,7 +113,8 @@ class S3(object):
 
         return match.group(1)
 
-    def save(self, path, file, acl='public-read', move_prefix=None, timestamp=None, download_filename=None):
+    def save(self, path, file, acl='public-read', move_prefix=None, timestamp=None, download_filename=None,
+             skip_unchanged=False, md5=None):
         """Save a file in an S3 bucket
 
         canned ACL list: https://docs.aws.amazon.com/AmazonS3/latest/dev/acl-overview.html#canned-acl
@@ -46,25 +124,55 @@ class S3(object):
         :param acl:         S3 canned ACL
         :param move_prefix: Prefix to give to existing file when moving it out of the way
         :param timestamp:   Timestamp to set for this file rather than using utcnow
+        :param skip_unchanged: Hash the file first and, if an object with the same content already
+                               exists at ``path``, return it without moving or uploading anything.
+                               The ``acl`` is applied to it again, and if ``download_filename`` or an
+                               explicit ``timestamp`` differ from the object's they are updated with a
+                               metadata-only copy
+        :param md5:         ``(hexdigest, base64 digest, size)`` of the whole file,
+                            if already known, so that neither this method nor boto hashes it again
+
+        The whole file is uploaded, whatever its current position.
 
         :return: S3 Key
         """
         path = path.lstrip('/')
-
-        self._move_existing(path, move_prefix)
+        file.seek(0)
+
+        if skip_unchanged:
+            # (hexdigest, base64 digest, size); passing it on also saves boto a hashing pass
+            if md5 is None:
+                md5 = compute_md5(file)
+            existing_key = self._call(self.bucket.get_key, path)
+            if existing_key and get_key_md5(existing_key) == md5[0]:
+                return self._update_unchanged(path, existing_key, md5, acl, timestamp, download_filename)
+            if existing_key:
+                self._move_key(path, existing_key, move_prefix)
+        else:
+            self._move_existing(path, move_prefix)
 
         key = self.bucket.new_key(path)
-        filesize = get_file_size_up_to_maximum(file)
+        filesize = md5[2] if md5 is not None else get_file_size_up_to_maximum(file)
         timestamp = timestamp or datetime.datetime.utcnow()
         key.set_metadata('timestamp', timestamp.strftime(DATETIME_FORMAT))
-        headers = {'Content-Type': self._get_mimetype(key.name)}
-        if download_filename:
-            headers['Content-Disposition'] = 'attachment; filename="{}"'.format(download_filename).encode('utf-8')
-        key.set_contents_from_file(
-            file,
-            headers=headers
-        )
-        key.set_acl(acl)
+        headers = self._get_headers(key.name, download_filename)
+        upload_kwargs = {}
+        if md5 is not None:
+            key.set_metadata('md5', md5[0])
+            upload_kwargs = {'md5': md5[:2], 'size': md5[2]}
+
+        def upload():
+            # a failed attempt may have read part of the file
+            file.seek(0)
+            key.set_contents_from_file(
+                file,
+                headers=headers,
+                **upload_kwargs
+            )
+        self._call(upload)
+        self._call(key.set_acl, acl)
+        if self.index is not None:
+            self.index.add(path, filesize, timestamp, key.etag)
         logger.info(
             "Uploaded file {filepath} of size {filesize} with acl {fileacl}",
             extra={
@@ -75,8 +183,55 @@ class S3(object):
 
         return key
 
+    def save_many(self, items, max_workers=DEFAULT_MAX_WORKERS):
+        """Save several files in an S3 bucket concurrently
+
+        Failures are returned rather than raised, so one bad upload does not stop the batch.
+
+        :param items:       iterable of dicts of ``save`` keyword arguments. Each must contain ``path``
+                            and ``file`` and may contain ``acl``, ``move_prefix``, ``timestamp`` and
+                            ``download_filename``
+        :param max_workers: maximum number of uploads in progress at once
+
+        :return: list of dicts with ``path``, ``key`` (S3 Key or ``None``), ``size`` and ``error``
+                 (``None`` or the exception raised), in the same order as ``items``
+        """
+        start = monotonic()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(self._save_item, items))
+        elapsed = monotonic() - start
+
+        total_size = sum(result['size'] for result in results if result['error'] is None)
+        logger.info(
+            "Uploaded {filecount} files ({failedcount} failed) of {totalsize} bytes in {elapsed:.2f}s "
+            "({filespersecond:.1f} files/s, {bytespersecond:.0f} bytes/s)",
+            extra={
+                "filecount": len(results),
+                "failedcount": sum(1 for result in results if result['error'] is not None),
+                "totalsize": total_size,
+                "elapsed": elapsed,
+                "filespersecond": len(results) / elapsed if elapsed else 0,
+                "bytespersecond": total_size / elapsed if elapsed else 0,
+            })
+
+        return results
+
+    def _save_item(self, item):
+        item = dict(item)
+        path, file = item.pop('path'), item.pop('file')
+        result = {'path': path, 'key': None, 'size': 0, 'error': None}
+        try:
+            result['size'] = get_file_size_up_to_maximum(file)
+            with self.concurrency_limiter:
+                result['key'] = self.save(path, file, **item)
+        except Exception as e:
+            logger.error("Failed to upload file {filepath}: {error}", extra={"filepath": path, "error": e})
+            result['error'] = e
+
+        return result
+
     def path_exists(self, path):
-        return bool(self.bucket.get_key(path))
+        return bool(self._call(self.bucket.get_key, path))
 
     def get_signed_url(self, path, expires_in=30):
         """Create a signed S3 document URL
@@ -89,18 +244,151 @@ class S3(object):
 
         """
 
-        key = self.bucket.get_key(path)
+        key = self._call(self.bucket.get_key, path)
         if key:
             return key.generate_url(expires_in)
 
     def get_key(self, path):
-        key = self.bucket.get_key(path)
+        key = self._call(self.bucket.get_key, path)
         if key:
             return self._format_key(key, False, key.get_metadata('timestamp'))
 
+    def open(self, path, byte_range=None):
+        """Open an S3 object for streaming reads
+
+        Only the response headers are read; the body is read from the returned key with
+        ``key.read(size)`` or ``iter_key_chunks``, and the key should be closed afterwards.
+
+        :param path:       S3 object path within the bucket
+        :param byte_range: optional ``(start, end)`` tuple of inclusive byte offsets. ``end`` may be
+                           ``None`` to read to the end of the object.
+
+        :return: boto Key with ``size`` set to the full object size, or ``None`` if the object
+                 was not found
+        """
+        key = self.bucket.new_key(path)
+        headers = {}
+        if byte_range is not None:
+            headers['Range'] = get_range_header(byte_range)
+        try:
+            self._call(key.open_read, headers=headers)
+        except S3ResponseError as e:
+            if e.status == 404:
+                return None
+            raise
+
+        return key
+
+    def iter_chunks(self, path, chunk_size=DEFAULT_CHUNK_SIZE, byte_range=None):
+        """Yield the body of an S3 object in chunks of at most ``chunk_size`` bytes
+
+        Use ``open`` and ``iter_key_chunks`` instead when the response headers (for example
+        the object size for a ``Content-Range`` header) are needed before streaming.
+
+        :raises S3ResponseError: if the object does not exist, when the generator is started
+        """
+        key = self.open(path, byte_range)
+        if key is None:
+            raise S3ResponseError(404, 'Not Found')
+
+        for chunk in iter_key_chunks(key, chunk_size):
+            yield chunk
+
     def delete_key(self, path):
         self._move_existing(path, None)
-        self.bucket.delete_key(path)
+        self._call(self.bucket.delete_key, path)
+        if self.index is not None:
+            self.index.remove(path)
+
+    def delete_many(self, paths, backup=True, move_prefix=None, max_workers=DEFAULT_MAX_WORKERS):
+        """Delete several keys using S3 multi-object delete requests
+
+        :param paths:       iterable of S3 object paths
+        :param backup:      copy each existing object out of the way first, like ``delete_key`` does.
+                            Copies are made concurrently and a key whose copy fails is not deleted.
+        :param move_prefix: prefix for the backup copies; defaults to the current time
+        :param max_workers: maximum number of backup copies in progress at once
+
+        :return: list of dicts with ``path``, ``deleted`` and ``error`` (``None`` or an exception),
+                 in the same order as ``paths``
+        """
+        results = [{'path': path, 'deleted': False, 'error': None} for path in paths]
+        if backup:
+            move_prefix = move_prefix or default_move_prefix()
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                errors = list(executor.map(lambda path: self._backup_key(path, move_prefix),
+                                           [result['path'] for result in results]))
+            for result, error in zip(results, errors):
+                result['error'] = error
+
+        to_delete = [result for result in results if result['error'] is None]
+        for start in range(0, len(to_delete), MULTI_DELETE_LIMIT):
+            batch = to_delete[start:start + MULTI_DELETE_LIMIT]
+            try:
+                response = self._call(self.bucket.delete_keys, [result['path'] for result in batch], quiet=True)
+            except S3ResponseError as e:
+                for result in batch:
+                    result['error'] = e
+                continue
+
+            errors = {error.key: _multi_delete_error(error) for error in response.errors}
+            for result in batch:
+                result['error'] = errors.get(result['path'])
+                result['deleted'] = result['error'] is None
+                if result['deleted'] and self.index is not None:
+                    self.index.remove(result['path'])
+
+        logger.info(
+            "Deleted {deletedcount} of {filecount} files",
+            extra={
+                "deletedcount": sum(1 for result in results if result['deleted']),
+                "filecount": len(results),
+            })
+
+        return results
+
+    def purge_prefix(self, prefix, backup=False, move_prefix=None, max_workers=DEFAULT_MAX_WORKERS):
+        """Delete every key under a prefix
+
+        Without ``backup`` the listing is streamed and deleted a page at a time. With ``backup`` the
+        key names are listed first, so that the backup copies made under the same prefix are not
+        themselves purged.
+
+        :return: list of per-key results, as returned by ``delete_many``
+        """
+        if not prefix:
+            raise ValueError("Refusing to purge an entire bucket")
+
+        names = (key.name for key in self.bucket.list(prefix))
+        if backup:
+            return self.delete_many(list(names), backup=True, move_prefix=move_prefix, max_workers=max_workers)
+
+        results = []
+        batch = []
+        for name in names:
+            batch.append(name)
+            if len(batch) == MULTI_DELETE_LIMIT:
+                results.extend(self.delete_many(batch, backup=False))
+                batch = []
+        if batch:
+            results.extend(self.delete_many(batch, backup=False))
+
+        return results
+
+    def _backup_key(self, path, move_prefix):
+        directory, name = os.path.split(path)
+        moved_path = os.path.join(directory, '{}-{}'.format(move_prefix, name))
+        try:
+            with self.concurrency_limiter:
+                key = self._call(self.bucket.copy_key, moved_path, self.bucket_name, path)
+        except S3ResponseError as e:
+            if e.status == 404:
+                # nothing to back up; deleting a missing key succeeds
+                return None
+            return e
+
+        if self.index is not None:
+            self.index.add(moved_path, key.size, datetime.datetime.utcnow(), key.etag)
 
     def list(self, prefix='', delimiter='', load_timestamps=False):
         """
@@ -113,13 +401,46 @@ class S3(object):
                                If you need to show the timestamp set this to True.
         :return: list
         """
+        return sorted(
+            self.iter_list(prefix, delimiter, load_timestamps),
+            key=lambda key: key['last_modified']
+        )
+
+    def iter_list(self, prefix='', delimiter='', load_timestamps=False):
+        """
+        yield file keys from an s3 bucket one at a time, in bucket (lexicographic) order
+
+        Pages of the bucket listing are only requested as the generator is consumed, so
+        memory use does not grow with the number of keys under the prefix.
+
+        :param prefix:         filter by files whose names begin with the prefix
+        :param delimiter:      filter out files whose names contain the delimiter
+        :param load_timestamp: load custom timestamps (one extra API call per key)
+        :return: generator of dicts in the same format as ``list``
+        """
         # http://boto.readthedocs.org/en/latest/ref/s3.html#boto.s3.bucket.Bucket.list
-        list_of_keys = self.bucket.list(prefix, delimiter)
-        return sorted([
-            self._format_key(key, load_timestamps)
-            for key in list_of_keys
-            if not (key.size == 0 and key.name[-1] == '/')
-        ], key=lambda key: key['last_modified'])
+        for key in self.bucket.list(prefix, delimiter):
+            if key.size == 0 and key.name[-1] == '/':
+                continue
+            yield self._format_key(key, load_timestamps)
+
+    def latest(self, prefix='', n=1, delimiter='', load_timestamps=False):
+        """
+        return the ``n`` most recently modified file keys under a prefix, newest first
+
+        Only ``n`` keys are held in memory while the listing is streamed.
+
+        :param prefix:         filter by files whose names begin with the prefix
+        :param n:              number of keys to return
+        :param delimiter:      filter out files whose names contain the delimiter
+        :param load_timestamp: load custom timestamps (one extra API call per key)
+        :return: list
+        """
+        return heapq.nlargest(
+            n,
+            self.iter_list(prefix, delimiter, load_timestamps),
+            key=lambda key: key['last_modified']
+        )
 
     def _format_key(self, key, load_timestamps, timestamp=None):
         """
@@ -132,40 +453,277 @@ class S3(object):
         """
         filename, ext = os.path.splitext(os.path.basename(key.name))
         if load_timestamps:
-            key = self.bucket.get_key(key.name)
+            key = self._call(self.bucket.get_key, key.name)
             timestamp = key.get_metadata('timestamp')
 
         timestamp = timestamp or key.last_modified
-        timestamp = parse_time(timestamp)
 
         return {
             'path': key.name,
             'filename': filename,
             'ext': ext[1:],
-            'last_modified': timestamp.strftime(DATETIME_FORMAT),
+            'last_modified': normalise_timestamp(timestamp),
             'size': key.size
         }
 
     def _move_existing(self, existing_path, move_prefix=None):
+        existing_key = self._call(self.bucket.get_key, existing_path)
+        if existing_key:
+            self._move_key(existing_path, existing_key, move_prefix)
+
+    def _update_unchanged(self, path, existing_key, md5, acl, timestamp, download_filename):
+        headers = self._get_headers(path, download_filename)
+        metadata_changed = (
+            _to_text(existing_key.content_disposition) != _to_text(headers.get('Content-Disposition')) or
+            (timestamp is not None and
+             existing_key.get_metadata('timestamp') != timestamp.strftime(DATETIME_FORMAT)))
+        if metadata_changed:
+            metadata = dict(existing_key.metadata or {}, md5=md5[0])
+            if timestamp is not None:
+                metadata['timestamp'] = timestamp.strftime(DATETIME_FORMAT)
+            # copying an object onto itself with new metadata does not upload its content again
+            existing_key = self._call(
+                self.bucket.copy_key, path, self.bucket_name, path, metadata=metadata, headers=headers)
+            if self.index is not None:
+                self.index.add(path, md5[2], timestamp or datetime.datetime.utcnow(), existing_key.etag)
+        # the existing object may have been saved with a different ACL, which must not be kept
+        self._call(existing_key.set_acl, acl)
+        logger.info(
+            "Skipped upload of unchanged file {filepath}",
+            extra={"filepath": path})
+
+        return existing_key
+
+    def _get_headers(self, path, download_filename=None):
+        headers = {'Content-Type': self._get_mimetype(path)}
+        if download_filename:
+            headers['Content-Disposition'] = 'attachment; filename="{}"'.format(download_filename).encode('utf-8')
+        return headers
+
+    def _move_key(self, existing_path, existing_key, move_prefix=None):
         if move_prefix is None:
             move_prefix = default_move_prefix()
 
-        if self.bucket.get_key(existing_path):
-            path, name = os.path.split(existing_path)
-            self.bucket.copy_key(
-                os.path.join(path, '{}-{}'.format(move_prefix, name)),
-                self.bucket_name,
-                existing_path
-            )
+        path, name = os.path.split(existing_path)
+        moved_path = os.path.join(path, '{}-{}'.format(move_prefix, name))
+        self._call(
+            self.bucket.copy_key,
+            moved_path,
+            self.bucket_name,
+            existing_path
+        )
+        if self.index is not None:
+            self.index.add(moved_path, existing_key.size, datetime.datetime.utcnow(), existing_key.etag)
+
+    def _call(self, fn, *args, **kwargs):
+        """Make an S3 request with the retry policy, feeding throttling back to the concurrency limiter"""
+        def attempt():
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if is_throttling_error(e):
+                    self.concurrency_limiter.on_throttle()
+                raise
+            self.concurrency_limiter.on_success()
+            return result
+
+        return self.retry_policy.call(attempt)
 
     def _get_mimetype(self, filename):
         mimetype, _ = mimetypes.guess_type(filename)
         return mimetype
 
 
+def get_connection(host):
+    """Return the process-wide boto S3 connection for a host and the current credentials
+
+    boto connections keep a thread-safe pool of HTTP connections, so one connection per host is
+    shared by all ``S3`` instances and threads. Connections are keyed by the credentials boto reads
+    from the environment as well as the host, so changing them gets a new connection rather than
+    one made with the old credentials. Connections are re-created in a forked child process rather
+    than sharing sockets with the parent.
+    """
+    settings = _connection_settings(host)
+    with _registry_lock:
+        _reset_registry_after_fork()
+        if settings not in _connections:
+            _connections[settings] = boto.connect_s3(host=host)
+        return _connections[settings]
+
+
+def get_bucket(bucket_name, host, validate=False):
+    """Return the process-wide boto Bucket for a bucket name, host and the current credentials
+
+    :param validate: make a request to check the bucket exists, once per process
+    """
+    conn = get_connection(host)
+    cache_key = (_connection_settings(host), bucket_name)
+    with _registry_lock:
+        if cache_key not in _buckets:
+            _buckets[cache_key] = conn.get_bucket(bucket_name, validate=False)
+        bucket = _buckets[cache_key]
+        needs_validation = validate and cache_key not in _validated_buckets
+
+    if needs_validation:
+        # raises S3ResponseError if the bucket does not exist or is not accessible
+        conn.get_bucket(bucket_name, validate=True)
+        with _registry_lock:
+            _validated_buckets.add(cache_key)
+
+    return bucket
+
+
+def reset_connections():
+    """Discard all shared S3 connections and buckets"""
+    with _registry_lock:
+        _connections.clear()
+        _buckets.clear()
+        _validated_buckets.clear()
+
+
+def _connection_settings(host):
+    return (host,) + tuple(os.environ.get(name) for name in CREDENTIALS_ENVIRONMENT_VARIABLES)
+
+
+def _reset_registry_after_fork():
+    global _registry_pid
+    if _registry_pid != os.getpid():
+        _connections.clear()
+        _buckets.clear()
+        _validated_buckets.clear()
+        _registry_pid = os.getpid()
+
+
+def iter_key_chunks(key, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield the rest of an opened boto Key's body in chunks and close it"""
+    try:
+        while True:
+            chunk = key.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        key.close()
+
+
+def parse_timestamp(value):
+    """Parse an S3 or ``DATETIME_FORMAT`` timestamp into a naive UTC datetime
+
+    Other formats, such as the RFC 1123 ``Last-Modified`` header, are parsed with dateutil.
+    """
+    match = TIMESTAMP_PATTERN.match(value)
+    if match is None:
+        timestamp = parse_time(value)
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(tz.tzutc()).replace(tzinfo=None)
+        return timestamp
+
+    year, month, day, hour, minute, second, fraction = match.groups()
+    return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                             int((fraction or '0').ljust(6, '0')))
+
+
+def normalise_timestamp(value):
+    """Convert an S3 or ``DATETIME_FORMAT`` timestamp string to ``DATETIME_FORMAT``
+
+    The two known formats are rewritten without building a datetime. The result has a fixed
+    width, so sorting the strings sorts the timestamps chronologically.
+    """
+    match = TIMESTAMP_PATTERN.match(value)
+    if match is None:
+        return parse_timestamp(value).strftime(DATETIME_FORMAT)
+
+    year, month, day, hour, minute, second, fraction = match.groups()
+    return '{}-{}-{}T{}:{}:{}.{}Z'.format(year, month, day, hour, minute, second, (fraction or '').ljust(6, '0'))
+
+
+def get_key_md5(key):
+    """Return the MD5 hexdigest of an S3 object's content, or ``None`` if it is not known
+
+    The ETag is the MD5 of the content for objects uploaded in a single request; otherwise
+    the ``md5`` metadata set by ``S3.save(skip_unchanged=True)`` is used.
+    """
+    etag = (key.etag or '').strip('"')
+    if MD5_HEXDIGEST_PATTERN.match(etag):
+        return etag
+    return key.get_metadata('md5')
+
+
+def _to_text(value):
+    return value.decode('utf-8') if isinstance(value, six.binary_type) else value
+
+
+def _multi_delete_error(error):
+    e = S3ResponseError(None, error.message)
+    e.error_code = error.code
+    return e
+
+
+def get_range_header(byte_range):
+    start, end = byte_range
+    return 'bytes={}-{}'.format(start, '' if end is None else end)
+
+
+def get_content_range_header(byte_range, size):
+    """Return the ``Content-Range`` header value for a byte range of an object of ``size`` bytes"""
+    start, end = byte_range
+    end = size - 1 if end is None else min(end, size - 1)
+    return 'bytes {}-{}/{}'.format(start, end, size)
+
+
+def get_file_size(file_contents):
+    """Return the number of bytes between the current position and the end of a file object, without reading it
+
+    Works for anything that can seek and tell, such as real files, ``BytesIO``, spooled temporary
+    files and werkzeug ``FileStorage`` objects wrapping them. Otherwise uses ``content_length`` if
+    the file object has a positive one.
+
+    :return: size in bytes, or ``None`` if it cannot be found without reading the file
+    """
+    try:
+        position = file_contents.tell()
+        file_contents.seek(0, os.SEEK_END)
+        end = file_contents.tell()
+        file_contents.seek(position)
+    except (AttributeError, IOError, OSError, ValueError):
+        position = end = None
+    if isinstance(position, six.integer_types) and isinstance(end, six.integer_types):
+        return end - position
+
+    content_length = getattr(file_contents, 'content_length', None)
+    if isinstance(content_length, six.integer_types) and content_length > 0:
+        return content_length
+
+    return None
+
+
 def get_file_size_up_to_maximum(file_contents):
-    size = len(file_contents.read(FILE_SIZE_LIMIT))
-    file_contents.seek(0)
+    """Return the size of a whole file object, reading no more than just past ``FILE_SIZE_LIMIT`` bytes
+
+    Seekable files are rewound to the start, measured and left there. If ``get_file_size``
+    cannot find the size, the file is read in discarded chunks until its end or until more than
+    ``FILE_SIZE_LIMIT`` bytes have been counted, so the result is only exact up to the limit and
+    never needs the file in memory. A stream that cannot seek is counted from its current
+    position and is consumed by counting it.
+    """
+    try:
+        file_contents.seek(0)
+        seekable = True
+    except (AttributeError, IOError, OSError, ValueError):
+        seekable = False
+
+    size = get_file_size(file_contents)
+    if size is not None:
+        return size
+
+    size = 0
+    while size <= FILE_SIZE_LIMIT:
+        chunk = file_contents.read(DEFAULT_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+    if seekable:
+        file_contents.seek(0)
 
     return size
 
@@ -0,0 +1,178 @@
+from __future__ import absolute_import
+import errno
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from monotonic import monotonic
+
+from .files import TMP_PREFIX, atomic_write
+from .s3 import S3ResponseError, iter_key_chunks
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 500 * 1024 * 1024
+# eviction goes below max_size, so a full cache is not scanned again on every store
+EVICTION_TARGET = 0.9
+# other processes sharing the directory add to it too, so the size is rescanned at least this often
+RESCAN_INTERVAL = 60
+
+
+class S3Cache(object):
+    """Read-through local disk cache of S3 objects
+
+    Every ``open`` makes one conditional GET with the cached ETag, so an
+    unchanged object costs a ``304 Not Modified`` response instead of a
+    download. Hits are served as open files, which Flask's ``send_file``
+    can pass to the WSGI server without reading them into memory.
+
+    The cache directory can be shared by several worker processes. Cached
+    bodies are immutable files named after the object path and ETag, and
+    they are written to a temporary file and renamed into place. A reader
+    therefore always gets a complete body that matches the ETag it checked.
+    Once the cache grows beyond ``max_size`` bytes, the least recently used
+    bodies and their entries are removed until it is back under 90% of it.
+    Each process keeps a running total of the cache size, and only scans the
+    directory when that total goes over the limit or has not been checked
+    for ``RESCAN_INTERVAL`` seconds.
+
+    :param s3:        ``dmutils.s3.S3`` instance for the bucket to read from
+    :param directory: cache directory, created if it does not exist
+    :param max_size:  maximum total size in bytes of the cached bodies
+    """
+
+    def __init__(self, s3, directory, max_size=DEFAULT_MAX_SIZE):
+        self.s3 = s3
+        self.directory = directory
+        self.max_size = max_size
+        self._size = None
+        self._scanned_at = None
+        self._size_lock = threading.Lock()
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    def open(self, path):
+        """Return an open binary file with the contents of an S3 object
+
+        :return: file object, or ``None`` if the object was not found
+        """
+        entry_name = self._entry_name(path)
+        cached = self._open_cached(entry_name)
+
+        key = self.s3.bucket.new_key(path)
+        headers = {'If-None-Match': cached[1]} if cached else {}
+        try:
+            # through S3._call for its retry policy and concurrency limiter feedback
+            self.s3._call(key.open_read, headers=headers)
+        except S3ResponseError as e:
+            if cached and e.status == 304:
+                self._touch(cached[0].name)
+                return cached[0]
+            if cached:
+                cached[0].close()
+            if e.status == 404:
+                return None
+            raise
+
+        if cached:
+            cached[0].close()
+
+        return self._store(entry_name, key)
+
+    def _open_cached(self, entry_name):
+        try:
+            with open(self._entry_path(entry_name)) as f:
+                entry = json.load(f)
+            return open(os.path.join(self.directory, entry['file']), 'rb'), entry['etag']
+        except (IOError, OSError, ValueError):
+            # missing, evicted, or replaced by another process since the entry was read
+            return None
+
+    def _store(self, entry_name, key):
+        data_name = '{}-{}'.format(entry_name, hashlib.sha1(key.etag.encode('utf-8')).hexdigest())
+        data_path = os.path.join(self.directory, data_name)
+
+        with atomic_write(data_path, 'wb') as f:
+            for chunk in iter_key_chunks(key):
+                f.write(chunk)
+        with atomic_write(self._entry_path(entry_name), 'w') as f:
+            json.dump({'path': key.name, 'etag': key.etag, 'file': data_name}, f)
+
+        # open before evicting so the new body cannot be removed under us
+        cached = open(data_path, 'rb')
+        self._add_size(os.fstat(cached.fileno()).st_size)
+
+        return cached
+
+    def _add_size(self, stored_size):
+        with self._size_lock:
+            if self._size is None or monotonic() - self._scanned_at >= RESCAN_INTERVAL:
+                # the scan includes the body just stored
+                self._size = sum(size for mtime, size, name in self._list_bodies())
+                self._scanned_at = monotonic()
+            else:
+                self._size += stored_size
+            if self._size > self.max_size:
+                self._size = self._evict()
+                self._scanned_at = monotonic()
+
+    def _list_bodies(self):
+        bodies = []
+        for name in os.listdir(self.directory):
+            if name.startswith(TMP_PREFIX) or name.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            bodies.append((stat.st_mtime, stat.st_size, name))
+        return bodies
+
+    def _evict(self):
+        bodies = self._list_bodies()
+        total_size = sum(size for mtime, size, name in bodies)
+        for mtime, size, name in sorted(bodies):
+            if total_size <= self.max_size * EVICTION_TARGET:
+                break
+            self._remove_entry(name)
+            _remove(os.path.join(self.directory, name))
+            total_size -= size
+            logger.debug("Evicted {cachefile} from S3 cache", extra={"cachefile": name})
+        return total_size
+
+    def _remove_entry(self, data_name):
+        # body names start with their entry's name, and the entry may already point to a newer body
+        entry_path = self._entry_path(data_name.rsplit('-', 1)[0])
+        try:
+            with open(entry_path) as f:
+                if json.load(f)['file'] != data_name:
+                    return
+        except (IOError, OSError, ValueError, KeyError):
+            return
+        _remove(entry_path)
+
+    def _touch(self, data_path):
+        try:
+            os.utime(data_path, None)
+        except OSError:
+            pass
+
+    def _entry_name(self, path):
+        return hashlib.sha1(u'{}/{}'.format(self.s3.bucket_name, path).encode('utf-8')).hexdigest()
+
+    def _entry_path(self, entry_name):
+        return os.path.join(self.directory, entry_name + '.json')
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
@@ -0,0 +1,194 @@
+from __future__ import absolute_import
+import datetime
+import os
+import sqlite3
+import threading
+
+import six
+
+from .formats import DATETIME_FORMAT
+
+
+SYNC_BATCH_SIZE = 1000  # one page of an S3 bucket listing
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS s3_keys (
+    bucket TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER,
+    last_modified TEXT NOT NULL,
+    etag TEXT,
+    sync_id INTEGER NOT NULL DEFAULT 0,
+    indexed_at TEXT NOT NULL,
+    PRIMARY KEY (bucket, path)
+);
+CREATE INDEX IF NOT EXISTS s3_keys_last_modified ON s3_keys (bucket, last_modified);
+CREATE TABLE IF NOT EXISTS s3_syncs (
+    bucket TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    sync_id INTEGER NOT NULL,
+    synced_at TEXT NOT NULL,
+    PRIMARY KEY (bucket, prefix)
+);
+"""
+
+
+class S3Index(object):
+    """Local SQLite manifest of the keys in an S3 bucket
+
+    The index is populated with ``sync`` and kept up to date by ``S3.save``
+    and ``S3.delete_key`` when it is passed to ``S3(..., index=...)``. It
+    answers prefix listings, newest-first queries and existence checks
+    without making any S3 requests, so it is only as fresh as the last
+    ``sync`` for keys written by other processes.
+    """
+
+    def __init__(self, bucket_name, db_path=':memory:'):
+        self.bucket_name = bucket_name
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+
+    def add(self, path, size, last_modified, etag=None):
+        """Record a key, replacing any existing entry for the same path
+
+        :param last_modified: datetime or string in ``DATETIME_FORMAT``
+        """
+        if isinstance(last_modified, datetime.datetime):
+            last_modified = last_modified.strftime(DATETIME_FORMAT)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO s3_keys (bucket, path, size, last_modified, etag, indexed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (self.bucket_name, path, size, last_modified, etag, _utcnow())
+            )
+
+    def remove(self, path):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM s3_keys WHERE bucket = ? AND path = ?",
+                (self.bucket_name, path)
+            )
+
+    def exists(self, path):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM s3_keys WHERE bucket = ? AND path = ?",
+                (self.bucket_name, path)
+            ).fetchone()
+        return row is not None
+
+    def list(self, prefix=''):
+        """Return indexed keys under a prefix, ordered by last_modified date
+
+        :return: list of dicts in the same format as ``S3.list``
+        """
+        return self._select(prefix, 'last_modified ASC, path ASC')
+
+    def latest(self, prefix='', n=1):
+        """Return the ``n`` most recently modified indexed keys under a prefix, newest first"""
+        return self._select(prefix, 'last_modified DESC, path ASC', limit=n)
+
+    def sync(self, s3, prefix='', load_timestamps=False):
+        """Reconcile the index with the bucket contents under a prefix
+
+        Every key in the bucket listing is upserted and index entries under
+        the prefix that are no longer in the bucket are removed.
+
+        :param s3:              ``dmutils.s3.S3`` instance for the indexed bucket
+        :param prefix:          only reconcile keys under this prefix
+        :param load_timestamps: load custom timestamps (one extra API call per key)
+        :return: number of keys in the bucket under the prefix
+        """
+        sync_id = self._next_sync_id()
+        sync_started_at = _utcnow()
+        count = 0
+        rows = []
+        for key in s3.bucket.list(prefix):
+            if key.size == 0 and key.name[-1] == '/':
+                continue
+            formatted = s3._format_key(key, load_timestamps)
+            rows.append((self.bucket_name, formatted['path'], formatted['size'], formatted['last_modified'],
+                         key.etag, sync_id, _utcnow()))
+            if len(rows) >= SYNC_BATCH_SIZE:
+                count += self._upsert(rows)
+                rows = []
+        count += self._upsert(rows)
+
+        # keys added by ``S3.save`` while the listing was running are kept
+        where, params = self._prefix_clause(prefix)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM s3_keys WHERE {} AND sync_id != ? AND indexed_at < ?".format(where),
+                params + (sync_id, sync_started_at)
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO s3_syncs (bucket, prefix, sync_id, synced_at) VALUES (?, ?, ?, ?)",
+                (self.bucket_name, prefix, sync_id, sync_started_at)
+            )
+
+        return count
+
+    def last_synced(self, prefix=''):
+        """Return the datetime of the last ``sync`` of a prefix, or ``None`` if it was never synced"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT synced_at FROM s3_syncs WHERE bucket = ? AND prefix = ?",
+                (self.bucket_name, prefix)
+            ).fetchone()
+        if row:
+            return datetime.datetime.strptime(row[0], DATETIME_FORMAT)
+
+    def needs_sync(self, prefix='', max_age=datetime.timedelta(hours=1)):
+        last_synced = self.last_synced(prefix)
+        return last_synced is None or datetime.datetime.utcnow() - last_synced > max_age
+
+    def _upsert(self, rows):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO s3_keys (bucket, path, size, last_modified, etag, sync_id, indexed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+        return len(rows)
+
+    def _next_sync_id(self):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MAX(sync_id) FROM s3_syncs WHERE bucket = ?", (self.bucket_name,)
+            ).fetchone()
+        return (row[0] or 0) + 1
+
+    def _select(self, prefix, order_by, limit=-1):
+        where, params = self._prefix_clause(prefix)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, size, last_modified FROM s3_keys WHERE {} ORDER BY {} LIMIT ?".format(where, order_by),
+                params + (limit,)
+            ).fetchall()
+        return [_format_row(*row) for row in rows]
+
+    def _prefix_clause(self, prefix):
+        if not prefix:
+            return "bucket = ?", (self.bucket_name,)
+
+        # a range over the primary key is both exact and index-friendly,
+        # unlike LIKE, which is case-insensitive in SQLite
+        upper_bound = prefix[:-1] + six.unichr(ord(prefix[-1]) + 1)
+        return "bucket = ? AND path >= ? AND path < ?", (self.bucket_name, prefix, upper_bound)
+
+
+def _utcnow():
+    return datetime.datetime.utcnow().strftime(DATETIME_FORMAT)
+
+
+def _format_row(path, size, last_modified):
+    filename, ext = os.path.splitext(os.path.basename(path))
+    return {
+        'path': path,
+        'filename': filename,
+        'ext': ext[1:],
+        'last_modified': last_modified,
+        'size': size,
+    }
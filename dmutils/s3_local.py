@@ -0,0 +1,292 @@
+from __future__ import absolute_import
+import datetime
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+import six
+from boto.s3.multidelete import Error, MultiDeleteResult
+
+from .files import TMP_PREFIX, atomic_write
+from .s3 import S3, S3ResponseError
+
+
+LIST_PAGE_SIZE = 1000  # keys per page of an S3 bucket listing
+STORED_ATTRIBUTES = ('size', 'etag', 'last_modified', 'metadata', 'content_type', 'content_disposition', 'acl')
+RANGE_HEADER_PATTERN = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+class LocalS3(S3):
+    """Filesystem-backed stand-in for ``dmutils.s3.S3``
+
+    Objects and their metadata are stored under ``root/bucket_name`` and every
+    ``S3`` method works unchanged against them, which makes it usable for local
+    development and for performance tests without AWS.
+
+    :param bucket_name: name of the bucket directory under ``root``
+    :param root:        directory holding the buckets
+    :param latency:     seconds to sleep on each simulated S3 request
+    """
+
+    def __init__(self, bucket_name=None, root=None, latency=0, index=None):
+        self.bucket_name = bucket_name
+        self.bucket = LocalBucket(bucket_name, root, latency)
+        self.index = index
+
+
+class LocalBucket(object):
+    """Subset of ``boto.s3.bucket.Bucket`` used by ``dmutils.s3.S3``, stored on local disk
+
+    ``request_count`` counts the simulated S3 requests made against the bucket.
+    """
+
+    def __init__(self, name, root, latency=0):
+        self.name = name
+        self.latency = latency
+        self.request_count = 0
+        self._lock = threading.Lock()
+        self._objects_dir = os.path.join(root, name, 'objects')
+        self._metadata_dir = os.path.join(root, name, 'metadata')
+
+    def get_key(self, key_name, headers=None):
+        self._request()
+        return self._load_key(key_name)
+
+    def new_key(self, key_name):
+        return LocalKey(self, key_name)
+
+    def list(self, prefix='', delimiter=''):
+        names = sorted(self._iter_key_names(prefix))
+        seen_prefixes = set()
+        for i, name in enumerate(names):
+            if i % LIST_PAGE_SIZE == 0:
+                self._request()
+            if delimiter and delimiter in name[len(prefix):]:
+                common_prefix = name[:name.index(delimiter, len(prefix)) + len(delimiter)]
+                if common_prefix not in seen_prefixes:
+                    seen_prefixes.add(common_prefix)
+                    yield LocalPrefix(common_prefix)
+                continue
+            key = self._load_key(name)
+            if key is not None:
+                yield key
+
+    def copy_key(self, new_key_name, src_bucket_name, src_key_name, metadata=None, headers=None, **kwargs):
+        self._request()
+        if src_bucket_name != self.name:
+            raise ValueError("LocalBucket can only copy keys within the same bucket")
+
+        source = self._load_key(src_key_name)
+        if source is None:
+            raise S3ResponseError(404, 'Not Found')
+
+        key = LocalKey(self, new_key_name)
+        if metadata is not None:
+            # as in S3, replacing the metadata replaces the content headers too
+            key.metadata = dict(metadata)
+            key.content_type = (headers or {}).get('Content-Type')
+            key.content_disposition = (headers or {}).get('Content-Disposition')
+            if isinstance(key.content_disposition, six.binary_type):
+                key.content_disposition = key.content_disposition.decode('utf-8')
+        else:
+            key.metadata = dict(source.metadata)
+            key.content_type = source.content_type
+            key.content_disposition = source.content_disposition
+        key.acl = source.acl
+        if new_key_name != src_key_name:  # copying a key onto itself only replaces its metadata
+            self._makedirs(new_key_name)
+            shutil.copyfile(self._object_path(src_key_name), self._object_path(new_key_name))
+        key.size = source.size
+        key.etag = source.etag
+        key._touch()
+        key._write_metadata()
+
+        return key
+
+    def delete_key(self, key_name):
+        self._request()
+        self._remove(key_name)
+
+    def delete_keys(self, keys, quiet=False, **kwargs):
+        self._request()
+        if len(keys) > 1000:
+            raise S3ResponseError(400, 'MalformedXML')
+
+        result = MultiDeleteResult(self)
+        for key_name in keys:
+            try:
+                self._remove(key_name)
+            except OSError as e:
+                result.errors.append(Error(key_name, code='InternalError', message=str(e)))
+
+        return result
+
+    def _remove(self, key_name):
+        for path in (self._object_path(key_name), self._metadata_path(key_name)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _request(self):
+        with self._lock:
+            self.request_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _load_key(self, key_name):
+        try:
+            with open(self._metadata_path(key_name)) as f:
+                stored = json.load(f)
+        except (IOError, OSError):
+            return None
+
+        key = LocalKey(self, key_name)
+        for name in STORED_ATTRIBUTES:
+            setattr(key, name, stored[name])
+
+        return key
+
+    def _iter_key_names(self, prefix):
+        # only walk the directory the prefix points into
+        start = os.path.join(self._objects_dir, os.path.dirname(prefix))
+        for dirname, dirs, files in os.walk(start):
+            for filename in files:
+                if filename.startswith(TMP_PREFIX):
+                    continue
+                name = os.path.relpath(os.path.join(dirname, filename), self._objects_dir).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    yield name
+
+    def _object_path(self, key_name):
+        return os.path.join(self._objects_dir, *key_name.split('/'))
+
+    def _metadata_path(self, key_name):
+        return os.path.join(self._metadata_dir, *key_name.split('/')) + '.json'
+
+    def _makedirs(self, key_name):
+        for path in (self._object_path(key_name), self._metadata_path(key_name)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+
+
+class LocalKey(object):
+    """Subset of ``boto.s3.key.Key`` used by ``dmutils.s3.S3``, stored on local disk"""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.size = None
+        self.etag = None
+        self.last_modified = None
+        self.metadata = {}
+        self.content_type = None
+        self.content_disposition = None
+        self.acl = 'private'
+        self._fp = None
+        self._remaining = 0
+
+    def set_metadata(self, name, value):
+        self.metadata[name] = value
+
+    def get_metadata(self, name):
+        return self.metadata.get(name)
+
+    def set_contents_from_file(self, fp, headers=None, md5=None, **kwargs):
+        self.bucket._request()
+        headers = headers or {}
+        self.content_type = headers.get('Content-Type')
+        content_disposition = headers.get('Content-Disposition')
+        if isinstance(content_disposition, six.binary_type):
+            content_disposition = content_disposition.decode('utf-8')
+        self.content_disposition = content_disposition
+
+        self.bucket._makedirs(self.name)
+        object_path = self.bucket._object_path(self.name)
+        checksum = hashlib.md5()
+        size = 0
+        with atomic_write(object_path) as f:
+            while True:
+                chunk = fp.read(8192)
+                if not chunk:
+                    break
+                if isinstance(chunk, six.text_type):
+                    chunk = chunk.encode('utf-8')
+                checksum.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+
+        self.size = size
+        self.etag = '"{}"'.format(checksum.hexdigest())
+        self._touch()
+        self._write_metadata()
+
+        return size
+
+    def set_acl(self, acl):
+        self.bucket._request()
+        self.acl = acl
+        self._write_metadata()
+
+    def open_read(self, headers=None, **kwargs):
+        self.bucket._request()
+        stored = self.bucket._load_key(self.name)
+        if stored is None:
+            raise S3ResponseError(404, 'Not Found')
+        for name in STORED_ATTRIBUTES:
+            setattr(self, name, getattr(stored, name))
+        if (headers or {}).get('If-None-Match') == self.etag:
+            raise S3ResponseError(304, 'Not Modified')
+
+        start, end = 0, self.size - 1
+        match = RANGE_HEADER_PATTERN.match((headers or {}).get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), end)
+            if start > end:
+                raise S3ResponseError(416, 'Requested Range Not Satisfiable')
+
+        self._fp = open(self.bucket._object_path(self.name), 'rb')
+        self._fp.seek(start)
+        self._remaining = end - start + 1
+
+    def read(self, size=0):
+        if self._fp is None:
+            self.open_read()
+        if self._remaining <= 0:
+            self.close()
+            return b''
+        data = self._fp.read(min(size, self._remaining) if size else self._remaining)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def generate_url(self, expires_in):
+        expires = int(time.time()) + expires_in
+        return 'file://{}?Expires={}'.format(self.bucket._object_path(self.name), expires)
+
+    def _touch(self):
+        # same format as last_modified in S3 bucket listings
+        self.last_modified = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+    def _write_metadata(self):
+        with atomic_write(self.bucket._metadata_path(self.name), 'w') as f:
+            json.dump({name: getattr(self, name) for name in STORED_ATTRIBUTES}, f)
+
+
+class LocalPrefix(object):
+    """Common prefix returned by ``LocalBucket.list`` when a delimiter is used"""
+
+    def __init__(self, name):
+        self.name = name
+        self.size = 0
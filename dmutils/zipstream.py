@@ -0,0 +1,94 @@
+import struct
+import zlib
+
+import six
+
+
+LOCAL_FILE_HEADER = struct.Struct('<IHHHHHIIIHH')
+DATA_DESCRIPTOR = struct.Struct('<IIII')
+CENTRAL_DIRECTORY_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_OF_CENTRAL_DIRECTORY = struct.Struct('<IHHHHIIH')
+
+LOCAL_FILE_HEADER_SIGNATURE = 0x04034b50
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+CENTRAL_DIRECTORY_HEADER_SIGNATURE = 0x02014b50
+END_OF_CENTRAL_DIRECTORY_SIGNATURE = 0x06054b50
+
+ZIP_VERSION = 20  # 2.0: deflate and data descriptors
+ZIP_DEFLATED = 8
+# sizes and CRC follow the entry data in a data descriptor; names are UTF-8
+ZIP_FLAGS = 0x0008 | 0x0800
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP32_ENTRY_LIMIT = 0xFFFF
+
+
+def iter_zip(entries, compress_level=6):
+    """Yield a ZIP archive of ``entries`` in chunks, without seeking or buffering whole entries
+
+    Each entry is deflated as its chunks arrive. Its sizes and CRC are written after its data
+    in a data descriptor, so memory use does not depend on the size of the entries.
+
+    Archives are limited to 65535 entries and 4GB, since ZIP64 is not supported; ``ValueError``
+    is raised when either limit is passed.
+
+    :param entries:        iterable of ``(name, modified, chunks)`` tuples, where ``modified`` is a
+                           datetime and ``chunks`` is an iterable of byte strings
+    :param compress_level: zlib compression level
+    """
+    central_directory = []
+    offset = 0
+    for name, modified, chunks in entries:
+        if len(central_directory) == ZIP32_ENTRY_LIMIT:
+            raise ValueError("ZIP archive has too many entries")
+        if isinstance(name, six.text_type):
+            name = name.encode('utf-8')
+        dos_time, dos_date = get_dos_datetime(modified)
+
+        header = LOCAL_FILE_HEADER.pack(
+            LOCAL_FILE_HEADER_SIGNATURE, ZIP_VERSION, ZIP_FLAGS, ZIP_DEFLATED, dos_time, dos_date,
+            0, 0, 0, len(name), 0) + name
+        yield header
+
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        crc, size, compressed_size = 0, 0, 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                compressed_size += len(data)
+                yield data
+        data = compressor.flush()
+        compressed_size += len(data)
+        yield data
+
+        crc &= 0xFFFFFFFF
+        if size > ZIP32_LIMIT or offset + len(header) + compressed_size > ZIP32_LIMIT:
+            raise ValueError("ZIP archive is too large")
+        yield DATA_DESCRIPTOR.pack(DATA_DESCRIPTOR_SIGNATURE, crc, compressed_size, size)
+
+        central_directory.append(CENTRAL_DIRECTORY_HEADER.pack(
+            CENTRAL_DIRECTORY_HEADER_SIGNATURE, ZIP_VERSION, ZIP_VERSION, ZIP_FLAGS, ZIP_DEFLATED,
+            dos_time, dos_date, crc, compressed_size, size, len(name), 0, 0, 0, 0, 0, offset) + name)
+        offset += len(header) + compressed_size + DATA_DESCRIPTOR.size
+
+    central_directory_size = 0
+    for record in central_directory:
+        central_directory_size += len(record)
+        yield record
+    if offset + central_directory_size > ZIP32_LIMIT:
+        raise ValueError("ZIP archive is too large")
+
+    yield END_OF_CENTRAL_DIRECTORY.pack(
+        END_OF_CENTRAL_DIRECTORY_SIGNATURE, 0, 0, len(central_directory), len(central_directory),
+        central_directory_size, offset, 0)
+
+
+def get_dos_datetime(value):
+    """Return the ``(time, date)`` MS-DOS timestamp fields used by ZIP archives for a datetime"""
+    # MS-DOS dates start in 1980 and times have a two second resolution
+    year = min(max(value.year, 1980), 2107)
+    return (
+        (value.hour << 11) | (value.minute << 5) | (value.second // 2),
+        ((year - 1980) << 9) | (value.month << 5) | value.day,
+    )
@@ -17,7 +17,9 @@ with open('dmutils/__init__.py', 'rb') as f:
 requirements = list(parse_requirements('requirements.txt',
                                        session=pip.download.PipSession()))
 
-install_requires = [str(r.req) for r in requirements]
+# keep environment markers, which str(r.req) leaves out
+install_requires = [str(r.req) + ('; {}'.format(r.markers) if getattr(r, 'markers', None) else '')
+                    for r in requirements]
 
 setup(
     name='dto-digitalmarketplace-utils',
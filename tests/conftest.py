@@ -5,9 +5,18 @@ from flask import Flask
 import mock
 from boto.ec2.cloudwatch import CloudWatchConnection
 
+from dmutils import metrics, s3
 from dmutils.logging import init_app
 
 
+@pytest.yield_fixture(autouse=True)
+def s3_connections():
+    # S3 connections and buckets are shared by the whole process, so no test sees another's mocks
+    s3.reset_connections()
+    yield
+    s3.reset_connections()
+
+
 @pytest.fixture
 def app():
     return Flask(__name__)
@@ -26,7 +35,9 @@ def cloudwatch():
     with mock.patch('dmutils.metrics.connect_to_region') as connect_to_region:
         conn = mock.Mock(spec=CloudWatchConnection)
         connect_to_region.return_value = conn
+        metrics.reset_shared_clients()
         yield conn
+        metrics.reset_shared_clients()
 
 
 @pytest.fixture
@@ -4,6 +4,7 @@ from flask_login import LoginManager
 from dmutils.flask_init import init_app, init_frontend_app
 
 from datetime import datetime
+import io
 import mock
 
 
@@ -13,8 +14,7 @@ class IsDatetime(object):
 
 
 def mock_file(filename, length, name=None):
-    mock_file = mock.MagicMock()
-    mock_file.read.return_value = '*' * length
+    mock_file = mock.MagicMock(wraps=io.BytesIO(b'*' * length))
     mock_file.filename = filename
     mock_file.name = name
 
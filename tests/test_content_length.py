@@ -0,0 +1,95 @@
+import io
+
+import pytest
+from flask import request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from dmutils import content_length
+from dmutils.content_length import ContentLengthLimit, LimitedInput
+from dmutils.s3 import FILE_SIZE_LIMIT
+
+
+@pytest.fixture
+def client(app):
+    app.config['DM_MAX_CONTENT_LENGTH'] = 10
+    app.config['DM_MAX_CONTENT_LENGTH_PREFIXES'] = {'/upload': 20, '/upload/large': None}
+
+    @app.route('/<path:path>', methods=['POST'])
+    def upload(path):
+        return str(len(request.get_data()))
+
+    content_length.init_app(app)
+    return app.test_client()
+
+
+def test_allows_body_up_to_limit(client):
+    response = client.post('/form', data=b'*' * 10)
+
+    assert response.status_code == 200
+    assert response.data == b'10'
+
+
+def test_rejects_content_length_over_limit(client):
+    response = client.post('/form', data=b'*' * 11)
+
+    assert response.status_code == 413
+
+
+def test_uses_longest_matching_prefix_limit(client):
+    assert client.post('/upload/document', data=b'*' * 20).status_code == 200
+    assert client.post('/upload/document', data=b'*' * 21).status_code == 413
+    assert client.post('/upload/large', data=b'*' * 1000).status_code == 200
+
+
+def test_rejects_content_length_without_reading_body(app):
+    def application(environ, start_response):
+        raise AssertionError("application called")
+
+    class Unreadable(object):
+        def read(self, *args):
+            raise AssertionError("body read")
+
+    responses = []
+    body = ContentLengthLimit(application, FILE_SIZE_LIMIT)(
+        {'PATH_INFO': '/', 'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(500 * 1024 * 1024),
+         'wsgi.input': Unreadable()},
+        lambda status, headers: responses.append(status))
+
+    assert responses[0].startswith('413')
+    assert b'Request Entity Too Large' in b''.join(body)
+
+
+def test_limits_body_without_content_length(app):
+    environ = {'PATH_INFO': '/', 'REQUEST_METHOD': 'POST', 'wsgi.input': io.BytesIO(b'*' * 100)}
+
+    def application(environ, start_response):
+        with pytest.raises(RequestEntityTooLarge):
+            environ['wsgi.input'].read()
+        return []
+
+    ContentLengthLimit(application, 10)(environ, lambda status, headers: None)
+
+
+def test_limited_input_reads_body_within_limit():
+    stream = LimitedInput(io.BytesIO(b'abc\ndef\n'), 10)
+
+    assert stream.readline() == b'abc\n'
+    assert list(stream) == [b'def\n']
+    assert stream.read() == b''
+
+
+def test_limited_input_stops_reading_just_past_limit():
+    body = io.BytesIO(b'*' * 100)
+    stream = LimitedInput(body, 10)
+
+    assert stream.read(6) == b'*' * 6
+    with pytest.raises(RequestEntityTooLarge):
+        stream.read(6)
+    assert body.tell() == 11
+
+
+def test_init_app_does_nothing_without_config(app):
+    wsgi_app = app.wsgi_app
+    content_length.init_app(app)
+
+    assert app.wsgi_app == wsgi_app
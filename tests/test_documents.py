@@ -1,11 +1,21 @@
 # coding: utf-8
+import datetime
+import io
+import json
+import tempfile
+import threading
 import unittest
+import zipfile
 
 import mock
 import pytest
+import six
+from flask import Flask, has_app_context, request
 from freezegun import freeze_time
 
 from .helpers import mock_file
+from dmutils import request_id
+from dmutils.logging import RequestIdFilter
 from dmutils.s3 import S3ResponseError
 
 from dmutils.documents import (
@@ -17,7 +27,10 @@ from dmutils.documents import (
     upload_document, upload_service_documents,
     get_signed_url, get_agreement_document_path, get_document_path,
     sanitise_supplier_name, file_is_pdf, file_is_zip, file_is_image,
-    file_is_csv)
+    file_is_csv, scan_document, DocumentScan, sniff_document_type, file_content_matches_extension,
+    iter_documents_zip, documents_zip_response, generate_file_names, sanitise_supplier_names,
+    audit_framework_documents, iter_audit_csv, iter_audit_json)
+from dmutils.s3_local import LocalS3
 
 
 class TestGenerateFilename(unittest.TestCase):
@@ -39,6 +52,19 @@ class TestGenerateFilename(unittest.TestCase):
                     'pricingDocumentURL', 'test.pdf',
                 ))
 
+    def test_generate_file_names_share_one_suffix(self):
+        with mock.patch('dmutils.documents.default_file_suffix', return_value='2015-01-02-0304') as suffix:
+            names = generate_file_names('slug', 'documents', [
+                (2, 1, 'pricingDocumentURL', 'test.pdf'),
+                (3, 4, 'sfiaRateDocumentURL', 'rates.ODS'),
+            ])
+
+        assert names == [
+            'slug/documents/2/1-pricing-document-2015-01-02-0304.pdf',
+            'slug/documents/3/4-sfia-rate-card-2015-01-02-0304.ods',
+        ]
+        assert suffix.call_count == 1
+
 
 class TestValidateDocuments(unittest.TestCase):
     def test_get_extension(self):
@@ -75,6 +101,34 @@ class TestValidateDocuments(unittest.TestCase):
     def test_file_is_more_than_5mb(self):
         self.assertFalse(file_is_less_than_5mb(mock_file('file1', 5400001)))
 
+    def test_scan_document_reads_file_once(self):
+        file = mock_file('file1.pdf', 1)
+
+        assert scan_document(file) == DocumentScan(
+            1, ('3389dae361af79b04c9c8e7057f60cc6', 'M4na42GvebBMnI5wV/YMxg==', 1))
+        assert file.tell() == 0
+        read_count = file.read.call_count
+
+        assert not file_is_empty(file)
+        assert file_is_less_than_5mb(file)
+        assert file.read.call_count == read_count
+
+    def test_scan_document_of_builtin_file(self):
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as f:
+            f.write(b'%PDF-1.4')
+            f.flush()
+            # a built-in file on Python 2, which does not accept new attributes to cache the scan on
+            with open(f.name, 'rb') as file_contents:
+                assert scan_document(file_contents).size == 8
+                assert sniff_document_type(file_contents) == 'pdf'
+                assert scan_document(file_contents).size == 8
+
+    def test_scan_document_stops_after_size_limit(self):
+        scan = scan_document(mock_file('file1.pdf', 10000000))
+
+        assert 5400000 < scan.size < 10000000
+        assert scan.md5 is None
+
     def test_file_is_open_document_format(self):
         self.assertTrue(file_is_open_document_format(mock_file('file1.pdf', 1)))
 
@@ -155,7 +209,8 @@ class TestUploadDocument(unittest.TestCase):
         uploader.save.assert_called_once_with(
             'g-cloud-6/documents/5/123-pricing-document-2015-01-02-0405.pdf',
             mock.ANY,
-            acl='public-read'
+            acl='public-read',
+            md5=('3389dae361af79b04c9c8e7057f60cc6', 'M4na42GvebBMnI5wV/YMxg==', 1)
         )
 
     def test_document_private_upload(self):
@@ -176,7 +231,8 @@ class TestUploadDocument(unittest.TestCase):
         uploader.save.assert_called_once_with(
             'g-cloud-6/documents/5/123-pricing-document-2015-01-02-0405.pdf',
             mock.ANY,
-            acl='private'
+            acl='private',
+            md5=mock.ANY
         )
 
     def test_document_upload_s3_error(self):
@@ -208,7 +264,8 @@ class TestUploadDocument(unittest.TestCase):
         uploader.save.assert_called_once_with(
             'g-cloud-6/submissions/5/123-pricing-document-2015-01-02-0405.pdf',
             mock.ANY,
-            acl='public-read'
+            acl='public-read',
+            md5=mock.ANY
         )
 
     def test_document_upload_with_invalid_short_bucket_name(self):
@@ -249,7 +306,8 @@ class TestUploadServiceDocuments(object):
                 request_files, self.section)
 
         self.uploader.save.assert_called_with(
-            'g-cloud-7/documents/12345/654321-pricing-document-2015-10-04-1436.pdf', mock.ANY, acl='public-read')
+            'g-cloud-7/documents/12345/654321-pricing-document-2015-10-04-1436.pdf', mock.ANY,
+            acl='public-read', md5=mock.ANY)
 
         assert 'pricingDocumentURL' in files
         assert len(errors) == 0
@@ -264,11 +322,85 @@ class TestUploadServiceDocuments(object):
                 public=False)
 
         self.uploader.save.assert_called_with(
-            'g-cloud-7/documents/12345/654321-pricing-document-2015-10-04-1436.pdf', mock.ANY, acl='private')
+            'g-cloud-7/documents/12345/654321-pricing-document-2015-10-04-1436.pdf', mock.ANY,
+            acl='private', md5=mock.ANY)
 
         assert 'pricingDocumentURL' in files
         assert len(errors) == 0
 
+    def test_upload_service_documents_uploads_fields_concurrently(self):
+        self.section.get_question_ids.return_value = ['pricingDocumentURL', 'termsAndConditionsDocumentURL']
+        request_files = {
+            'pricingDocumentURL': mock_file('q1.pdf', 100),
+            'termsAndConditionsDocumentURL': mock_file('q2.pdf', 100),
+        }
+        started = [threading.Event(), threading.Event()]
+
+        def save(path, file, **kwargs):
+            # each upload waits for the other to start, so they only both finish if run concurrently
+            index = 0 if 'pricing' in path else 1
+            started[index].set()
+            assert started[1 - index].wait(5)
+        self.uploader.save.side_effect = save
+
+        files, errors = upload_service_documents(
+            self.uploader, self.documents_url, self.service,
+            request_files, self.section)
+
+        assert sorted(files) == ['pricingDocumentURL', 'termsAndConditionsDocumentURL']
+        assert errors == {}
+
+    def test_upload_service_documents_in_request(self):
+        app = Flask(__name__)
+        request_id.init_app(app)
+        teardowns = []
+        app.teardown_request(lambda exc: teardowns.append(exc))
+        self.section.get_question_ids.return_value = ['pricingDocumentURL', 'termsAndConditionsDocumentURL']
+        saves = []
+
+        def save(path, file, **kwargs):
+            saves.append((file.read(), RequestIdFilter().request_id, has_app_context()))
+        self.uploader.save.side_effect = save
+
+        with app.test_request_context('/', method='POST', headers={'DM-Request-ID': 'request-id'}, data={
+            'pricingDocumentURL': (io.BytesIO(b'%PDF-1.4 pricing'), 'q1.pdf'),
+            'termsAndConditionsDocumentURL': (io.BytesIO(b'%PDF-1.4 terms'), 'q2.pdf'),
+        }):
+            files, errors = upload_service_documents(
+                self.uploader, self.documents_url, self.service,
+                request.files, self.section)
+
+            assert errors == {}
+            assert sorted(saves) == [
+                (b'%PDF-1.4 pricing', 'request-id', True),
+                (b'%PDF-1.4 terms', 'request-id', True),
+            ]
+            # the request and its files are still open for the rest of the view
+            assert teardowns == []
+            request.files['pricingDocumentURL'].seek(0)
+            assert request.files['pricingDocumentURL'].read() == b'%PDF-1.4 pricing'
+
+    def test_upload_service_documents_reports_failed_fields(self):
+        self.section.get_question_ids.return_value = ['pricingDocumentURL', 'termsAndConditionsDocumentURL']
+        request_files = {
+            'pricingDocumentURL': mock_file('q1.pdf', 100),
+            'termsAndConditionsDocumentURL': mock_file('q2.pdf', 100),
+        }
+
+        def save(path, file, **kwargs):
+            if 'pricing' in path:
+                raise S3ResponseError(500, 'Internal Error')
+        self.uploader.save.side_effect = save
+
+        with freeze_time('2015-10-04 14:36:05'):
+            files, errors = upload_service_documents(
+                self.uploader, self.documents_url, self.service,
+                request_files, self.section)
+
+        assert files['termsAndConditionsDocumentURL'] == \
+            'http://localhost/g-cloud-7/documents/12345/654321-terms-and-conditions-2015-10-04-1436.pdf'
+        assert errors == {'pricingDocumentURL': 'file_can_be_saved'}
+
     def test_empty_files_are_filtered(self):
         request_files = {'pricingDocumentURL': mock_file('q1.pdf', 0)}
 
@@ -300,6 +432,246 @@ class TestUploadServiceDocuments(object):
         assert 'pricingDocumentURL' in errors
 
 
+def make_zip(*entries):
+    contents = io.BytesIO()
+    with zipfile.ZipFile(contents, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in entries:
+            archive.writestr(zipfile.ZipInfo(name), data)
+    return contents.getvalue()
+
+
+def sniffable_file(filename, contents):
+    file = io.BytesIO(contents)
+    file.filename = filename
+    return file
+
+
+@pytest.mark.parametrize('contents,expected', [
+    (b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n', 'pdf'),
+    (b'\r\n%PDF-1.7\n', 'pdf'),
+    (make_zip(('mimetype', b'application/vnd.oasis.opendocument.text'), ('content.xml', b'<xml/>')), 'odf'),
+    (make_zip(('content.xml', b'<xml/>')), 'zip'),
+    (make_zip(), 'zip'),
+    (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR', 'png'),
+    (b'\xff\xd8\xff\xe0\x00\x10JFIF', 'jpeg'),
+    (b'name,price\nKev,1.50\n', 'csv'),
+    (u'name;price\nCaf\xe9,1\n'.encode('utf-8'), 'csv'),
+    (b'a,b\n' + u'\xe9'.encode('utf-8') * 2046, 'csv'),  # header ends part way through a character
+    (b'just some text\n', 'text'),
+    (b'a,b\n\x00\x01', None),
+    (b'', None),
+])
+def test_sniff_document_type(contents, expected):
+    file = sniffable_file('file', contents)
+
+    assert sniff_document_type(file) == expected
+    assert file.tell() == 0
+
+
+def test_sniff_document_type_reads_header_once():
+    file = mock.MagicMock(wraps=io.BytesIO(b'\x00' * 10000))
+
+    assert sniff_document_type(file) is None
+    assert sniff_document_type(file) is None
+    file.read.assert_called_once_with(4096)
+
+
+@pytest.mark.parametrize('filename,contents,expected', [
+    ('file.pdf', b'%PDF-1.4\n', True),
+    ('file.pdf', b'\x89PNG\r\n\x1a\n', False),
+    ('file.odt', make_zip(('mimetype', b'application/vnd.oasis.opendocument.text')), True),
+    ('file.odt', make_zip(('word/document.xml', b'<xml/>')), False),
+    ('file.zip', make_zip(('mimetype', b'application/vnd.oasis.opendocument.text')), True),
+    ('file.csv', b'a,b\n1,2\n', True),
+    ('file.csv', b'email\none@example.com\ntwo@example.com\n', True),  # a single column
+    ('file.csv', b'\x89PNG\r\n\x1a\n', False),
+    ('file.pdf', b'just some text\n', False),
+    ('file.jpg', b'\xff\xd8\xff\xe0', True),
+    ('file.doc', b'\xd0\xcf\x11\xe0', False),
+])
+def test_file_content_matches_extension(filename, contents, expected):
+    assert file_content_matches_extension(sniffable_file(filename, contents)) == expected
+
+
+def test_validate_documents_sniffs_content():
+    files = {
+        'file1': sniffable_file('file1.pdf', b'%PDF-1.4\n'),
+        'file2': sniffable_file('file2.pdf', b'\xff\xd8\xff\xe0'),
+    }
+
+    assert validate_documents(files) == {}
+    assert validate_documents(files, sniff_content=True) == {'file2': 'file_is_open_document_format'}
+
+
+class TestDocumentsZip(object):
+    paths = [
+        'g-cloud-7/agreements/1234/1234-signed-framework-agreement.pdf',
+        'g-cloud-7/agreements/1234/1234-signature-page.pdf',
+        'g-cloud-7/agreements/1234/1234-result-letter.pdf',
+    ]
+
+    @pytest.fixture(autouse=True)
+    def s3(self, tmpdir):
+        self.s3 = LocalS3('test-bucket', str(tmpdir.join('s3')))
+        for path in self.paths:
+            self.s3.save(path, io.BytesIO(path.encode('utf-8') * 1000))
+
+    def test_iter_documents_zip(self):
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(iter_documents_zip(self.s3, self.paths, chunk_size=1000))))
+
+        assert archive.namelist() == [path.split('/')[-1] for path in self.paths]
+        for path in self.paths:
+            assert archive.read(path.split('/')[-1]) == path.encode('utf-8') * 1000
+
+    def test_iter_documents_zip_gives_duplicate_file_names_a_suffix(self):
+        paths = [
+            'g-cloud-7/agreements/1234/result-letter.pdf',
+            'g-cloud-7/agreements/5678/result-letter.pdf',
+            'g-cloud-7/agreements/9012/Result-Letter.pdf',
+            'g-cloud-7/agreements/3456/result-letter-2.pdf',
+        ]
+        for path in paths:
+            self.s3.save(path, io.BytesIO(path.encode('utf-8')))
+
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(iter_documents_zip(self.s3, paths))))
+
+        assert archive.namelist() == [
+            'result-letter.pdf', 'result-letter-2.pdf', 'Result-Letter-3.pdf', 'result-letter-2-2.pdf',
+        ]
+        assert archive.read('result-letter-2.pdf') == paths[1].encode('utf-8')
+        assert archive.read('result-letter-2-2.pdf') == paths[3].encode('utf-8')
+
+    def test_iter_documents_zip_leaves_out_missing_files(self):
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(
+            iter_documents_zip(self.s3, ['g-cloud-7/agreements/1234/1234-missing.pdf'] + self.paths))))
+
+        assert len(archive.namelist()) == 3
+
+    def test_iter_documents_zip_reads_ahead(self):
+        request_count = self.s3.bucket.request_count
+        chunks = iter_documents_zip(self.s3, self.paths + ['g-cloud-7/agreements/1234/1234-other.pdf'], read_ahead=1)
+        next(chunks)
+        chunks.close()
+
+        # one object being written and one opened ahead of it
+        assert self.s3.bucket.request_count == request_count + 2
+
+    def test_iter_documents_zip_closes_keys_opened_ahead(self):
+        s3 = mock.Mock()
+        keys = [mock.Mock(last_modified=None, **{'read.return_value': b''}) for path in self.paths]
+        s3.open.side_effect = keys
+
+        chunks = iter_documents_zip(s3, self.paths, read_ahead=2)
+        next(chunks)
+        chunks.close()
+
+        assert keys[1].close.called
+        assert keys[2].close.called
+
+    def test_documents_zip_response(self):
+        response = documents_zip_response(self.s3, self.paths, 'agreements.zip')
+
+        assert response.mimetype == 'application/zip'
+        assert response.headers['Content-Disposition'] == 'attachment; filename="agreements.zip"'
+        assert response.is_streamed
+        assert len(zipfile.ZipFile(io.BytesIO(response.get_data())).namelist()) == 3
+
+
+class TestAuditFrameworkDocuments(object):
+    @pytest.fixture(autouse=True)
+    def s3(self, tmpdir):
+        self.s3 = LocalS3('test-bucket', str(tmpdir.join('s3')))
+        with freeze_time('2016-01-01 12:00:00'):
+            for path in [
+                'g-cloud-7/agreements/1234/1234-signed-framework-agreement.pdf',
+                'g-cloud-7/agreements/1234/1234-result-letter.pdf',
+                'g-cloud-7/agreements/5678/5678-result-letter.pdf',
+                'g-cloud-7/agreements/5678/OLD-5678-countersigned-framework-agreement.pdf',
+                'g-cloud-8/agreements/5678/5678-signed-framework-agreement.pdf',
+            ]:
+                self.s3.save(path, io.BytesIO(b'document'))
+        with freeze_time('2016-02-01 12:00:00'):
+            self.s3.save('g-cloud-7/agreements/1234/1234-signed-framework-agreement.jpg', io.BytesIO(b'document'))
+            self.s3.save('g-cloud-7/agreements/1234/1234-countersigned-framework-agreement.pdf',
+                         io.BytesIO(b'document'))
+
+    def statuses(self, results):
+        return [(result['supplier_code'], result['document'], result['status']) for result in results]
+
+    def test_audit_framework_documents(self):
+        request_count = self.s3.bucket.request_count
+        results = list(audit_framework_documents(self.s3, 'g-cloud-7', [1234, 5678, 9999]))
+
+        assert self.s3.bucket.request_count == request_count + 1
+        assert self.statuses(results) == [
+            (1234, 'signed-framework-agreement', 'present'),
+            (1234, 'countersigned-framework-agreement.pdf', 'present'),
+            (1234, 'result-letter.pdf', 'present'),
+            (5678, 'signed-framework-agreement', 'missing'),
+            (5678, 'countersigned-framework-agreement.pdf', 'missing'),
+            (5678, 'result-letter.pdf', 'present'),
+            (9999, 'signed-framework-agreement', 'missing'),
+            (9999, 'countersigned-framework-agreement.pdf', 'missing'),
+            (9999, 'result-letter.pdf', 'missing'),
+        ]
+        assert results[0]['path'] == 'g-cloud-7/agreements/1234/1234-signed-framework-agreement.jpg'
+        assert results[0]['last_modified'].startswith('2016-02-01T12:00:00')
+        assert results[3]['path'] is None
+
+    def test_audit_framework_documents_finds_stale_documents(self):
+        results = audit_framework_documents(
+            self.s3, 'g-cloud-7', ['1234'], stale_before=datetime.datetime(2016, 1, 15))
+
+        assert self.statuses(results) == [
+            ('1234', 'signed-framework-agreement', 'present'),
+            ('1234', 'countersigned-framework-agreement.pdf', 'present'),
+            ('1234', 'result-letter.pdf', 'stale'),
+        ]
+
+    def test_audit_framework_documents_defaults_to_suppliers_with_documents(self):
+        results = audit_framework_documents(self.s3, 'g-cloud-7', documents=['result-letter.pdf'])
+
+        assert self.statuses(results) == [
+            (u'1234', 'result-letter.pdf', 'present'),
+            (u'5678', 'result-letter.pdf', 'present'),
+        ]
+
+    def test_iter_audit_csv(self):
+        results = audit_framework_documents(self.s3, 'g-cloud-7', [5678], documents=['result-letter.pdf', 'x.pdf'])
+        lines = list(iter_audit_csv(results))
+
+        assert lines[0] == 'supplier_code,document,status,path,last_modified\r\n'
+        assert lines[1].startswith(
+            '5678,result-letter.pdf,present,g-cloud-7/agreements/5678/5678-result-letter.pdf,2016-01-01T12:00:00')
+        assert lines[2] == '5678,x.pdf,missing,,\r\n'
+
+    def test_iter_audit_csv_with_non_ascii_values(self):
+        results = [{
+            'supplier_code': 5678,
+            'document': u'signed-framework-agreement',
+            'status': 'present',
+            'path': u'g-cloud-7/agreements/5678/5678-signed-framework-agreement-Café_Ltd.pdf',
+            'last_modified': u'2016-01-01T12:00:00.000000Z',
+        }]
+        lines = list(iter_audit_csv(results))
+
+        expected = (u'5678,signed-framework-agreement,present,'
+                    u'g-cloud-7/agreements/5678/5678-signed-framework-agreement-Café_Ltd.pdf,'
+                    u'2016-01-01T12:00:00.000000Z\r\n')
+        assert lines[1] == (expected.encode('utf-8') if six.PY2 else expected)
+
+    def test_iter_audit_json(self):
+        results = audit_framework_documents(self.s3, 'g-cloud-7', [5678, 9999], documents=['x.pdf'])
+
+        assert json.loads(''.join(iter_audit_json(results))) == [
+            {'supplier_code': 5678, 'document': 'x.pdf', 'status': 'missing', 'path': None, 'last_modified': None},
+            {'supplier_code': 9999, 'document': 'x.pdf', 'status': 'missing', 'path': None, 'last_modified': None},
+        ]
+
+    def test_iter_audit_json_with_no_results(self):
+        assert json.loads(''.join(iter_audit_json([]))) == []
+
+
 @pytest.mark.parametrize('base_url,expected', [
     ('http://other', 'http://other/foo?after'),
     (None, 'http://example/foo?after'),
@@ -333,3 +705,8 @@ def test_sanitise_supplier_name():
     assert sanitise_supplier_name(u'\ / : * ? \' " < > |') == '_'
     assert sanitise_supplier_name(u'kev@the*agency') == 'kevtheagency'
     assert sanitise_supplier_name(u"Ψ is a silly character") == "is_a_silly_character"
+    assert sanitise_supplier_name(u'Kev _&_ . _Sons') == 'Kev_and_Sons'
+
+
+def test_sanitise_supplier_names():
+    assert sanitise_supplier_names([u'Kev\'s Butties', u'Kev & Sons. | Ltd']) == ['Kevs_Butties', 'Kev_and_Sons_Ltd']
@@ -4,25 +4,34 @@ import pytest
 import mock
 import six
 
+import boto3
+import botocore.exceptions
 from botocore.exceptions import ClientError
 from datetime import datetime
 
 from dmutils.config import init_app
 from dmutils.email import (
     generate_token, decode_token, send_email, EmailError, hash_email, decode_invitation_token,
-    decode_password_reset_token, parse_fernet_timestamp, InvalidToken)
+    decode_password_reset_token, parse_fernet_timestamp, InvalidToken, get_ses_client, reset_ses_clients,
+    send_bulk_email, drain_email_outbox, decode_token_with_timestamp, get_fernet,
+    generate_tokens, decode_tokens)
+from dmutils import metrics
+from dmutils.outbox import Outbox
 from dmutils.formats import DATETIME_FORMAT
 from .test_user import user_json
 
 TEST_SECRET_KEY = 'TestKeyTestKeyTestKeyTestKeyTestKeyTestKeyX='
+OLD_TEST_SECRET_KEY = 'OldKeyOldKeyOldKeyOldKeyOldKeyOldKeyOldKeyX='
 TEST_ARCHIVE_ADDRESS = 'marketplace+archive@digital.gov.au'
 
 
 @pytest.yield_fixture
 def email_client():
+    reset_ses_clients()
     with mock.patch('boto3.client') as boto_client:
         instance = boto_client.return_value
         yield instance
+    reset_ses_clients()
 
 
 @pytest.yield_fixture
@@ -108,6 +117,252 @@ def test_should_throw_exception_if_email_client_fails(email_app, email_client):
             )
 
 
+def test_send_email_reuses_ses_client(email_app, email_client):
+    with email_app.app_context():
+        send_email("email_address", "body", "subject", "from_email", "from_name")
+        send_email("email_address", "body", "subject", "from_email", "from_name")
+
+    assert boto3.client.call_count == 1
+    assert email_client.send_email.call_count == 2
+
+
+def test_send_email_records_latency(email_app, email_client, cloudwatch):
+    metrics.flask_client().init_app(email_app)
+    with email_app.app_context():
+        send_email("email_address", "body", "subject", "from_email", "from_name")
+        send_email("email_address", "body", "subject", "from_email", "from_name")
+
+    assert cloudwatch.put_metric_data.call_count == 0
+
+    metrics.flush_shared_clients()
+
+    assert cloudwatch.put_metric_data.call_count == 1
+    args, kwargs = cloudwatch.put_metric_data.call_args
+    assert kwargs['name'] == 'email.send.latency'
+    assert kwargs['unit'] == 'Milliseconds'
+    assert kwargs['statistics']['samplecount'] == 2
+
+
+def test_send_email_does_not_raise_metrics_errors(email_app, email_client, cloudwatch):
+    metrics.flask_client().init_app(email_app)
+    email_client.send_email.return_value = ses_response('id')
+    cloudwatch.put_metric_data.side_effect = Exception('CloudWatch is down')
+    with email_app.app_context():
+        send_email("email_address", "body", "subject", "from_email", "from_name")
+
+    assert email_client.send_email.call_count == 1
+
+
+def test_get_ses_client_is_cached_by_region_and_credentials(email_client):
+    with mock.patch('boto3.client', side_effect=lambda *args, **kwargs: mock.Mock()) as boto_client:
+        assert get_ses_client('eu-west-1') is get_ses_client('eu-west-1')
+        assert get_ses_client('eu-west-1') is not get_ses_client('us-east-1')
+        assert get_ses_client('eu-west-1', 'key', 'secret') is not get_ses_client('eu-west-1')
+
+    boto_client.assert_any_call('ses', region_name='eu-west-1', aws_access_key_id='key',
+                                aws_secret_access_key='secret')
+    assert boto_client.call_count == 3
+
+
+def test_get_ses_client_is_recreated_after_fork(email_client):
+    with mock.patch('boto3.client', side_effect=lambda *args, **kwargs: mock.Mock()):
+        client = get_ses_client()
+        with mock.patch('dmutils.email.os.getpid', return_value=-1):
+            assert get_ses_client() is not client
+
+
+def bulk_message(to_email_address):
+    return {
+        'to_email_address': to_email_address,
+        'email_body': 'body',
+        'subject': 'subject',
+        'from_email': 'from_email',
+        'from_name': 'from_name',
+    }
+
+
+def ses_response(request_id):
+    return {'ResponseMetadata': {'RequestId': request_id}}
+
+
+def ses_error(code, message):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, 'SendEmail')
+
+
+def test_send_bulk_email_dedupes_recipients(email_app, email_client):
+    email_client.send_email.side_effect = lambda **kwargs: ses_response(kwargs['Destination']['ToAddresses'][0])
+    with email_app.app_context():
+        results = send_bulk_email(
+            [bulk_message('one@example.com'), bulk_message('two@example.com'), bulk_message(' ONE@example.com')],
+            max_send_rate=100)
+
+    assert email_client.send_email.call_count == 2
+    assert [result['status'] for result in results] == ['sent', 'sent', 'duplicate']
+    assert [result['id'] for result in results] == ['one@example.com', 'two@example.com', None]
+    assert results[0]['email_hash'] == hash_email('one@example.com')
+
+
+@mock.patch('dmutils.retry.time.sleep')
+def test_send_bulk_email_retries_throttled_messages(sleep, email_app, email_client):
+    email_client.send_email.side_effect = [
+        ses_error('Throttling', 'Maximum sending rate exceeded.'),
+        ses_response('id'),
+    ]
+    with email_app.app_context():
+        results = send_bulk_email([bulk_message('one@example.com')], max_send_rate=100)
+
+    assert email_client.send_email.call_count == 2
+    assert sleep.call_count == 1
+    assert results[0]['status'] == 'sent'
+
+
+def test_send_bulk_email_returns_failures(email_app, email_client):
+    email_client.send_email.side_effect = [
+        ses_error('Throttling', 'Daily message quota exceeded.'),
+        ses_error('MessageRejected', 'Email address is not verified.'),
+    ]
+    with email_app.app_context():
+        results = send_bulk_email([bulk_message('one@example.com'), bulk_message('two@example.com')],
+                                  max_workers=1, max_send_rate=100)
+
+    assert email_client.send_email.call_count == 2
+    assert [result['status'] for result in results] == ['failed', 'failed']
+    assert isinstance(results[0]['error'], EmailError)
+
+
+def test_send_bulk_email_returns_connection_errors(email_app, email_client):
+    email_client.send_email.side_effect = [
+        botocore.exceptions.EndpointConnectionError(endpoint_url='https://email.eu-west-1.amazonaws.com'),
+        ses_response('id'),
+    ]
+    with email_app.app_context():
+        results = send_bulk_email([bulk_message('one@example.com'), bulk_message('two@example.com')],
+                                  max_workers=1, max_send_rate=100)
+
+    assert [result['status'] for result in results] == ['failed', 'sent']
+    assert 'Could not connect' in str(results[0]['error'])
+
+
+def test_send_bulk_email_publishes_latency_once_per_batch(email_app, email_client, cloudwatch):
+    metrics.flask_client().init_app(email_app)
+    email_client.send_email.return_value = ses_response('id')
+    with email_app.app_context():
+        send_bulk_email([bulk_message('one@example.com'), bulk_message('two@example.com')], max_send_rate=100)
+
+    assert cloudwatch.put_metric_data.call_count == 1
+    args, kwargs = cloudwatch.put_metric_data.call_args
+    assert kwargs['name'] == 'email.send.latency'
+    assert kwargs['statistics']['samplecount'] == 2
+    # every message's app context uses the same connection
+    assert metrics.connect_to_region.call_count == 1
+
+
+def test_send_bulk_email_does_not_raise_metrics_errors(email_app, email_client, cloudwatch):
+    metrics.flask_client().init_app(email_app)
+    email_client.send_email.return_value = ses_response('id')
+    cloudwatch.put_metric_data.side_effect = Exception('CloudWatch is down')
+    with email_app.app_context():
+        results = send_bulk_email([bulk_message('one@example.com')], max_send_rate=100)
+
+    assert results[0]['status'] == 'sent'
+
+
+def test_send_bulk_email_uses_account_send_rate(email_app, email_client):
+    email_client.get_send_quota.return_value = {'MaxSendRate': 14.0, 'Max24HourSend': 50000.0}
+    email_client.send_email.return_value = ses_response('id')
+    with email_app.app_context():
+        with mock.patch('dmutils.email.TokenBucket') as token_bucket:
+            send_bulk_email([bulk_message('one@example.com')])
+
+    token_bucket.assert_called_once_with(14.0, capacity=14.0)
+    # the archive address is a second recipient of each message
+    token_bucket.return_value.acquire.assert_called_once_with(2)
+
+
+@mock.patch('dmutils.retry.time.sleep')
+@mock.patch('dmutils.retry.monotonic', return_value=100.0)
+def test_send_bulk_email_at_sandbox_send_rate(monotonic, sleep, email_app, email_client):
+    def wait(seconds):
+        monotonic.return_value += seconds
+    sleep.side_effect = wait
+    email_client.get_send_quota.return_value = {'MaxSendRate': 1.0, 'Max24HourSend': 200.0}
+    email_client.send_email.return_value = ses_response('id')
+    with email_app.app_context():
+        results = send_bulk_email([bulk_message('one@example.com'), bulk_message('two@example.com')],
+                                  max_workers=1)
+
+    assert [result['status'] for result in results] == ['sent', 'sent']
+    # the second message waits for its own and its archive copy's tokens
+    sleep.assert_called_once_with(2.0)
+
+
+def test_send_bulk_email_to_stderr(email_app, email_client):
+    email_app.config['DM_SEND_EMAIL_TO_STDERR'] = True
+    with email_app.app_context():
+        with mock.patch('sys.stderr') as stderr:
+            results = send_bulk_email([bulk_message('one@example.com'), bulk_message('one@example.com')])
+
+    assert stderr.write.call_count == 1
+    assert not email_client.send_email.called
+    assert [result['status'] for result in results] == ['sent', 'duplicate']
+
+
+@pytest.fixture
+def outbox_app(email_app, tmpdir):
+    email_app.config['DM_EMAIL_OUTBOX_DIR'] = str(tmpdir.join('outbox'))
+    return email_app
+
+
+def test_send_email_queues_email_in_outbox(outbox_app, email_client):
+    with outbox_app.app_context():
+        send_email("email_address", "body", "subject", "from_email", "from_name")
+
+    assert not email_client.send_email.called
+    assert Outbox(outbox_app.config['DM_EMAIL_OUTBOX_DIR']).stats()['depth'] == 1
+
+
+def test_drain_email_outbox_sends_queued_email(outbox_app, email_client):
+    email_client.send_email.return_value = ses_response('id')
+    with outbox_app.app_context():
+        send_email("email_address", "body", "subject", "from_email", "from_name")
+        counts = drain_email_outbox()
+
+    assert counts == {'sent': 1, 'retried': 0, 'failed': 0}
+    email_client.send_email.assert_called_once_with(
+        ReplyToAddresses=['from_email'],
+        Message={'Body': {'Html': {'Charset': 'UTF-8', 'Data': 'body'}},
+                 'Subject': {'Charset': 'UTF-8', 'Data': 'subject'}},
+        Destination={'ToAddresses': ['email_address'], 'BccAddresses': [TEST_ARCHIVE_ADDRESS]},
+        Source=u'from_name <from_email>'
+    )
+
+
+def test_drain_email_outbox_retries_throttled_email(outbox_app, email_client):
+    email_client.send_email.side_effect = ses_error('Throttling', 'Maximum sending rate exceeded.')
+    with outbox_app.app_context():
+        send_email("email_address", "body", "subject", "from_email", "from_name")
+        assert drain_email_outbox() == {'sent': 0, 'retried': 1, 'failed': 0}
+
+
+def test_drain_email_outbox_does_not_retry_rejected_email(outbox_app, email_client):
+    email_client.send_email.side_effect = ses_error('MessageRejected', 'Email address is not verified.')
+    with outbox_app.app_context():
+        send_email("email_address", "body", "subject", "from_email", "from_name")
+        assert drain_email_outbox() == {'sent': 0, 'retried': 0, 'failed': 1}
+
+
+def test_drain_email_outbox_records_outbox_metrics(outbox_app, email_client, cloudwatch):
+    metrics.flask_client().init_app(outbox_app)
+    email_client.send_email.side_effect = ses_error('Throttling', 'Maximum sending rate exceeded.')
+    with outbox_app.app_context():
+        send_email("email_address", "body", "subject", "from_email", "from_name")
+    drain_email_outbox(outbox_app)
+
+    gauges = {kwargs['name']: kwargs for args, kwargs in cloudwatch.put_metric_data.call_args_list}
+    assert gauges['email.outbox.depth']['value'] == 1
+    assert gauges['email.outbox.age']['unit'] == 'Seconds'
+
+
 def test_can_generate_token():
     token = generate_token({
         "key1": "value1",
@@ -130,6 +385,57 @@ def test_parse_timestamp_from_token():
     assert timestamp == test_time
 
 
+def test_decode_token_with_timestamp():
+    test_time = datetime(2000, 1, 1)
+    with freeze_time(test_time):
+        token = generate_token({"key1": "value1"}, TEST_SECRET_KEY, 'PassSalt')
+        assert decode_token_with_timestamp(token, TEST_SECRET_KEY, 'PassSalt') == ({"key1": "value1"}, test_time)
+
+
+def test_get_fernet_is_cached():
+    assert get_fernet(TEST_SECRET_KEY) is get_fernet(TEST_SECRET_KEY)
+    assert get_fernet([TEST_SECRET_KEY, OLD_TEST_SECRET_KEY]) is get_fernet((TEST_SECRET_KEY, OLD_TEST_SECRET_KEY))
+    assert get_fernet([TEST_SECRET_KEY]) is not get_fernet([TEST_SECRET_KEY, OLD_TEST_SECRET_KEY])
+
+
+def test_can_decode_token_made_with_previous_key():
+    token = generate_token({"key1": "value1"}, OLD_TEST_SECRET_KEY, '1234567890')
+
+    assert decode_token(token, [TEST_SECRET_KEY, OLD_TEST_SECRET_KEY], '1234567890') == {"key1": "value1"}
+
+
+def test_generate_token_uses_first_key():
+    token = generate_token({"key1": "value1"}, [TEST_SECRET_KEY, OLD_TEST_SECRET_KEY], '1234567890')
+
+    assert decode_token(token, TEST_SECRET_KEY, '1234567890') == {"key1": "value1"}
+    with pytest.raises(InvalidToken):
+        decode_token(token, OLD_TEST_SECRET_KEY, '1234567890')
+
+
+def test_generate_tokens():
+    results = generate_tokens([{"n": 1}, {"n": object()}, {"n": 3}], TEST_SECRET_KEY, '1234567890')
+
+    assert decode_token(results[0]['token'], TEST_SECRET_KEY, '1234567890') == {"n": 1}
+    assert results[1]['token'] is None
+    assert isinstance(results[1]['error'], TypeError)
+    assert decode_token(results[2]['token'], TEST_SECRET_KEY, '1234567890') == {"n": 3}
+
+
+def test_decode_tokens_returns_errors_for_bad_tokens():
+    test_time = datetime(2000, 1, 1)
+    with freeze_time(test_time):
+        tokens = [
+            generate_token({"n": 1}, TEST_SECRET_KEY, '1234567890'),
+            generate_token({"n": 2}, TEST_SECRET_KEY, 'wrong salt'),
+            'not a token',
+        ]
+        results = decode_tokens(tokens, TEST_SECRET_KEY, '1234567890')
+
+    assert results[0] == {'data': {"n": 1}, 'timestamp': test_time, 'error': None}
+    assert [result['data'] for result in results[1:]] == [None, None]
+    assert [type(result['error']) for result in results[1:]] == [InvalidToken, InvalidToken]
+
+
 def test_cant_decode_token_with_wrong_salt():
     token = generate_token({
         "key1": "value1",
@@ -173,6 +479,19 @@ def test_decode_password_reset_token_ok_for_good_token(email_app):
         assert decode_password_reset_token(token, data_api_client) == data
 
 
+def test_decode_password_reset_token_uses_secret_keys_for_rotation(email_app):
+    user = user_json()
+    user['users']['passwordChangedAt'] = "2016-01-01T12:00:00.30Z"
+    data_api_client = mock.Mock()
+    data_api_client.get_user.return_value = user
+    email_app.config['SECRET_KEY'] = 'NewKeyNewKeyNewKeyNewKeyNewKeyNewKeyNewKeyX='
+    email_app.config['SECRET_KEYS'] = [email_app.config['SECRET_KEY'], TEST_SECRET_KEY]
+    with email_app.app_context():
+        data = {'user': 'test@example.com'}
+        token = generate_token(data, TEST_SECRET_KEY, 'PassSalt')
+        assert decode_password_reset_token(token, data_api_client) == data
+
+
 def test_decode_password_reset_token_does_not_work_if_bad_token(email_app):
     user = user_json()
     user['users']['passwordChangedAt'] = "2016-01-01T12:00:00.30Z"
@@ -0,0 +1,42 @@
+import os
+
+import mock
+import pytest
+
+from dmutils.files import atomic_write
+
+
+def test_atomic_write(tmpdir):
+    path = str(tmpdir.join('file.txt'))
+
+    with atomic_write(path, 'w') as f:
+        f.write('contents')
+        assert not os.path.exists(path)
+
+    with open(path) as f:
+        assert f.read() == 'contents'
+    assert os.listdir(str(tmpdir)) == ['file.txt']
+
+
+def test_atomic_write_error_keeps_old_file(tmpdir):
+    path = str(tmpdir.join('file.txt'))
+    tmpdir.join('file.txt').write('old')
+
+    with pytest.raises(ValueError):
+        with atomic_write(path, 'w') as f:
+            f.write('new')
+            raise ValueError()
+
+    assert tmpdir.join('file.txt').read() == 'old'
+    assert os.listdir(str(tmpdir)) == ['file.txt']
+
+
+def test_atomic_write_fsync(tmpdir):
+    path = str(tmpdir.join('file.txt'))
+
+    with mock.patch('dmutils.files.os.fsync') as fsync:
+        with atomic_write(path, 'w', fsync=True) as f:
+            f.write('contents')
+
+    assert fsync.call_count == 1
+    assert tmpdir.join('file.txt').read() == 'contents'
@@ -41,3 +41,28 @@ class TestInitManager(BaseApplicationTest):
 
     def test_init_manager(self):
         manager = init_manager(self.flask, 5000, [])
+
+
+class TestContentLengthLimitInit(BaseApplicationTest):
+
+    def setup(self):
+        self.config = Config()
+        self.config.DM_HTTP_PROTO = 'http'
+        self.config.URL_PREFIX = ''
+        self.config.DM_MAX_CONTENT_LENGTH = 10
+        super(TestContentLengthLimitInit, self).setup()
+
+        @self.flask.route('/upload', methods=['POST'])
+        def upload():
+            return 'uploaded'
+
+    def test_rejects_oversized_body(self):
+        response = self.app.post('/upload', data=b'*' * 11)
+
+        assert response.status_code == 413
+
+    def test_allows_body_up_to_limit(self):
+        response = self.app.post('/upload', data=b'*' * 10)
+
+        assert response.status_code == 200
+        assert 'DM-Request-ID' in response.headers
@@ -8,7 +8,7 @@ except ImportError:
 import json
 
 from dmutils import request_id
-from dmutils.logging import init_app, RequestIdFilter, JSONFormatter, CustomLogFormatter
+from dmutils.logging import init_app, RequestIdFilter, JSONFormatter, CustomLogFormatter, request_id_context
 from dmutils.logging import LOG_FORMAT, TIME_FORMAT
 
 
@@ -16,6 +16,12 @@ def test_request_id_filter_not_in_app_context():
     assert RequestIdFilter().request_id == 'no-request-id'
 
 
+def test_request_id_filter_uses_thread_request_id_outside_request_context():
+    with request_id_context('thread-request-id'):
+        assert RequestIdFilter().request_id == 'thread-request-id'
+    assert RequestIdFilter().request_id == 'no-request-id'
+
+
 def test_formatter_request_id(app_with_logging):
     headers = {'DM-Request-Id': 'generated'}
     request_id.init_app(app_with_logging)  # set CustomRequest class
@@ -46,6 +46,70 @@ def test_timer(cloudwatch):
     assert kwargs['unit'] == "Milliseconds"
 
 
+def test_gauge(cloudwatch):
+    client = metrics.client("myregion", "mynamespace")
+    client.gauge("depth", 3)
+
+    args, kwargs = cloudwatch.put_metric_data.call_args
+    assert kwargs['name'] == "depth"
+    assert kwargs['value'] == 3
+    assert kwargs['unit'] == "Count"
+
+
+def test_buffer_publishes_statistic_set_on_flush(cloudwatch):
+    client = metrics.client("myregion", "mynamespace")
+    buffer = client.buffer("latency", "Milliseconds")
+    for value in (30, 10, 20):
+        buffer.add(value)
+
+    assert client.buffer("latency", "Milliseconds") is buffer
+    assert not cloudwatch.put_metric_data.called
+
+    client.flush()
+    client.flush()
+
+    assert cloudwatch.put_metric_data.call_count == 1
+    args, kwargs = cloudwatch.put_metric_data.call_args
+    assert kwargs['name'] == "latency"
+    assert kwargs['value'] is None
+    assert kwargs['unit'] == "Milliseconds"
+    assert kwargs['statistics'] == {'samplecount': 3, 'sum': 60, 'minimum': 10, 'maximum': 30}
+
+
+def test_shared_client_is_cached_by_settings(cloudwatch):
+    client = metrics.shared_client("myregion", "mynamespace", {"applicationName": "app"})
+
+    assert metrics.shared_client("myregion", "mynamespace", {"applicationName": "app"}) is client
+    assert metrics.shared_client("myregion", "mynamespace", {"applicationName": "other"}) is not client
+    assert metrics.shared_client("otherregion", "mynamespace", {"applicationName": "app"}) is not client
+
+
+def test_shared_client_is_recreated_after_fork(cloudwatch):
+    client = metrics.shared_client("myregion", "mynamespace")
+    with mock.patch('dmutils.metrics.os.getpid', return_value=-1):
+        assert metrics.shared_client("myregion", "mynamespace") is not client
+
+
+def test_flush_shared_clients(cloudwatch):
+    metrics.shared_client("myregion", "mynamespace").buffer("latency").add(1)
+    metrics.flush_shared_clients()
+
+    args, kwargs = cloudwatch.put_metric_data.call_args
+    assert kwargs['statistics']['samplecount'] == 1
+
+
+def test_metrics_flusher_flushes_until_stopped():
+    flush = mock.Mock(side_effect=[Exception('CloudWatch is down'), None, None])
+    flusher = metrics.MetricsFlusher(flush, interval=0.01)
+    flusher.start()
+    while flush.call_count < 2:
+        pass
+    flusher.stop()
+    flusher.join(1)
+
+    assert not flusher.is_alive()
+
+
 def test_flask_client_returns_none_before_init():
     client = metrics.flask_client()
 
@@ -67,6 +131,16 @@ def test_flask_client_returns_client_when_in_app_context(app, cloudwatch):
         assert isinstance(client.client, metrics.CloudWatchClient)
 
 
+def test_flask_client_reuses_client_across_app_contexts(app, cloudwatch):
+    client = metrics.flask_client()
+    client.init_app(app)
+
+    with app.app_context():
+        first = client.client
+    with app.app_context():
+        assert client.client is first
+
+
 def test_flask_client_adds_application_name_dimension(app, cloudwatch):
     client = metrics.flask_client()
     client.init_app(app)
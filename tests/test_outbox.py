@@ -0,0 +1,138 @@
+import json
+import os
+import time
+import uuid
+
+import mock
+import pytest
+
+from dmutils.outbox import Outbox, OutboxWorker
+
+
+class SendError(Exception):
+    pass
+
+
+@pytest.fixture
+def outbox(tmpdir):
+    return Outbox(str(tmpdir.join('outbox')), max_attempts=3)
+
+
+def test_put_writes_message_and_returns_immediately(outbox):
+    message_id = outbox.put({'to': 'one@example.com'})
+
+    with open(os.path.join(outbox.pending_dir, message_id)) as f:
+        assert json.load(f)['message'] == {'to': 'one@example.com'}
+
+
+def test_drain_sends_messages_oldest_first(outbox):
+    outbox.put({'n': 1})
+    outbox.put({'n': 2})
+    send = mock.Mock()
+
+    assert outbox.drain(send) == {'sent': 2, 'retried': 0, 'failed': 0}
+    assert send.call_args_list == [mock.call({'n': 1}), mock.call({'n': 2})]
+    assert outbox.stats()['depth'] == 0
+    assert os.listdir(outbox.sending_dir) == []
+
+
+def test_drain_retries_failed_message_later(outbox):
+    outbox.put({'n': 1})
+    send = mock.Mock(side_effect=[SendError('SES is down'), None])
+
+    with mock.patch.object(outbox.retry_policy, 'backoff', return_value=60):
+        assert outbox.drain(send) == {'sent': 0, 'retried': 1, 'failed': 0}
+    # not due yet
+    assert outbox.drain(send) == {'sent': 0, 'retried': 0, 'failed': 0}
+    assert send.call_count == 1
+
+    later = time.time() + 120
+    with mock.patch('dmutils.outbox.time.time', return_value=later):
+        assert outbox.drain(send) == {'sent': 1, 'retried': 0, 'failed': 0}
+
+
+def test_drain_gives_up_after_max_attempts(outbox):
+    message_id = outbox.put({'n': 1})
+    send = mock.Mock(side_effect=SendError('SES is down'))
+
+    with mock.patch.object(outbox.retry_policy, 'backoff', return_value=0):
+        for i in range(3):
+            outbox.drain(send)
+
+    assert send.call_count == 3
+    assert os.listdir(outbox.failed_dir) == [message_id]
+    with open(os.path.join(outbox.failed_dir, message_id)) as f:
+        assert json.load(f)['error'] == 'SES is down'
+    assert outbox.stats()['depth'] == 0
+
+
+def test_drain_does_not_retry_permanent_errors(outbox):
+    outbox.put({'n': 1})
+
+    counts = outbox.drain(mock.Mock(side_effect=SendError('rejected')), is_retryable=lambda e: False)
+
+    assert counts == {'sent': 0, 'retried': 0, 'failed': 1}
+
+
+def claim(outbox, message_id, pid):
+    claimed_path = os.path.join(outbox.sending_dir, '{}.{}-{}'.format(message_id, pid, uuid.uuid4().hex))
+    os.rename(os.path.join(outbox.pending_dir, message_id), claimed_path)
+    return claimed_path
+
+
+def test_drain_skips_messages_claimed_by_another_process(outbox):
+    claim(outbox, outbox.put({'n': 1}), os.getppid())
+    send = mock.Mock()
+
+    outbox.drain(send)
+
+    assert not send.called
+    assert outbox.stats()['depth'] == 1
+
+
+def test_drain_recovers_messages_claimed_by_dead_process(outbox):
+    claim(outbox, outbox.put({'n': 1}), 999999999)
+    send = mock.Mock()
+
+    assert outbox.drain(send) == {'sent': 1, 'retried': 0, 'failed': 0}
+    send.assert_called_once_with({'n': 1})
+
+
+def test_drain_recovers_messages_claimed_by_previous_process_with_same_pid(outbox):
+    # e.g. the app restarted in a container, where it is always pid 1
+    claim(outbox, outbox.put({'n': 1}), os.getpid())
+    send = mock.Mock()
+
+    assert outbox.drain(send) == {'sent': 1, 'retried': 0, 'failed': 0}
+    send.assert_called_once_with({'n': 1})
+
+
+def test_drain_recovers_messages_claimed_too_long_ago(outbox):
+    claimed_path = claim(outbox, outbox.put({'n': 1}), os.getppid())
+    claimed_at = time.time() - outbox.claim_timeout - 1
+    os.utime(claimed_path, (claimed_at, claimed_at))
+    send = mock.Mock()
+
+    assert outbox.drain(send) == {'sent': 1, 'retried': 0, 'failed': 0}
+
+
+def test_stats(outbox):
+    assert outbox.stats() == {'depth': 0, 'age': 0}
+
+    with mock.patch('dmutils.outbox.time.time', return_value=1000.0):
+        outbox.put({'n': 1})
+        outbox.put({'n': 2})
+    with mock.patch('dmutils.outbox.time.time', return_value=1060.0):
+        assert outbox.stats() == {'depth': 2, 'age': 60.0}
+
+
+def test_outbox_worker_drains_until_stopped():
+    drain = mock.Mock()
+    worker = OutboxWorker(drain, interval=0.01)
+    worker.start()
+    while drain.call_count < 2:
+        pass
+    worker.stop()
+    worker.join(1)
+
+    assert not worker.is_alive()
@@ -0,0 +1,149 @@
+import threading
+
+import mock
+import pytest
+
+from dmutils.retry import AdaptiveConcurrencyLimiter, RetryBudget, RetryPolicy, TokenBucket
+
+
+class RetryableError(Exception):
+    pass
+
+
+@pytest.yield_fixture
+def sleep():
+    with mock.patch('dmutils.retry.time.sleep') as sleep:
+        yield sleep
+
+
+def is_retryable(e):
+    return isinstance(e, RetryableError)
+
+
+def test_retry_policy_returns_result(sleep):
+    assert RetryPolicy(is_retryable).call(lambda x: x * 2, 2) == 4
+    assert not sleep.called
+
+
+def test_retry_policy_retries_retryable_errors(sleep):
+    fn = mock.Mock(side_effect=[RetryableError(), RetryableError(), 'result'])
+
+    assert RetryPolicy(is_retryable).call(fn, 'arg', kwarg='kwarg') == 'result'
+    fn.assert_called_with('arg', kwarg='kwarg')
+    assert fn.call_count == 3
+    assert sleep.call_count == 2
+
+
+def test_retry_policy_does_not_retry_other_errors(sleep):
+    fn = mock.Mock(side_effect=ValueError())
+
+    with pytest.raises(ValueError):
+        RetryPolicy(is_retryable).call(fn)
+    assert fn.call_count == 1
+
+
+def test_retry_policy_gives_up_after_max_attempts(sleep):
+    fn = mock.Mock(side_effect=RetryableError())
+
+    with pytest.raises(RetryableError):
+        RetryPolicy(is_retryable, max_attempts=3).call(fn)
+    assert fn.call_count == 3
+
+
+def test_retry_policy_backoff_is_jittered_and_capped():
+    policy = RetryPolicy(is_retryable, base_delay=1, max_delay=3)
+
+    with mock.patch('dmutils.retry.random.uniform') as uniform:
+        for attempt in range(1, 5):
+            policy.backoff(attempt)
+
+    assert uniform.call_args_list == [mock.call(0, 1), mock.call(0, 2), mock.call(0, 3), mock.call(0, 3)]
+
+
+def test_retry_policy_stops_when_budget_is_spent(sleep):
+    policy = RetryPolicy(is_retryable, budget=RetryBudget(initial_tokens=1))
+    fn = mock.Mock(side_effect=RetryableError())
+
+    with pytest.raises(RetryableError):
+        policy.call(fn)
+    assert fn.call_count == 2
+
+
+def test_retry_budget_is_refilled_by_successes():
+    budget = RetryBudget(ratio=0.5, initial_tokens=0)
+
+    assert not budget.withdraw()
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+
+def test_limiter_additive_increase():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=2, max_limit=3)
+
+    limiter.on_success()
+    assert limiter.limit == 2.5
+
+    for _ in range(5):
+        limiter.on_success()
+    assert limiter.limit == 3
+
+
+def test_limiter_multiplicative_decrease_once_per_interval():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=8, min_limit=2)
+
+    with mock.patch('dmutils.retry.monotonic', side_effect=[0, 0.5, 2, 4]):
+        limiter.on_throttle()
+        limiter.on_throttle()
+        assert limiter.limit == 4
+        limiter.on_throttle()
+        limiter.on_throttle()
+        assert limiter.limit == 2
+
+
+def test_limiter_blocks_above_limit():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=1)
+    entered = threading.Event()
+
+    def worker():
+        with limiter:
+            entered.set()
+
+    with limiter:
+        thread = threading.Thread(target=worker)
+        thread.start()
+        assert not entered.wait(0.05)
+
+    thread.join(1)
+    assert entered.is_set()
+    assert limiter.in_flight == 0
+
+
+def test_token_bucket_allows_burst_up_to_capacity(sleep):
+    bucket = TokenBucket(rate=2, capacity=3)
+    for i in range(3):
+        bucket.acquire()
+
+    assert not sleep.called
+
+
+def test_token_bucket_waits_for_tokens(sleep):
+    with mock.patch('dmutils.retry.monotonic', return_value=100.0) as monotonic:
+        bucket = TokenBucket(rate=4, capacity=1)
+        bucket.acquire()
+
+        def wait(seconds):
+            monotonic.return_value += seconds
+        sleep.side_effect = wait
+        bucket.acquire(tokens=1)
+
+    sleep.assert_called_once_with(0.25)
+    assert bucket.tokens == 0
+
+
+def test_token_bucket_rejects_acquiring_more_than_capacity(sleep):
+    bucket = TokenBucket(rate=1)
+
+    with pytest.raises(ValueError):
+        bucket.acquire(tokens=2)
@@ -1,4 +1,5 @@
 import unittest
+import io
 import os
 import datetime
 
@@ -6,7 +7,10 @@ import mock
 import pytest
 from freezegun import freeze_time
 from .helpers import mock_file
-from dmutils.s3 import S3, get_file_size_up_to_maximum
+from dmutils.retry import AdaptiveConcurrencyLimiter
+from dmutils.s3 import (
+    S3, S3ResponseError, get_file_size, get_file_size_up_to_maximum, get_content_range_header,
+    parse_timestamp, normalise_timestamp)
 
 
 class TestS3Uploader(unittest.TestCase):
@@ -16,14 +20,68 @@ class TestS3Uploader(unittest.TestCase):
             'dmutils.s3.boto.connect_s3',
             return_value=self.s3_mock
         )
-        self._boto_patch.start()
+        self.connect_s3 = self._boto_patch.start()
 
     def tearDown(self):
         self._boto_patch.stop()
 
     def test_get_bucket(self):
         S3('test-bucket')
-        self.s3_mock.get_bucket.assert_called_with('test-bucket')
+        self.s3_mock.get_bucket.assert_called_once_with('test-bucket', validate=False)
+
+    def test_get_bucket_is_shared(self):
+        assert S3('test-bucket').bucket is S3('test-bucket').bucket
+        S3('test-bucket', host='other-host')
+
+        self.connect_s3.assert_has_calls([
+            mock.call(host='s3-eu-west-1.amazonaws.com'),
+            mock.call(host='other-host'),
+        ])
+        assert self.connect_s3.call_count == 2
+        assert self.s3_mock.get_bucket.call_count == 2
+
+    def test_get_bucket_is_not_shared_between_credentials(self):
+        with mock.patch.dict('os.environ', {'AWS_ACCESS_KEY_ID': 'one', 'AWS_SECRET_ACCESS_KEY': 'secret'}):
+            bucket = S3('test-bucket').bucket
+            self.s3_mock.get_bucket.return_value = mock.Mock()
+        with mock.patch.dict('os.environ', {'AWS_ACCESS_KEY_ID': 'two', 'AWS_SECRET_ACCESS_KEY': 'secret'}):
+            assert S3('test-bucket').bucket is not bucket
+
+        assert self.connect_s3.call_count == 2
+
+    def test_get_bucket_validates_once(self):
+        S3('test-bucket', validate=True)
+        S3('test-bucket', validate=True)
+
+        self.s3_mock.get_bucket.assert_has_calls([
+            mock.call('test-bucket', validate=False),
+            mock.call('test-bucket', validate=True),
+        ])
+        assert self.s3_mock.get_bucket.call_count == 2
+
+    def test_get_bucket_validation_error(self):
+        self.s3_mock.get_bucket.side_effect = [mock.Mock(), S3ResponseError(404, 'Not Found')]
+
+        with pytest.raises(S3ResponseError):
+            S3('test-bucket', validate=True)
+
+    def test_connections_are_recreated_after_fork(self):
+        S3('test-bucket')
+        with mock.patch('dmutils.s3.os.getpid', return_value=-1):
+            S3('test-bucket')
+
+        assert self.connect_s3.call_count == 2
+
+    def test_bucket_is_recreated_after_fork(self):
+        s3 = S3('test-bucket')
+        parent_bucket = s3.bucket
+        self.s3_mock.get_bucket.return_value = mock.Mock()
+        with mock.patch('dmutils.s3.os.getpid', return_value=-1):
+            child_bucket = s3.bucket
+
+        assert child_bucket is not parent_bucket
+        assert child_bucket is self.s3_mock.get_bucket.return_value
+        assert self.connect_s3.call_count == 2
 
     def test_path_exists(self):
         mock_bucket = FakeBucket()
@@ -73,6 +131,61 @@ class TestS3Uploader(unittest.TestCase):
 
         assert S3('test-bucket').get_key('dir/file1.pdf') == fake_key.fake_format_key(filename='file1', ext='pdf')
 
+    def test_open(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        key = S3('test-bucket').open('documents/file.pdf')
+
+        mock_bucket.new_key.assert_called_once_with('documents/file.pdf')
+        assert key is mock_bucket.new_key.return_value
+        key.open_read.assert_called_once_with(headers={})
+
+    def test_open_byte_range(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        S3('test-bucket').open('documents/file.pdf', byte_range=(10, None))
+        S3('test-bucket').open('documents/file.pdf', byte_range=(10, 19))
+
+        mock_bucket.new_key.return_value.open_read.assert_has_calls([
+            mock.call(headers={'Range': 'bytes=10-'}),
+            mock.call(headers={'Range': 'bytes=10-19'}),
+        ])
+
+    def test_open_missing_object(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.new_key.return_value.open_read.side_effect = S3ResponseError(404, 'Not Found')
+
+        assert S3('test-bucket').open('documents/file.pdf') is None
+
+    def test_open_error(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.new_key.return_value.open_read.side_effect = S3ResponseError(403, 'Forbidden')
+
+        with pytest.raises(S3ResponseError):
+            S3('test-bucket').open('documents/file.pdf')
+
+    def test_iter_chunks(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        key = mock_bucket.new_key.return_value
+        key.read.side_effect = [b'abc', b'de', b'']
+
+        assert list(S3('test-bucket').iter_chunks('documents/file.pdf', chunk_size=3)) == [b'abc', b'de']
+        key.read.assert_called_with(3)
+        key.close.assert_called_once_with()
+
+    def test_iter_chunks_missing_object(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.new_key.return_value.open_read.side_effect = S3ResponseError(404, 'Not Found')
+
+        with pytest.raises(S3ResponseError):
+            list(S3('test-bucket').iter_chunks('documents/file.pdf'))
+
     def test_delete_key(self):
         mock_bucket = FakeBucket(['folder/test-file.pdf'])
         self.s3_mock.get_bucket.return_value = mock_bucket
@@ -90,6 +203,86 @@ class TestS3Uploader(unittest.TestCase):
 
         assert 'folder/2015-10-10T00:00:00-test-file.pdf' in mock_bucket.keys
 
+    def test_delete_many_without_backup(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.delete_keys.return_value.errors = []
+
+        results = S3('test-bucket').delete_many(['a.pdf', 'b.pdf'], backup=False)
+
+        mock_bucket.delete_keys.assert_called_once_with(['a.pdf', 'b.pdf'], quiet=True)
+        assert not mock_bucket.copy_key.called
+        assert results == [
+            {'path': 'a.pdf', 'deleted': True, 'error': None},
+            {'path': 'b.pdf', 'deleted': True, 'error': None},
+        ]
+
+    def test_delete_many_batches_requests(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.delete_keys.return_value.errors = []
+        paths = ['{}.pdf'.format(i) for i in range(2500)]
+
+        S3('test-bucket').delete_many(paths, backup=False)
+
+        assert [len(args[0]) for args, kwargs in mock_bucket.delete_keys.call_args_list] == [1000, 1000, 500]
+
+    def test_delete_many_reports_per_key_errors(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.delete_keys.return_value.errors = [mock.Mock(key='b.pdf', code='AccessDenied', message='no')]
+
+        results = S3('test-bucket').delete_many(['a.pdf', 'b.pdf'], backup=False)
+
+        assert results[0]['deleted'] is True
+        assert results[1]['deleted'] is False
+        assert results[1]['error'].error_code == 'AccessDenied'
+
+    def test_delete_many_with_backup(self):
+        mock_bucket = FakeBucket(['folder/a.pdf'])
+        mock_bucket.delete_keys = mock.Mock()
+        mock_bucket.delete_keys.return_value.errors = []
+        mock_bucket.copy_key = mock.Mock(side_effect=[mock.Mock(), S3ResponseError(403, 'Forbidden')])
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        results = S3('test-bucket').delete_many(['folder/a.pdf', 'folder/b.pdf'], move_prefix='OLD', max_workers=1)
+
+        mock_bucket.copy_key.assert_has_calls([
+            mock.call('folder/OLD-a.pdf', 'test-bucket', 'folder/a.pdf'),
+            mock.call('folder/OLD-b.pdf', 'test-bucket', 'folder/b.pdf'),
+        ])
+        mock_bucket.delete_keys.assert_called_once_with(['folder/a.pdf'], quiet=True)
+        assert results[0] == {'path': 'folder/a.pdf', 'deleted': True, 'error': None}
+        assert results[1]['deleted'] is False
+        assert results[1]['error'].status == 403
+
+    def test_delete_many_with_backup_of_missing_key(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.copy_key.side_effect = S3ResponseError(404, 'Not Found')
+        mock_bucket.delete_keys.return_value.errors = []
+
+        results = S3('test-bucket').delete_many(['folder/a.pdf'])
+
+        assert results == [{'path': 'folder/a.pdf', 'deleted': True, 'error': None}]
+
+    def test_purge_prefix(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.list.return_value = [FakeKey('dir/{}.pdf'.format(i)) for i in range(1500)]
+        mock_bucket.delete_keys.return_value.errors = []
+
+        results = S3('test-bucket').purge_prefix('dir/')
+
+        mock_bucket.list.assert_called_once_with('dir/')
+        assert len(results) == 1500
+        assert mock_bucket.delete_keys.call_count == 2
+        assert not mock_bucket.copy_key.called
+
+    def test_purge_prefix_refuses_empty_prefix(self):
+        with pytest.raises(ValueError):
+            S3('test-bucket').purge_prefix('')
+
     def test_list_files(self):
         mock_bucket = mock.Mock()
         self.s3_mock.get_bucket.return_value = mock_bucket
@@ -158,6 +351,41 @@ class TestS3Uploader(unittest.TestCase):
         assert results[1]['last_modified'] == '2015-11-10T15:00:00.000000Z'
         assert results[2]['last_modified'] == '2015-12-10T15:00:00.000000Z'
 
+    def test_iter_list_is_lazy(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        def keys():
+            yield FakeKey('dir/file 1.odt')
+            raise AssertionError('listing should not be consumed past the first key')
+
+        mock_bucket.list.return_value = keys()
+
+        files = S3('test-bucket').iter_list('dir/')
+        assert next(files) == FakeKey('dir/file 1.odt').fake_format_key(filename='file 1', ext='odt')
+        mock_bucket.list.assert_called_once_with('dir/', '')
+
+    def test_iter_list_removes_directories(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        mock_bucket.list.return_value = [FakeKey('dir/', size=0), FakeKey('dir/file 1.odt')]
+
+        assert [key['path'] for key in S3('test-bucket').iter_list()] == ['dir/file 1.odt']
+
+    def test_latest_returns_newest_first(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        mock_bucket.list.return_value = [
+            FakeKey('dir/file 1.odt', last_modified='2015-08-17T14:00:00.000000Z'),
+            FakeKey('dir/file 2.odt', last_modified='2014-08-17T14:00:00.000000Z'),
+            FakeKey('dir/file 3.odt', last_modified='2016-08-17T14:00:00.000000Z'),
+        ]
+
+        latest = S3('test-bucket').latest('dir/', 2)
+        assert [key['path'] for key in latest] == ['dir/file 3.odt', 'dir/file 1.odt']
+
     def test_save_file(self):
         mock_bucket = FakeBucket()
         self.s3_mock.get_bucket.return_value = mock_bucket
@@ -210,6 +438,137 @@ class TestS3Uploader(unittest.TestCase):
                 'Content-Disposition': 'attachment; filename="new-test-file.pdf"'.encode('utf-8')
             })
 
+    def test_save_uploads_whole_file_from_any_position(self):
+        mock_bucket = FakeBucket()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        uploaded = []
+        mock_bucket.s3_key_mock.set_contents_from_file.side_effect = lambda file, **kwargs: uploaded.append(file.read())
+        file = io.BytesIO(b'blah')
+        file.read(2)
+
+        S3('test-bucket').save('folder/test-file.pdf', file)
+
+        assert uploaded == [b'blah']
+
+    def test_save_skip_unchanged_returns_existing_key(self):
+        mock_bucket = FakeBucket(['folder/test-file.pdf'])
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.s3_key_mock.etag = '"6f1ed002ab5595859014ebf0951522d9"'  # md5 of 'blah'
+
+        key = S3('test-bucket').save('folder/test-file.pdf', io.BytesIO(b'blah'), skip_unchanged=True)
+
+        assert key is mock_bucket.s3_key_mock
+        assert mock_bucket.keys == set(['folder/test-file.pdf'])
+        assert not mock_bucket.s3_key_mock.set_contents_from_file.called
+
+    def test_save_skip_unchanged_applies_acl(self):
+        mock_bucket = FakeBucket(['folder/test-file.pdf'])
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.s3_key_mock.etag = '"6f1ed002ab5595859014ebf0951522d9"'  # md5 of 'blah'
+
+        S3('test-bucket').save('folder/test-file.pdf', io.BytesIO(b'blah'), acl='private', skip_unchanged=True)
+
+        mock_bucket.s3_key_mock.set_acl.assert_called_once_with('private')
+        assert not mock_bucket.s3_key_mock.set_contents_from_file.called
+
+    def test_save_skip_unchanged_updates_changed_metadata(self):
+        mock_bucket = FakeBucket(['folder/test-file.pdf'])
+        mock_bucket.copy_key = mock.Mock(return_value=mock.Mock())
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.s3_key_mock.etag = '"6f1ed002ab5595859014ebf0951522d9"'  # md5 of 'blah'
+        mock_bucket.s3_key_mock.metadata = {'timestamp': '2015-10-10T00:00:00.000000Z'}
+        mock_bucket.s3_key_mock.get_metadata.return_value = '2015-10-10T00:00:00.000000Z'
+
+        key = S3('test-bucket').save(
+            'folder/test-file.pdf', io.BytesIO(b'blah'), timestamp=datetime.datetime(2016, 1, 1),
+            download_filename='new-test-file.pdf', skip_unchanged=True)
+
+        mock_bucket.copy_key.assert_called_once_with(
+            'folder/test-file.pdf', 'test-bucket', 'folder/test-file.pdf',
+            metadata={'timestamp': '2016-01-01T00:00:00.000000Z', 'md5': '6f1ed002ab5595859014ebf0951522d9'},
+            headers={
+                'Content-Type': 'application/pdf',
+                'Content-Disposition': 'attachment; filename="new-test-file.pdf"'.encode('utf-8')
+            })
+        assert key is mock_bucket.copy_key.return_value
+        key.set_acl.assert_called_once_with('public-read')
+        assert not mock_bucket.s3_key_mock.set_contents_from_file.called
+
+    def test_save_skip_unchanged_uses_md5_metadata_for_multipart_etags(self):
+        mock_bucket = FakeBucket(['folder/test-file.pdf'])
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.s3_key_mock.etag = '"d41d8cd98f00b204e9800998ecf8427e-2"'
+        mock_bucket.s3_key_mock.get_metadata.return_value = '6f1ed002ab5595859014ebf0951522d9'
+
+        S3('test-bucket').save('folder/test-file.pdf', io.BytesIO(b'blah'), skip_unchanged=True)
+
+        mock_bucket.s3_key_mock.get_metadata.assert_called_once_with('md5')
+        assert not mock_bucket.s3_key_mock.set_contents_from_file.called
+
+    @mock.patch('dmutils.s3.compute_md5')
+    def test_save_uses_given_md5(self, compute_md5):
+        mock_bucket = FakeBucket()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        file = io.BytesIO(b'blah')
+        md5 = ('6f1ed002ab5595859014ebf0951522d9', 'bx7QAqtVlYWQFOvwlRUi2Q==', 4)
+
+        S3('test-bucket').save('folder/test-file.pdf', file, md5=md5, skip_unchanged=True)
+
+        assert not compute_md5.called
+        mock_bucket.s3_key_mock.set_contents_from_file.assert_called_once_with(
+            file, headers={'Content-Type': 'application/pdf'}, md5=md5[:2], size=4)
+
+    def test_save_skip_unchanged_uploads_changed_file(self):
+        mock_bucket = FakeBucket(['folder/test-file.pdf'])
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.s3_key_mock.etag = '"d41d8cd98f00b204e9800998ecf8427e"'
+        file = io.BytesIO(b'blah')
+
+        S3('test-bucket').save('folder/test-file.pdf', file, move_prefix='OLD', skip_unchanged=True)
+
+        assert mock_bucket.keys == set(['folder/test-file.pdf', 'folder/OLD-test-file.pdf'])
+        mock_bucket.s3_key_mock.set_metadata.assert_any_call('md5', '6f1ed002ab5595859014ebf0951522d9')
+        mock_bucket.s3_key_mock.set_contents_from_file.assert_called_once_with(
+            file, headers={'Content-Type': 'application/pdf'},
+            md5=('6f1ed002ab5595859014ebf0951522d9', 'bx7QAqtVlYWQFOvwlRUi2Q=='), size=4)
+
+    @mock.patch('dmutils.retry.time.sleep')
+    def test_save_retries_throttled_upload(self, sleep):
+        mock_bucket = FakeBucket()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=8)
+        mock_bucket.s3_key_mock.set_contents_from_file.side_effect = [
+            S3ResponseError(503, 'Slow Down'),
+            None,
+        ]
+        file = mock_file('blah', 123)
+
+        S3('test-bucket', concurrency_limiter=limiter).save('folder/test-file.pdf', file)
+
+        assert mock_bucket.s3_key_mock.set_contents_from_file.call_count == 2
+        # each attempt starts from the beginning of the file
+        assert file.seek.call_args_list[-2:] == [mock.call(0), mock.call(0)]
+        assert sleep.call_count == 1
+        assert limiter.limit < 8
+
+    def test_save_does_not_retry_client_errors(self):
+        mock_bucket = FakeBucket()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.s3_key_mock.set_acl.side_effect = S3ResponseError(403, 'Forbidden')
+
+        with pytest.raises(S3ResponseError):
+            S3('test-bucket').save('folder/test-file.pdf', mock_file('blah', 123))
+        assert mock_bucket.s3_key_mock.set_acl.call_count == 1
+
+    @mock.patch('dmutils.retry.time.sleep')
+    def test_get_key_retries_server_errors(self, sleep):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        fake_key = FakeKey('dir/file1.pdf')
+        mock_bucket.get_key.side_effect = [S3ResponseError(500, 'Internal Error'), fake_key]
+
+        assert S3('test-bucket').get_key('dir/file1.pdf') == fake_key.fake_format_key(filename='file1', ext='pdf')
+
     def test_save_strips_leading_slash(self):
         mock_bucket = FakeBucket()
         self.s3_mock.get_bucket.return_value = mock_bucket
@@ -217,6 +576,43 @@ class TestS3Uploader(unittest.TestCase):
         S3('test-bucket').save('/folder/test-file.pdf', mock_file('blah', 123))
         self.assertEqual(mock_bucket.keys, set(['folder/test-file.pdf']))
 
+    def test_save_many(self):
+        mock_bucket = FakeBucket()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        results = S3('test-bucket').save_many([
+            {'path': 'folder/file-1.pdf', 'file': mock_file('blah', 123)},
+            {'path': 'folder/file-2.pdf', 'file': mock_file('blah', 10), 'acl': 'private',
+             'download_filename': 'file.pdf'},
+        ], max_workers=2)
+
+        assert mock_bucket.keys == set(['folder/file-1.pdf', 'folder/file-2.pdf'])
+        assert [(result['path'], result['size'], result['error']) for result in results] == [
+            ('folder/file-1.pdf', 123, None),
+            ('folder/file-2.pdf', 10, None),
+        ]
+        assert all(result['key'] is mock_bucket.s3_key_mock for result in results)
+        mock_bucket.s3_key_mock.set_acl.assert_any_call('private')
+        assert {
+            'Content-Type': 'application/pdf',
+            'Content-Disposition': 'attachment; filename="file.pdf"'.encode('utf-8')
+        } in [kwargs['headers'] for args, kwargs in mock_bucket.s3_key_mock.set_contents_from_file.call_args_list]
+
+    def test_save_many_returns_per_item_errors(self):
+        mock_bucket = FakeBucket()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        error = S3ResponseError(403, 'Forbidden')
+        mock_bucket.s3_key_mock.set_acl.side_effect = [None, error]
+
+        results = S3('test-bucket').save_many([
+            {'path': 'folder/file-1.pdf', 'file': mock_file('blah', 123)},
+            {'path': 'folder/file-2.pdf', 'file': mock_file('blah', 123)},
+        ], max_workers=1)
+
+        assert results[0]['error'] is None
+        assert results[1]['error'] is error
+        assert results[1]['key'] is None
+
     def test_default_move_prefix_is_datetime(self):
         mock_bucket = FakeBucket(['folder/test-file.pdf'])
         self.s3_mock.get_bucket.return_value = mock_bucket
@@ -284,7 +680,7 @@ class TestS3Uploader(unittest.TestCase):
 class FakeBucket(object):
     def __init__(self, keys=None):
         self.keys = set(keys or [])
-        self.s3_key_mock = mock.Mock()
+        self.s3_key_mock = mock.Mock(content_disposition=None, metadata={})
         self.s3_key_mock.name = "test-file.pdf"
 
     def get_key(self, key):
@@ -322,9 +718,93 @@ class FakeKey(object):
         return self.timestamp if key == 'timestamp' and self.timestamp else None
 
 
+@pytest.mark.parametrize('byte_range,expected', [
+    ((0, None), 'bytes 0-9/10'),
+    ((2, 5), 'bytes 2-5/10'),
+    ((2, 100), 'bytes 2-9/10'),
+])
+def test_get_content_range_header(byte_range, expected):
+    assert get_content_range_header(byte_range, 10) == expected
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('2015-08-17T14:00:00.000Z', '2015-08-17T14:00:00.000000Z'),
+    ('2015-08-17T14:00:00.123456Z', '2015-08-17T14:00:00.123456Z'),
+    ('2015-10-10T15:00:00.0000Z', '2015-10-10T15:00:00.000000Z'),
+    ('2015-08-17T14:00:00Z', '2015-08-17T14:00:00.000000Z'),
+    ('Mon, 17 Aug 2015 14:00:00 GMT', '2015-08-17T14:00:00.000000Z'),
+])
+def test_normalise_timestamp(value, expected):
+    assert normalise_timestamp(value) == expected
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('2015-08-17T14:00:00.120Z', datetime.datetime(2015, 8, 17, 14, 0, 0, 120000)),
+    ('2015-08-17T14:00:00.000001Z', datetime.datetime(2015, 8, 17, 14, 0, 0, 1)),
+    ('Mon, 17 Aug 2015 14:00:00 GMT', datetime.datetime(2015, 8, 17, 14)),
+    ('2015-08-17T15:00:00+01:00', datetime.datetime(2015, 8, 17, 14)),
+])
+def test_parse_timestamp(value, expected):
+    assert parse_timestamp(value) == expected
+
+
 def test_get_file_size_just_below_maximum():
     assert get_file_size_up_to_maximum(mock_file('', 5399999)) == 5399999
 
 
 def test_get_file_size_just_above_maximum():
     assert get_file_size_up_to_maximum(mock_file('', 5400001)) == 5400001
+
+
+def test_get_file_size_does_not_read_the_file():
+    file = mock_file('', 5400001)
+
+    assert get_file_size_up_to_maximum(file) == 5400001
+    assert not file.read.called
+    assert file.tell() == 0
+
+
+def test_get_file_size_counts_from_current_position():
+    file = io.BytesIO(b'abcdef')
+    file.seek(2)
+
+    assert get_file_size(file) == 4
+    assert file.tell() == 2
+
+
+def test_get_file_size_of_werkzeug_file_storage():
+    from werkzeug.datastructures import FileStorage
+    assert get_file_size(FileStorage(io.BytesIO(b'abcdef'), filename='file.pdf')) == 6
+
+
+def test_get_file_size_uses_content_length_of_unseekable_file():
+    file = mock.Mock(spec=['read', 'content_length'], content_length=10)
+
+    assert get_file_size(file) == 10
+    assert not file.read.called
+
+
+def test_get_file_size_up_to_maximum_counts_unseekable_file_in_chunks():
+    file = mock.Mock(spec=['read'])
+    file.read.side_effect = [b'*' * 4000000, b'*' * 4000000, b'*' * 4000000]
+
+    assert get_file_size_up_to_maximum(file) == 8000000
+    assert file.read.call_count == 2
+
+
+def test_get_file_size_up_to_maximum_rewinds_file_after_counting():
+    file = mock.Mock(spec=['read', 'seek', 'tell'])
+    file.tell.return_value = 0
+    file.seek.side_effect = [None, IOError('cannot seek from end'), None]
+    file.read.side_effect = [b'*' * 10, b'']
+
+    assert get_file_size_up_to_maximum(file) == 10
+    assert file.seek.call_args_list[-1] == mock.call(0)
+
+
+def test_get_file_size_up_to_maximum_measures_whole_file_and_rewinds_it():
+    file = io.BytesIO(b'abcdef')
+    file.read(2)
+
+    assert get_file_size_up_to_maximum(file) == 6
+    assert file.tell() == 0
@@ -0,0 +1,156 @@
+import io
+import os
+
+import mock
+import pytest
+
+from dmutils.s3 import S3ResponseError
+from dmutils.s3_cache import S3Cache
+from dmutils.s3_local import LocalKey, LocalS3
+
+
+@pytest.fixture
+def s3(tmpdir):
+    return LocalS3('test-bucket', str(tmpdir.join('s3')))
+
+
+@pytest.fixture
+def cache(s3, tmpdir):
+    return S3Cache(s3, str(tmpdir.join('cache')), max_size=10)
+
+
+def test_miss_downloads_object(s3, cache):
+    s3.save('agreements/framework-agreement.pdf', io.BytesIO(b'agreement'))
+
+    with cache.open('agreements/framework-agreement.pdf') as f:
+        assert f.read() == b'agreement'
+
+
+def test_hit_uses_conditional_get(s3, cache):
+    s3.save('agreements/framework-agreement.pdf', io.BytesIO(b'agreement'))
+    cache.open('agreements/framework-agreement.pdf').close()
+
+    request_count = s3.bucket.request_count
+    with mock.patch('dmutils.s3_cache.iter_key_chunks') as iter_key_chunks:
+        with cache.open('agreements/framework-agreement.pdf') as f:
+            assert f.read() == b'agreement'
+
+    assert not iter_key_chunks.called
+    assert s3.bucket.request_count == request_count + 1
+
+
+def test_changed_object_is_downloaded_again(s3, cache):
+    s3.save('agreements/framework-agreement.pdf', io.BytesIO(b'old'))
+    cache.open('agreements/framework-agreement.pdf').close()
+    s3.save('agreements/framework-agreement.pdf', io.BytesIO(b'new'))
+
+    with cache.open('agreements/framework-agreement.pdf') as f:
+        assert f.read() == b'new'
+
+
+def test_missing_object(s3, cache):
+    assert cache.open('agreements/missing.pdf') is None
+
+
+def test_deleted_object_is_not_served_from_cache(s3, cache):
+    s3.save('agreements/framework-agreement.pdf', io.BytesIO(b'agreement'))
+    cache.open('agreements/framework-agreement.pdf').close()
+    s3.bucket.delete_key('agreements/framework-agreement.pdf')
+
+    assert cache.open('agreements/framework-agreement.pdf') is None
+
+
+@mock.patch('dmutils.retry.time.sleep')
+def test_errors_are_raised(sleep, s3, cache):
+    with mock.patch.object(s3.bucket, 'new_key') as new_key:
+        new_key.return_value.open_read.side_effect = S3ResponseError(403, 'Forbidden')
+        with pytest.raises(S3ResponseError):
+            cache.open('agreements/framework-agreement.pdf')
+
+
+@mock.patch('dmutils.retry.time.sleep')
+def test_errors_are_retried(sleep, s3, cache):
+    s3.save('agreements/framework-agreement.pdf', io.BytesIO(b'agreement'))
+    real_open_read = LocalKey.open_read
+    calls = []
+
+    def open_read(key, *args, **kwargs):
+        calls.append(key.name)
+        if len(calls) == 1:
+            raise S3ResponseError(503, 'Slow Down')
+        return real_open_read(key, *args, **kwargs)
+
+    with mock.patch.object(LocalKey, 'open_read', open_read):
+        with cache.open('agreements/framework-agreement.pdf') as f:
+            assert f.read() == b'agreement'
+
+    assert len(calls) == 2
+
+
+def test_least_recently_used_objects_are_evicted(s3, cache):
+    for name in ('a', 'b', 'c'):
+        s3.save(name, io.BytesIO(b'1234'))
+
+    cache.open('a').close()
+    cache.open('b').close()
+    os.utime(cache._open_cached(cache._entry_name('a'))[0].name, (0, 0))
+    os.utime(cache._open_cached(cache._entry_name('b'))[0].name, (1, 1))
+    cache.open('a').close()  # hit, marks 'a' as recently used
+    cache.open('c').close()
+
+    assert cache._open_cached(cache._entry_name('a')) is not None
+    assert cache._open_cached(cache._entry_name('b')) is None
+    assert cache._open_cached(cache._entry_name('c')) is not None
+
+
+def test_eviction_removes_entries(s3, cache):
+    s3.save('a', io.BytesIO(b'123456'))
+    s3.save('b', io.BytesIO(b'123456'))
+
+    with cache.open('a') as f:
+        a_body = f.name
+    os.utime(a_body, (0, 0))
+    cache.open('b').close()
+
+    assert not os.path.exists(a_body)
+    assert not os.path.exists(cache._entry_path(cache._entry_name('a')))
+    assert len(os.listdir(cache.directory)) == 2
+
+
+def test_cache_size_is_tracked_between_scans(s3, cache):
+    for name in ('a', 'b', 'c'):
+        s3.save(name, io.BytesIO(b'123'))
+
+    with mock.patch('dmutils.s3_cache.os.listdir', wraps=os.listdir) as listdir:
+        cache.open('a').close()
+        cache.open('b').close()
+        cache.open('c').close()
+
+    # the first store scans the directory, and the next ones are within max_size
+    assert listdir.call_count == 1
+    assert cache._size == 9
+
+
+def test_cache_size_is_rescanned(s3, cache):
+    s3.save('a', io.BytesIO(b'123'))
+    s3.save('b', io.BytesIO(b'123'))
+
+    with mock.patch('dmutils.s3_cache.monotonic', return_value=0):
+        cache.open('a').close()
+    with open(os.path.join(cache.directory, 'stored-by-another-process'), 'wb') as f:
+        f.write(b'1234')
+    with mock.patch('dmutils.s3_cache.monotonic', return_value=60):
+        cache.open('b').close()
+
+    assert cache._size == 10
+
+
+def test_open_file_survives_eviction(s3, cache):
+    s3.save('a', io.BytesIO(b'12345678'))
+    s3.save('b', io.BytesIO(b'12345678'))
+
+    f = cache.open('a')
+    cache.open('b').close()
+
+    assert f.read() == b'12345678'
+    f.close()
@@ -0,0 +1,140 @@
+import datetime
+
+import mock
+from freezegun import freeze_time
+
+from .helpers import mock_file
+from dmutils.s3 import S3
+from dmutils.s3_index import S3Index
+
+
+class FakeListKey(object):
+    def __init__(self, name, last_modified='2015-08-17T14:00:00.000Z', size=1, etag='"abc"'):
+        self.name = name
+        self.last_modified = last_modified
+        self.size = size
+        self.etag = etag
+
+
+def index_with_keys(*paths):
+    index = S3Index('test-bucket')
+    for i, path in enumerate(paths):
+        index.add(path, 10, datetime.datetime(2015, 1, 1 + i), '"etag"')
+    return index
+
+
+def test_add_and_exists():
+    index = index_with_keys('g-cloud-7/documents/1/file.pdf')
+
+    assert index.exists('g-cloud-7/documents/1/file.pdf')
+    assert not index.exists('g-cloud-7/documents/1/other.pdf')
+
+
+def test_remove():
+    index = index_with_keys('g-cloud-7/documents/1/file.pdf')
+    index.remove('g-cloud-7/documents/1/file.pdf')
+
+    assert not index.exists('g-cloud-7/documents/1/file.pdf')
+
+
+def test_list_filters_by_prefix_and_orders_by_last_modified():
+    index = index_with_keys('a/2.pdf', 'a/1.pdf', 'ab/3.pdf', 'b/4.pdf')
+
+    assert [key['path'] for key in index.list('a/')] == ['a/2.pdf', 'a/1.pdf']
+    assert [key['path'] for key in index.list('a')] == ['a/2.pdf', 'a/1.pdf', 'ab/3.pdf']
+    assert len(index.list()) == 4
+
+
+def test_list_format_matches_s3_list():
+    index = index_with_keys('dir/file 1.odt')
+
+    assert index.list() == [{
+        'path': 'dir/file 1.odt',
+        'filename': 'file 1',
+        'ext': 'odt',
+        'last_modified': '2015-01-01T00:00:00.000000Z',
+        'size': 10,
+    }]
+
+
+def test_latest():
+    index = index_with_keys('a/1.pdf', 'a/2.pdf', 'a/3.pdf')
+
+    assert [key['path'] for key in index.latest('a/', 2)] == ['a/3.pdf', 'a/2.pdf']
+
+
+def test_indexes_are_scoped_to_bucket(tmpdir):
+    db_path = str(tmpdir.join('index.db'))
+    S3Index('bucket-a', db_path).add('file.pdf', 1, '2015-01-01T00:00:00.000000Z')
+
+    assert S3Index('bucket-a', db_path).exists('file.pdf')
+    assert not S3Index('bucket-b', db_path).exists('file.pdf')
+
+
+class TestSync(object):
+    def setup(self):
+        self.bucket = mock.Mock()
+        self._boto_patch = mock.patch('dmutils.s3.boto.connect_s3')
+        self._boto_patch.start().return_value.get_bucket.return_value = self.bucket
+
+    def teardown(self):
+        self._boto_patch.stop()
+
+    def test_sync_adds_and_removes_keys(self):
+        index = index_with_keys('a/stale.pdf', 'b/untouched.pdf')
+        self.bucket.list.return_value = [FakeListKey('a/', size=0), FakeListKey('a/new.pdf', size=5)]
+
+        assert index.sync(S3('test-bucket'), 'a/') == 1
+
+        self.bucket.list.assert_called_once_with('a/')
+        assert index.list() == [
+            {
+                'path': 'b/untouched.pdf',
+                'filename': 'untouched',
+                'ext': 'pdf',
+                'last_modified': '2015-01-02T00:00:00.000000Z',
+                'size': 10,
+            },
+            {
+                'path': 'a/new.pdf',
+                'filename': 'new',
+                'ext': 'pdf',
+                'last_modified': '2015-08-17T14:00:00.000000Z',
+                'size': 5,
+            },
+        ]
+
+    @freeze_time('2015-10-10')
+    def test_sync_records_sync_time(self):
+        index = S3Index('test-bucket')
+        self.bucket.list.return_value = []
+
+        assert index.needs_sync('a/')
+        index.sync(S3('test-bucket'), 'a/')
+
+        assert index.last_synced('a/') == datetime.datetime(2015, 10, 10)
+        assert not index.needs_sync('a/')
+        assert index.needs_sync('b/')
+
+    def test_save_and_delete_update_index(self):
+        index = S3Index('test-bucket')
+        s3 = S3('test-bucket', index=index)
+        self.bucket.get_key.return_value = None
+        self.bucket.new_key.return_value = FakeListKey('folder/file.pdf')
+        self.bucket.new_key.return_value.set_metadata = mock.Mock()
+        self.bucket.new_key.return_value.set_contents_from_file = mock.Mock()
+        self.bucket.new_key.return_value.set_acl = mock.Mock()
+
+        s3.save('/folder/file.pdf', mock_file('file.pdf', 3))
+        assert index.exists('folder/file.pdf')
+
+        s3.delete_key('folder/file.pdf')
+        assert not index.exists('folder/file.pdf')
+
+    def test_move_existing_adds_moved_key_to_index(self):
+        index = S3Index('test-bucket')
+        self.bucket.get_key.return_value = FakeListKey('folder/file.pdf')
+
+        S3('test-bucket', index=index)._move_existing('folder/file.pdf', 'OLD')
+
+        assert index.exists('folder/OLD-file.pdf')
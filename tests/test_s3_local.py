@@ -0,0 +1,186 @@
+import datetime
+import io
+import time
+
+import pytest
+from freezegun import freeze_time
+
+from dmutils.s3 import S3ResponseError
+from dmutils.s3_local import LocalS3
+
+
+@pytest.fixture
+def s3(tmpdir):
+    return LocalS3('test-bucket', str(tmpdir))
+
+
+def test_save_and_get_key(s3):
+    s3.save('/folder/test-file.pdf', io.BytesIO(b'blah'), timestamp=datetime.datetime(2015, 10, 11))
+
+    assert s3.path_exists('folder/test-file.pdf')
+    assert s3.get_key('folder/test-file.pdf') == {
+        'path': 'folder/test-file.pdf',
+        'filename': 'test-file',
+        'ext': 'pdf',
+        'last_modified': '2015-10-11T00:00:00.000000Z',
+        'size': 4,
+    }
+
+
+def test_save_stores_headers_and_acl(s3):
+    s3.save('folder/test-file.pdf', io.BytesIO(b'blah'), acl='private', download_filename='new-file.pdf')
+
+    key = s3.bucket.get_key('folder/test-file.pdf')
+    assert key.content_type == 'application/pdf'
+    assert key.content_disposition == 'attachment; filename="new-file.pdf"'
+    assert key.acl == 'private'
+    assert key.etag == '"6f1ed002ab5595859014ebf0951522d9"'
+
+
+def test_path_exists_nonexistent_path(s3):
+    assert s3.path_exists('foo') is False
+    assert s3.get_key('foo') is None
+    assert s3.get_signed_url('foo') is None
+
+
+def test_get_signed_url(s3):
+    s3.save('folder/test-file.pdf', io.BytesIO(b'blah'))
+
+    assert s3.get_signed_url('folder/test-file.pdf').startswith('file://')
+
+
+def test_list_files_by_prefix_in_last_modified_order(s3):
+    with freeze_time('2015-10-11'):
+        s3.save('folder/b.pdf', io.BytesIO(b'blah'))
+    with freeze_time('2015-10-10'):
+        s3.save('folder/a.pdf', io.BytesIO(b'blah'))
+        s3.save('other/c.pdf', io.BytesIO(b'blah'))
+
+    assert [key['path'] for key in s3.list('folder/')] == ['folder/a.pdf', 'folder/b.pdf']
+    assert [key['last_modified'] for key in s3.list('folder/')] == [
+        '2015-10-10T00:00:00.000000Z', '2015-10-11T00:00:00.000000Z']
+    assert len(s3.list()) == 3
+
+
+def test_list_files_with_loading_custom_timestamps(s3):
+    s3.save('folder/a.pdf', io.BytesIO(b'blah'), timestamp=datetime.datetime(2014, 1, 1))
+
+    assert s3.list(load_timestamps=True)[0]['last_modified'] == '2014-01-01T00:00:00.000000Z'
+
+
+def test_list_with_delimiter_skips_subdirectories(s3):
+    s3.save('folder/a.pdf', io.BytesIO(b'blah'))
+    s3.save('folder/sub/b.pdf', io.BytesIO(b'blah'))
+
+    assert [key['path'] for key in s3.list('folder/', delimiter='/')] == ['folder/a.pdf']
+
+
+@freeze_time('2015-10-10')
+def test_save_existing_file_moves_it_out_of_the_way(s3):
+    s3.save('folder/test-file.pdf', io.BytesIO(b'old'))
+    s3.save('folder/test-file.pdf', io.BytesIO(b'new'))
+
+    assert sorted(key['path'] for key in s3.list()) == [
+        'folder/2015-10-10T00:00:00-test-file.pdf',
+        'folder/test-file.pdf',
+    ]
+    assert s3.get_key('folder/2015-10-10T00:00:00-test-file.pdf')['size'] == 3
+
+
+@freeze_time('2015-10-10')
+def test_save_skip_unchanged(s3):
+    s3.save('folder/test-file.pdf', io.BytesIO(b'blah'))
+    request_count = s3.bucket.request_count
+
+    s3.save('folder/test-file.pdf', io.BytesIO(b'blah'), skip_unchanged=True)
+
+    # the existing object is checked and its ACL applied, but it is not uploaded again
+    assert s3.bucket.request_count == request_count + 2
+    assert [key['path'] for key in s3.list()] == ['folder/test-file.pdf']
+
+    s3.save('folder/test-file.pdf', io.BytesIO(b'changed'), skip_unchanged=True)
+
+    assert s3.get_key('folder/test-file.pdf')['size'] == 7
+    assert s3.path_exists('folder/2015-10-10T00:00:00-test-file.pdf')
+
+
+def test_save_skip_unchanged_applies_acl_and_metadata(s3):
+    s3.save('folder/test-file.pdf', io.BytesIO(b'blah'), acl='public-read')
+
+    s3.save('folder/test-file.pdf', io.BytesIO(b'blah'), acl='private', download_filename='download.pdf',
+            skip_unchanged=True)
+
+    key = s3.bucket.get_key('folder/test-file.pdf')
+    assert key.acl == 'private'
+    assert key.content_disposition == 'attachment; filename="download.pdf"'
+    assert key.content_type == 'application/pdf'
+    assert [path['path'] for path in s3.list()] == ['folder/test-file.pdf']
+
+
+@freeze_time('2015-10-10')
+def test_delete_key_moves_file_with_prefix(s3):
+    s3.save('folder/test-file.pdf', io.BytesIO(b'blah'))
+    s3.delete_key('folder/test-file.pdf')
+
+    assert not s3.path_exists('folder/test-file.pdf')
+    assert s3.path_exists('folder/2015-10-10T00:00:00-test-file.pdf')
+
+
+def test_iter_chunks(s3):
+    s3.save('folder/test-file.pdf', io.BytesIO(b'0123456789'))
+
+    assert list(s3.iter_chunks('folder/test-file.pdf', chunk_size=4)) == [b'0123', b'4567', b'89']
+    assert list(s3.iter_chunks('folder/test-file.pdf', chunk_size=4, byte_range=(3, 8))) == [b'3456', b'78']
+    assert list(s3.iter_chunks('folder/test-file.pdf', byte_range=(7, None))) == [b'789']
+
+
+def test_open_byte_range(s3):
+    s3.save('folder/test-file.pdf', io.BytesIO(b'0123456789'))
+
+    key = s3.open('folder/test-file.pdf', byte_range=(3, 100))
+    assert key.size == 10
+    assert key.read() == b'3456789'
+    key.close()
+
+    with pytest.raises(S3ResponseError):
+        s3.open('folder/test-file.pdf', byte_range=(10, None))
+
+
+def test_open_missing_object(s3):
+    assert s3.open('folder/missing.pdf') is None
+
+
+def test_iter_chunks_empty_object(s3):
+    s3.save('folder/test-file.pdf', io.BytesIO(b''))
+
+    assert list(s3.iter_chunks('folder/test-file.pdf')) == []
+
+
+@freeze_time('2015-10-10')
+def test_purge_prefix_with_backup(s3):
+    for path in ('g-cloud-7/1/a.pdf', 'g-cloud-7/1/b.pdf', 'g-cloud-8/1/c.pdf'):
+        s3.save(path, io.BytesIO(b'blah'))
+
+    results = s3.purge_prefix('g-cloud-7/', backup=True)
+
+    assert [result['deleted'] for result in results] == [True, True]
+    assert sorted(key['path'] for key in s3.list()) == [
+        'g-cloud-7/1/2015-10-10T00:00:00-a.pdf',
+        'g-cloud-7/1/2015-10-10T00:00:00-b.pdf',
+        'g-cloud-8/1/c.pdf',
+    ]
+
+
+def test_copy_missing_key(s3):
+    with pytest.raises(S3ResponseError):
+        s3.bucket.copy_key('b', 'test-bucket', 'a')
+
+
+def test_request_count_and_latency(tmpdir):
+    s3 = LocalS3('test-bucket', str(tmpdir), latency=0.01)
+
+    start = time.time()
+    s3.path_exists('foo')
+
+    assert s3.bucket.request_count == 1
+    assert time.time() - start >= 0.01
@@ -0,0 +1,56 @@
+# coding: utf-8
+import datetime
+import io
+import zipfile
+
+import pytest
+
+from dmutils.zipstream import iter_zip, get_dos_datetime
+
+
+def read_zip(chunks):
+    return zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+
+
+def test_iter_zip_writes_readable_archive():
+    modified = datetime.datetime(2016, 5, 4, 13, 2, 11)
+    archive = read_zip(iter_zip([
+        (u'price-list.csv', modified, [b'name,price\n', b'Kev,1.50\n']),
+        (u'r\xe9sum\xe9.pdf', modified, iter([b'%PDF-1.4\n' * 10000])),
+        ('empty.txt', modified, []),
+    ]))
+
+    assert archive.testzip() is None
+    assert archive.namelist() == [u'price-list.csv', u'r\xe9sum\xe9.pdf', u'empty.txt']
+    assert archive.read(u'price-list.csv') == b'name,price\nKev,1.50\n'
+    assert archive.read(u'r\xe9sum\xe9.pdf') == b'%PDF-1.4\n' * 10000
+    assert archive.read(u'empty.txt') == b''
+    assert archive.getinfo(u'price-list.csv').date_time == (2016, 5, 4, 13, 2, 10)
+    assert archive.getinfo(u'r\xe9sum\xe9.pdf').compress_size < 1000
+
+
+def test_iter_zip_writes_empty_archive():
+    assert read_zip(iter_zip([])).namelist() == []
+
+
+def test_iter_zip_reads_entries_lazily():
+    def entries():
+        yield 'file-1', datetime.datetime(2016, 1, 1), [b'one']
+        raise AssertionError("second entry read before the first was written")
+
+    chunks = iter_zip(entries())
+    assert next(chunks).endswith(b'file-1')
+
+
+def test_iter_zip_rejects_too_many_entries():
+    with pytest.raises(ValueError):
+        for chunk in iter_zip(('file', datetime.datetime(2016, 1, 1), []) for i in range(0x10000)):
+            pass
+
+
+@pytest.mark.parametrize('value,expected', [
+    (datetime.datetime(2016, 5, 4, 13, 2, 11), ((13 << 11) | (2 << 5) | 5, (36 << 9) | (5 << 5) | 4)),
+    (datetime.datetime(1970, 1, 1), (0, (1 << 5) | 1)),
+])
+def test_get_dos_datetime(value, expected):
+    assert get_dos_datetime(value) == expected